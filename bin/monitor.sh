@@ -0,0 +1,19 @@
+#!/bin/sh
+
+#
+# Show live statistics of the UNICORE TSI: workers with their
+# current command and user, command latencies, and connection
+# setup timings (requires 'tsi.control_socket' to be set)
+#
+# Use '--json' to get the raw statistics
+#
+
+cd /opt/tsi-nuvla
+
+#
+# Read basic settings
+#
+. ./conf/startup.properties
+
+export PYTHONPATH=${PY}
+$PYTHON $PY/Monitor.py ${CONF}/tsi.properties $*
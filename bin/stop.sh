@@ -3,6 +3,11 @@
 #
 # Shutdown script for UNICORE TSI
 #
+# Usage: stop.sh [timeout]
+#
+# waits up to 'timeout' seconds (default: 330) for the TSI to finish
+# running requests before killing it
+#
 
 
 cd /opt/tsi-nuvla
@@ -33,7 +38,24 @@ WORKERS=$(ps --ppid $PIDVALUE -o pid | sed "s/PID//")
 echo "Found TSI main process running with PID" $PIDVALUE
 echo "Found TSI worker process(es) running with PID(s)" $WORKERS
 
-echo $PIDVALUE $WORKERS | xargs kill -SIGKILL
+# graceful shutdown: the TSI stops accepting new connections and
+# waits for the workers to finish their current request
+# (see 'tsi.drain_timeout')
+kill -TERM $PIDVALUE
+
+TIMEOUT=${1:-330}
+while [ -e /proc/$PIDVALUE ] && [ $TIMEOUT -gt 0 ]
+do
+ sleep 1
+ TIMEOUT=$((TIMEOUT-1))
+done
+
+if [ -e /proc/$PIDVALUE ]
+then
+ echo "TSI did not stop in time, killing it."
+ WORKERS=$(ps --ppid $PIDVALUE -o pid | sed "s/PID//")
+ echo $PIDVALUE $WORKERS | xargs kill -SIGKILL
+fi
 
 echo "TSI stopped."
 
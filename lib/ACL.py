@@ -8,6 +8,11 @@
     are used: it is assumed that getfacl returns also the default ACL entries,
     it is assumed that setfacl automatically creates the mandatory default ACL
     entries when needed, -R option is used to achieve recursive behavior.
+    On Linux with Python 3, the ACLs are by default read and written
+    directly via the 'system.posix_acl_access' and
+    'system.posix_acl_default' extended attributes, producing the same
+    output as the commands (see 'tsi.posix_acl_native'). The commands are
+    used if this is not possible.
 
  The process_acl function expects the following argument in the XNJS message:
  #TSI_ACL_OPERATION <CHECK_SUPPORT|GETFACL|SETFACL>
@@ -20,6 +25,10 @@
  TSI_ACL_COMMAND is reguired only for SETFACL
  TSI_ACL_COMMAND_SPEC is only required for SETFACL, with command MODIFY or RM.
 
+ For SETFACL, TSI_ACL_PATH and TSI_ACL_COMMAND_SPEC may be given more than
+ once, to apply all the given changes to all the given paths in a single
+ request. Failures are reported for each path in a single TSI_FAILED line.
+
  the COMMAND and COMMAND_SPEC are required only for SETFACL operation.
  In the COMMAND_SPEC D is used to modify/remove default directory ACL. Subject
  can be empty
@@ -46,31 +55,105 @@
      Every line is terminated by \n
 """
 
+import errno
+import grp
+import itertools
 import os
+import pwd
 import re
+import struct
+import sys
+import time
+from multiprocessing.pool import ThreadPool
 
 from Utils import run_command, extract_parameter
 
+# Linux binary format of the ACL extended attributes:
+# a header (version) followed by entries (tag, permissions, id)
+ACL_XATTR_ACCESS = "system.posix_acl_access"
+ACL_XATTR_DEFAULT = "system.posix_acl_default"
+ACL_XATTR_VERSION = 2
+ACL_UNDEFINED_ID = 0xFFFFFFFF
+(ACL_USER_OBJ, ACL_USER, ACL_GROUP_OBJ, ACL_GROUP, ACL_MASK, ACL_OTHER) = (
+    0x01, 0x02, 0x04, 0x08, 0x10, 0x20)
+
+_header = struct.Struct("<I")
+_entry = struct.Struct("<HHI")
+
+
+class ACLIndex(object):
+    """ The configured ACL support per directory ('tsi.acl.<path>'),
+        as a trie of path components. The most specific (longest)
+        configured prefix of a path wins. Results are memoized
+        per directory.
+    """
+
+    def __init__(self, acl, max_memo=10000):
+        # node: [value or None, {component: node}]
+        self.root = [None, {}]
+        for (prefix, value) in acl.items():
+            node = self.root
+            for component in _components(prefix):
+                node = node[1].setdefault(component, [None, {}])
+            node[0] = value
+        self.memo = {}
+        self.max_memo = max_memo
+
+    def _walk(self, directory):
+        """ returns the ACL support of the directory, and the directory's
+            trie node (None if the directory is not a configured prefix
+            or a parent of one)
+        """
+        node = self.root
+        result = node[0]
+        for component in _components(directory):
+            node = node[1].get(component)
+            if node is None:
+                break
+            if node[0] is not None:
+                result = node[0]
+        return result, node
+
+    def lookup(self, path):
+        path = os.path.normpath(os.path.abspath(path))
+        (directory, name) = os.path.split(path)
+        entry = self.memo.get(directory)
+        if entry is None:
+            if len(self.memo) >= self.max_memo:
+                self.memo.clear()
+            entry = self._walk(directory)
+            self.memo[directory] = entry
+        (result, node) = entry
+        if node is not None and name:
+            child = node[1].get(name)
+            if child is not None and child[0] is not None:
+                result = child[0]
+        if result is None:
+            return "NONE"
+        return result
+
+
+def _components(path):
+    return [c for c in os.path.normpath(path).split("/") if c]
+
+
+def get_acl_index(config):
+    """ The ACL index compiled from the configuration """
+    index = config.get('tsi.acl_index')
+    if index is None:
+        index = ACLIndex(config.get('tsi.acl', {}))
+        config['tsi.acl_index'] = index
+    return index
+
 
 def check_support(path, acl):
     """ Checks if a directory is on a FS configured with ACL support.
+        'acl' is an ACLIndex or the dictionary of configured prefixes.
         Returns: "POSIX" or "NFS", or "NONE" if no ACL support
     """
-    # FIXIT: something is wrong here
-    abs_path = os.path.abspath(path)
-    best_match = 0
-    for key in acl:
-        m = re.match(r"^" + key, path)
-        if m:
-            size = len(m.group(0))
-            if size > best_match:
-                best_match = size
-                best_result = acl[key]
-
-    if best_match > 0:
-        return best_result
-    else:
-        return "NONE"
+    if not isinstance(acl, ACLIndex):
+        acl = ACLIndex(acl)
+    return acl.lookup(path)
 
 
 def getfacl_nfs(path, connector, config, LOG):
@@ -86,7 +169,137 @@ def unset_posix():
         del os.environ['POSIXLY_CORRECT']
 
 
+def native_acl_supported(config):
+    """ Whether ACLs can be read and written via extended attributes """
+    return config.get('tsi.posix_acl_native', True) and \
+        hasattr(os, "getxattr") and sys.platform.startswith("linux")
+
+
+def decode_acl(data):
+    """ Decodes an ACL extended attribute into a list of
+        (tag, permissions, id) tuples
+    """
+    (version,) = _header.unpack_from(data)
+    if version != ACL_XATTR_VERSION:
+        raise ValueError("Unsupported ACL version %s" % version)
+    return [_entry.unpack_from(data, offset) for offset in
+            range(_header.size, len(data), _entry.size)]
+
+
+def encode_acl(entries):
+    """ Encodes a list of (tag, permissions, id) tuples, sorted in the
+        order expected by the kernel
+    """
+    entries = sorted(entries, key=lambda e: (e[0], e[2]))
+    return _header.pack(ACL_XATTR_VERSION) + b"".join(
+        [_entry.pack(tag, perms, qualifier) for (tag, perms, qualifier) in
+         entries])
+
+
+def acl_from_mode(mode):
+    """ The minimal ACL equivalent to the permission bits """
+    return [(ACL_USER_OBJ, (mode >> 6) & 7, ACL_UNDEFINED_ID),
+            (ACL_GROUP_OBJ, (mode >> 3) & 7, ACL_UNDEFINED_ID),
+            (ACL_OTHER, mode & 7, ACL_UNDEFINED_ID)]
+
+
+def read_acl(path, default=False):
+    """ Reads the access ACL (or the default ACL, None if there is none)
+        of the path
+    """
+    name = ACL_XATTR_DEFAULT if default else ACL_XATTR_ACCESS
+    try:
+        return decode_acl(os.getxattr(path, name))
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENODATA:
+            raise
+    if default:
+        return None
+    return acl_from_mode(os.stat(path).st_mode)
+
+
+def _perm_text(perms):
+    return "".join([c if perms & bit else "-" for (c, bit) in
+                    [("r", 4), ("w", 2), ("x", 1)]])
+
+
+def _qualifier_text(tag, qualifier, names):
+    if tag not in (ACL_USER, ACL_GROUP):
+        return ""
+    name = names.get((tag, qualifier))
+    if name is None:
+        try:
+            if tag == ACL_USER:
+                name = pwd.getpwuid(qualifier).pw_name
+            else:
+                name = grp.getgrgid(qualifier).gr_name
+        except KeyError:
+            name = str(qualifier)
+        names[(tag, qualifier)] = name
+    return name
+
+
+_tag_names = {ACL_USER_OBJ: "user", ACL_USER: "user", ACL_GROUP_OBJ: "group",
+              ACL_GROUP: "group", ACL_MASK: "mask", ACL_OTHER: "other"}
+
+
+def acl_to_text(entries, prefix="", names=None):
+    """ Formats the ACL entries like getfacl does, including the
+        effective permissions if restricted by the mask
+    """
+    if names is None:
+        names = {}
+    mask = None
+    for (tag, perms, _) in entries:
+        if tag == ACL_MASK:
+            mask = perms
+    lines = []
+    for (tag, perms, qualifier) in entries:
+        line = "%s%s:%s:%s" % (prefix, _tag_names[tag],
+                               _qualifier_text(tag, qualifier, names),
+                               _perm_text(perms))
+        if mask is not None and tag in (ACL_USER, ACL_GROUP_OBJ, ACL_GROUP) \
+                and perms & mask != perms:
+            # align the comment at column 32 (like getfacl)
+            column = len(line)
+            tabs = ""
+            while True:
+                tabs += "\t"
+                column = (column // 8 + 1) * 8
+                if column >= 32:
+                    break
+            line += "%s#effective:%s" % (tabs, _perm_text(perms & mask))
+        lines.append(line)
+    return lines
+
+
+def getfacl_native(path):
+    """ Returns the ACL lines as printed by getfacl """
+    names = {}
+    lines = acl_to_text(read_acl(path), "", names)
+    if os.path.isdir(path):
+        default_acl = read_acl(path, default=True)
+        if default_acl is not None:
+            lines += acl_to_text(default_acl, "default:", names)
+    return lines
+
+
 def getfacl_posix(path, connector, config, LOG):
+    if native_acl_supported(config):
+        try:
+            lines = getfacl_native(path)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.ENOTSUP, errno.EOPNOTSUPP):
+                connector.failed("Cannot get ACL of '%s': %s" % (path, e))
+                return
+            LOG.debug("No extended attribute support for %s, using %s" % (
+                path, config.get('tsi.getfacl_cmd')))
+        else:
+            connector.ok()
+            for line in lines:
+                if is_acl_entry(line):
+                    connector.write_message(line)
+            return
     unset_posix()
     getfacl_cmd = config.get('tsi.getfacl_cmd', '/bin/false')
     command = "%s %s" % (getfacl_cmd, path)
@@ -95,13 +308,18 @@ def getfacl_posix(path, connector, config, LOG):
     if not success:
         connector.failed(result)
     else:
-        patterns = ["user", "group", "default:user", "default:group"]
         connector.ok()
         for line in result.splitlines():
-            if True in [line.startswith(p) for p in patterns]:
+            if is_acl_entry(line):
                 connector.write_message(line)
 
 
+def is_acl_entry(line):
+    """ Whether the getfacl output line is reported to the XNJS """
+    patterns = ["user", "group", "default:user", "default:group"]
+    return True in [line.startswith(p) for p in patterns]
+
+
 def prepare_posix_arg(val, remove):
     ret = ""
     oargs = val.split(" ")
@@ -114,7 +332,167 @@ def prepare_posix_arg(val, remove):
     return ret
 
 
-def setfacl_posix(path, op, val, connector, config, LOG):
+def parse_acl_spec(val, remove):
+    """ Parses '[D]<U|G> <subject> <permissions>' into a tuple
+        (default, tag, id, permissions)
+    """
+    oargs = val.split(" ")
+    default = oargs[0].startswith("D")
+    is_user = re.match(r"[D]?U", oargs[0]) is not None
+    subject = oargs[1] if len(oargs) > 1 else ""
+    if subject == "":
+        tag = ACL_USER_OBJ if is_user else ACL_GROUP_OBJ
+        qualifier = ACL_UNDEFINED_ID
+    else:
+        tag = ACL_USER if is_user else ACL_GROUP
+        try:
+            if is_user:
+                qualifier = pwd.getpwnam(subject).pw_uid
+            else:
+                qualifier = grp.getgrnam(subject).gr_gid
+        except KeyError:
+            if not subject.isdigit():
+                raise ValueError("Unknown %s '%s'" % (
+                    "user" if is_user else "group", subject))
+            qualifier = int(subject)
+    perms = 0
+    if not remove:
+        perm_text = oargs[2] if len(oargs) > 2 else ""
+        for (c, bit) in [("r", 4), ("w", 2), ("x", 1)]:
+            if c in perm_text:
+                perms |= bit
+        if re.match(r"^[rwx-]+$", perm_text) is None:
+            raise ValueError("Invalid permissions '%s'" % perm_text)
+    return default, tag, qualifier, perms
+
+
+def apply_acl_change(path, command, spec, recursive):
+    """ Applies the change to a single file or directory. 'command' is
+        one of RM_ALL, MODIFY or RM, spec as returned by parse_acl_spec
+    """
+    is_dir = os.path.isdir(path)
+    if command == "RM_ALL":
+        entries = [e for e in read_acl(path)
+                   if e[0] in (ACL_USER_OBJ, ACL_GROUP_OBJ, ACL_OTHER)]
+        os.setxattr(path, ACL_XATTR_ACCESS, encode_acl(entries))
+        if is_dir and read_acl(path, default=True) is not None:
+            os.removexattr(path, ACL_XATTR_DEFAULT)
+        return
+    (default, tag, qualifier, perms) = spec
+    if default and not is_dir:
+        if recursive:
+            return
+        raise ValueError("Only directories can have default ACLs")
+    entries = read_acl(path, default)
+    if entries is None:
+        if command == "RM":
+            return
+        # create the mandatory entries from the access ACL
+        entries = [e for e in read_acl(path)
+                   if e[0] in (ACL_USER_OBJ, ACL_GROUP_OBJ, ACL_OTHER)]
+    had_mask = True in [e[0] == ACL_MASK for e in entries]
+    others = [e for e in entries if (e[0], e[2]) != (tag, qualifier)]
+    if command == "RM":
+        if tag in (ACL_USER_OBJ, ACL_GROUP_OBJ):
+            raise ValueError("Cannot remove the base ACL entries")
+        entries = others
+    else:
+        entries = others + [(tag, perms, qualifier)]
+    entries = [e for e in entries if e[0] != ACL_MASK]
+    named = True in [e[0] in (ACL_USER, ACL_GROUP) for e in entries]
+    if had_mask or named:
+        mask = 0
+        for (t, p, _) in entries:
+            if t in (ACL_USER, ACL_GROUP_OBJ, ACL_GROUP):
+                mask |= p
+        entries.append((ACL_MASK, mask, ACL_UNDEFINED_ID))
+    name = ACL_XATTR_DEFAULT if default else ACL_XATTR_ACCESS
+    os.setxattr(path, name, encode_acl(entries))
+
+
+def parse_acl_changes(op, specs):
+    """ Returns the list of (command, spec) to apply for the SETFACL
+        command and command specs
+    """
+    if "RM_ALL" in op:
+        return [("RM_ALL", None)]
+    elif "MODIFY" in op:
+        return [("MODIFY", parse_acl_spec(val, False)) for val in specs]
+    elif "RM" in op:
+        return [("RM", parse_acl_spec(val, True)) for val in specs]
+    else:
+        raise ValueError("WRONG SETFACL SYNTAX")
+
+
+def walk_tree(path):
+    """ All files and directories below the path. Like setfacl, symbolic
+        links below the path are not followed
+    """
+    for (directory, dirs, files) in os.walk(path):
+        for name in dirs + files:
+            child = os.path.join(directory, name)
+            if not os.path.islink(child):
+                yield child
+
+
+def setfacl_native(paths, op, specs, config, LOG):
+    """ Changes the ACL of the paths like setfacl does, via extended
+        attributes. The trees below the paths (if recursive) are
+        processed by a pool of 'tsi.setfacl_threads' threads.
+        Returns the list of (path, error message) for failed paths.
+        Raises OSError if a path does not support extended attributes.
+    """
+    changes = parse_acl_changes(op, specs)
+    recursive = "RECURSIVE" in op
+
+    def apply(path):
+        try:
+            for (command, spec) in changes:
+                apply_acl_change(path, command, spec, recursive)
+        except (IOError, OSError, ValueError) as e:
+            return path, e
+        return path, None
+
+    failures = []
+    trees = []
+    for path in paths:
+        (_, error) = apply(path)
+        if error is None:
+            if recursive and os.path.isdir(path):
+                trees.append(path)
+        elif getattr(error, "errno", None) in (errno.ENOTSUP,
+                                               errno.EOPNOTSUPP):
+            raise error
+        else:
+            failures.append((path, _error_text(error)))
+    if len(trees) > 0:
+        start = time.time()
+        count = 0
+        pool = ThreadPool(int(config.get('tsi.setfacl_threads', 4)))
+        try:
+            children = itertools.chain(*[walk_tree(tree) for tree in trees])
+            for (path, error) in pool.imap_unordered(apply, children, 64):
+                count += 1
+                if error is not None:
+                    failures.append((path, _error_text(error)))
+                if count % 10000 == 0:
+                    LOG.info("ACL changed for %d files so far" % count)
+        finally:
+            pool.close()
+            pool.join()
+        LOG.info("ACL changed for %d files in %.1f seconds, %d failed" % (
+            len(paths) + count, time.time() - start, len(failures)))
+    return failures
+
+
+def _error_text(error):
+    return getattr(error, "strerror", None) or str(error)
+
+
+def setfacl_command(path, op, val, config, LOG):
+    """ Changes the ACL by running the setfacl command
+        Returns a success flag and the error message
+    """
     unset_posix()
     setfacl_cmd = config.get('tsi.setfacl_cmd', '/bin/false')
 
@@ -136,24 +514,66 @@ def setfacl_posix(path, op, val, connector, config, LOG):
             base_arg += "-x"
             remove = True
         else:
-            connector.failed("WRONG SETFACL SYNTAX")
-            return
+            return False, "WRONG SETFACL SYNTAX"
         arg = prepare_posix_arg(val, remove)
         command = "%s %s%s %s '%s'" % (
             setfacl_cmd, recursive, base_arg, arg, path)
 
     LOG.debug(command)
-    (success, result) = run_command(command)
-    if not success:
-        connector.failed(result)
+    return run_command(command)
+
+
+def setfacl_posix(path, op, val, connector, config, LOG):
+    setfacl_posix_batch([path], op, [val], connector, config, LOG)
+
+
+def setfacl_posix_batch(paths, op, specs, connector, config, LOG):
+    """ Applies all the ACL changes (specs) to all the paths, and
+        reports all failures in a single reply
+    """
+    if native_acl_supported(config):
+        try:
+            failures = setfacl_native(paths, op, specs, config, LOG)
+        except ValueError as e:
+            connector.failed(str(e))
+            return
+        except (IOError, OSError) as e:
+            LOG.debug("No extended attribute support for %s, using %s" % (
+                e.filename, config.get('tsi.setfacl_cmd')))
+        else:
+            report_failures(failures, connector)
+            return
+    if "RM_ALL" in op:
+        specs = [None]
+    failures = []
+    for path in paths:
+        for val in specs:
+            (success, result) = setfacl_command(path, op, val, config, LOG)
+            if not success:
+                failures.append((path, result))
+    if len(paths) == 1 and len(failures) == 1:
+        # single request: report the command's error as before
+        connector.failed(failures[0][1])
     else:
+        report_failures(failures, connector)
+
+
+def report_failures(failures, connector, max_reported=100):
+    if len(failures) == 0:
         connector.ok()
+        return
+    report = ", ".join(["%s: %s" % (path, error) for (path, error) in
+                        failures[:max_reported]])
+    if len(failures) > max_reported:
+        report += ", ... (%d more)" % (len(failures) - max_reported)
+    connector.failed("Setting ACL failed for %d path(s): %s" % (
+        len(failures), report))
 
 
 def process_acl(message, connector, config, LOG):
     operation = extract_parameter(message, "ACL_OPERATION")
     path = extract_parameter(message, "ACL_PATH")
-    acl = config.get('tsi.acl', {})
+    acl = get_acl_index(config)
     if operation == "CHECK_SUPPORT":
         support = check_support(path, acl)
         if support == "NONE":
@@ -173,12 +593,25 @@ def process_acl(message, connector, config, LOG):
         support = check_support(path, acl)
         command = extract_parameter(message, "ACL_COMMAND")
         command_spec = extract_parameter(message, "ACL_COMMAND_SPEC")
+        # batch requests have more than one path and/or spec
+        paths = re.findall(r"^#TSI_ACL_PATH (.+)\n", message, re.M)
+        specs = re.findall(r"^#TSI_ACL_COMMAND_SPEC (.+)\n", message, re.M)
         if command_spec is None:
             connector.failed("Missing parameter TSI_ACL_COMMAND_SPEC")
         if command is None:
             connector.failed("Missing parameter TSI_ACL_COMMAND")
-        if support == "POSIX":
+        if len(paths) > 1 and True in [check_support(p, acl) != support
+                                       for p in paths]:
+            connector.failed("ERROR: All paths must be on file systems "
+                             "with the same ACL support.")
+        elif support == "POSIX" and (len(paths) > 1 or len(specs) > 1):
+            setfacl_posix_batch(paths, command, specs, connector, config,
+                                LOG)
+        elif support == "POSIX":
             setfacl_posix(path, command, command_spec, connector, config, LOG)
+        elif support == "NFS" and (len(paths) > 1 or len(specs) > 1):
+            connector.failed("ERROR: Batch requests are not supported for "
+                             "NFS ACLs.")
         elif support == "NFS":
             setfacl_nfs(path, command, command_spec, connector, config, LOG)
         else:
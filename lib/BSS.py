@@ -1,10 +1,12 @@
 """Nuvla connector for UNICORE """
 
+import copy
 import hashlib
 import os
 import re
 import time
 import sys
+import Reservation
 import Utils
 
 from BSSCommon import BSSBase
@@ -35,6 +37,11 @@ JOB_STATE_MAP = {'initializing': 'QUEUED',
 
 class BSS(BSSBase):
 
+    # lines of '<deployment ID> <Nuvla state>' (e.g. a listing of Nuvla
+    # deployments), used for validation
+    qstat_pattern = re.compile(
+        r"\s*(?P<bssid>\S+)\s+(?P<state>\w+)(?:\s+(?P<queue>\S+))?")
+
     @staticmethod
     def check_params(messages):
         params = BSS._nuvla_parameter_dict(messages)
@@ -210,16 +217,16 @@ class BSS(BSSBase):
             s3_stage_path = self._put_files_to_s3(nuvla, message)
             s3_stage_path_str =  "%s/%s" % (s3_stage_path.bucket.name,
                                             s3_stage_path.name)
-            BSS._nested_set(params, [COMP_NAME, USERSPACE_RTP], s3_stage_path_str)
+            job_params = copy.deepcopy(params)
+            BSS._nested_set(job_params, [COMP_NAME, USERSPACE_RTP],
+                            s3_stage_path_str)
             
-            LOG.info("parameters: %s" % str(params))
+            LOG.info("parameters: %s" % str(job_params))
 
-            # use default cloud for all nodes, old value was:
-            # {COMP_NAME: CLOUD_CONN_NAME}
-            cloud_params = {}
-            
-            dpl_id = nuvla.deploy(app, cloud=cloud_params,
-                                  parameters=params, keep_running='never')
+            # a deployment from the warm pool, if one is ready
+            client = Reservation.SlipStreamClient(nuvla)
+            dpl_id = Reservation.deploy_job(client, app, params, job_params,
+                                            config, LOG)
             LOG.info("Submitted to Nuvla with id %s" % str(dpl_id))
             #connector.ok()
             connector.write_message(str(dpl_id))
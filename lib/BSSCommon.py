@@ -118,6 +118,11 @@ class BSSBase(object):
             job_id = m.group(1)
         return job_id
 
+    # compiled pattern matching the lines of the status listing that
+    # describe a job, with the groups 'bssid', 'state' and 'queue' (which
+    # may be empty). If not set, extract_info() is called for each line
+    qstat_pattern = None
+
     def extract_info(self, qstat_line):
         raise RuntimeError("Method not implemented!")
 
@@ -126,27 +131,36 @@ class BSSBase(object):
 
     __ustates = ["COMPLETED", "QUEUED", "SUSPENDED", "RUNNING"]
 
+    # if a job is listed more than once, the state with the higher rank wins
+    __ranks = dict([(ustate, rank) for (rank, ustate) in enumerate(__ustates)])
+
     def parse_status_listing(self, qstat_result):
         """ Does the actual parsing of the status listing. """
         states = {}
+        ranks = self.__ranks
+        pattern = self.qstat_pattern
         for line in qstat_result.splitlines():
-            (bssid, state, queue_name) = self.extract_info(str(line))
-            if bssid is None:
-                continue
-            ustate = self.convert_status(state)
-            if states.get(bssid, None) is None:
-                states[bssid]=(ustate,queue_name)
+            if pattern is not None:
+                m = pattern.match(line)
+                if m is None:
+                    continue
+                (bssid, state, queue_name) = m.group("bssid", "state",
+                                                     "queue")
             else:
-                have_state,_ = states[bssid]
-                if self.__ustates.index(ustate)>self.__ustates.index(have_state):
-                    states[bssid]=(ustate,queue_name)
- 
+                (bssid, state, queue_name) = self.extract_info(line)
+                if bssid is None:
+                    continue
+            ustate = self.convert_status(state)
+            have = states.get(bssid)
+            if have is None or ranks.get(ustate, -1) > ranks.get(have[0], -1):
+                states[bssid] = (ustate, queue_name)
+
         # generate reply to UNICORE/X
-        result = "QSTAT\n"
+        result = ["QSTAT\n"]
         for bssid in states:
-            ustate, queue_name = states[bssid]
-            result += " %s %s %s\n" % (bssid, ustate, queue_name)
-        return result
+            (ustate, queue_name) = states[bssid]
+            result.append(" %s %s %s\n" % (bssid, ustate, queue_name))
+        return "".join(result)
 
     def get_status_listing(self, message, connector, config, LOG):
         """ Get info about all the batch jobs and parses it.
@@ -1,6 +1,7 @@
 """This module contains the user-switching logic"""
 
 import os
+import time
 import UserCache
 
 
@@ -28,10 +29,23 @@ def initialize(config, LOG):
         LOG.info("XNJS will be free to assign any groups for the Xlogin "
                  "regardless of the operating system settings.")
 
-    cache_ttl = config.get('tsi.userCacheTtl', 600)
-    user_cache = UserCache.UserCache(cache_ttl, LOG)
+    cache_ttl = int(config.get('tsi.userCacheTtl', 600))
+    shared_file = config.get('tsi.user_cache_file')
+    if shared_file is not None:
+        LOG.info("User cache shared via %s" % shared_file)
+    negative_ttl = int(config.get('tsi.userCacheNegativeTtl', 60))
+    max_stale = int(config.get('tsi.userCacheMaxStale', 3600))
+    max_entries = int(config.get('tsi.userCacheMaxEntries', 10000))
+    user_cache = UserCache.UserCache(cache_ttl, LOG, shared_file,
+                                     negative_ttl, max_stale, max_entries)
     config['tsi.user_cache'] = user_cache
 
+    prewarm_users = config.get('tsi.userCachePrewarm', '').split()
+    prewarm_groups = config.get('tsi.userCachePrewarmGroups', '').split()
+    if prewarm_users or prewarm_groups:
+        user_cache.prewarm(prewarm_users, prewarm_groups,
+                           int(config.get('tsi.userCachePrewarmThreads', 4)))
+
 
 # if requested group is the primary group or if checking is disabled return OK
 # otherwise check that this user is a member of the requested group
@@ -121,37 +135,18 @@ def get_supplementary_groups(requested_groups, primary, user, config, LOG):
     return gids
 
 
-def become_user(user, requested_groups, config, LOG):
+def resolve_identity(user, requested_groups, config, LOG):
     """
-    Change the process' identity (real and effective) to a user's (if
-    process was started with sufficient privileges to allow this,
-    does nothing otherwise)
-    Arguments:
-      user = Name of the user
-      requested_groups = list of group names
-      config - configuration
-      LOG - logger
-
-    Returns: True if successful, an error string otherwise
+    Find the uid, primary gid, list of gids and home directory
+    to use for the user and requested groups.
 
-    Side effects: modifies the ENV array, setting values for USER, LOGNAME and
-    HOME
+    Returns: a tuple (uid, gid, gids, home) if successful, an error
+    string otherwise
     """
-
-    euid = config['tsi.effective_uid']
-    setting_uids = config['tsi.switch_uid']
     user_cache = config['tsi.user_cache']
     fail_on_invalid_gids = config['tsi.fail_on_invalid_gids']
     primary = requested_groups[0]
 
-    if not setting_uids:
-        if euid == 0:
-            # make sure to prevent running things as root
-            return "Running as root and not setting uids --- this is not " \
-                   "allowed. Please check your TSI installation!"
-        else:
-            return True
-
     new_uid = user_cache.get_uid_4user(user)
 
     if new_uid == -1:
@@ -176,6 +171,53 @@ def become_user(user, requested_groups, config, LOG):
         except RuntimeError as err:
             return str(err)
 
+    return new_uid, new_gid, new_gids, user_cache.get_home_4user(user)
+
+
+def become_user(user, requested_groups, config, LOG):
+    """
+    Change the process' identity (real and effective) to a user's (if
+    process was started with sufficient privileges to allow this,
+    does nothing otherwise)
+    Arguments:
+      user = Name of the user
+      requested_groups = list of group names
+      config - configuration
+      LOG - logger
+
+    Returns: True if successful, an error string otherwise
+
+    Side effects: modifies the ENV array, setting values for USER, LOGNAME and
+    HOME
+    """
+
+    euid = config['tsi.effective_uid']
+    setting_uids = config['tsi.switch_uid']
+    user_cache = config['tsi.user_cache']
+
+    if not setting_uids:
+        if euid == 0:
+            # make sure to prevent running things as root
+            return "Running as root and not setting uids --- this is not " \
+                   "allowed. Please check your TSI installation!"
+        else:
+            return True
+
+    start = time.time()
+    identity = user_cache.get_identity(user, requested_groups)
+    if identity is None:
+        identity = resolve_identity(user, requested_groups, config, LOG)
+        if not isinstance(identity, tuple):
+            return identity
+        user_cache.put_identity(user, requested_groups, identity)
+    (new_uid, new_gid, new_gids, home) = identity
+    resolve_time = 1000 * (time.time() - start)
+    LOG.debug("Identity of %s %s resolved in %.3f ms" % (
+        user, requested_groups, resolve_time))
+    monitor = config.get('tsi.monitor')
+    if monitor is not None:
+        monitor.report("identity", duration_ms=resolve_time)
+
     # Change identity
     #
     # Impl note: yes, the primary gid will appear twice in the list, however
@@ -214,7 +256,7 @@ def become_user(user, requested_groups, config, LOG):
                "got %s" % (user, new_gids, set_groups)
 
     # set environment
-    os.environ['HOME'] = user_cache.get_home_4user(user)
+    os.environ['HOME'] = home
     os.environ['USER'] = user
     os.environ['LOGNAME'] = user
 
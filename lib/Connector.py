@@ -1,18 +1,37 @@
 """ Wrapper class around common I/O operations """
 
+import logging
+import socket
 import Utils
 
+# defaults for 'tsi.max_message_size' and 'tsi.data_buffer_size'
+MAX_MESSAGE_SIZE = 16777216
+DATA_BUFFER_SIZE = 262144
+
 
 class Connector(object):
-    def __init__(self, command, data, LOG):
+    """ Replies to the XNJS are collected in a buffer and sent with a single
+    sendall() when flush() is called, which the main loop does at the end of
+    each transaction. Handlers that need the XNJS to see a reply before the
+    transaction is complete (e.g. before using the data channel) must call
+    flush() themselves.
+    """
+
+    def __init__(self, command, data, LOG, max_message_size=MAX_MESSAGE_SIZE,
+                 buf_size=DATA_BUFFER_SIZE):
         self.data = data
         self.command = command
-        self.control_in = command.makefile("r")
-        self.control_out = command.makefile("w")
-        self.data_in = data.makefile("rb")
-        self.data_out = data.makefile("wb")
+        self.control_in = command.makefile("rb")
+        self.data_in = data.makefile("rb", buf_size)
+        self.data_out = data.makefile("wb", buf_size)
         self.LOG = LOG
-        self.buf_size = 32768
+        self.buf_size = buf_size
+        self.reply = []
+        self.reply_size = 0
+        # limit for the reply buffer, larger replies are sent in parts
+        self.max_reply_size = 1048576
+        # limit for messages read from the XNJS
+        self.max_message_size = max_message_size
 
     def failed(self, message):
         """ Write single line of TSI_FAILED and error message to control
@@ -34,24 +53,51 @@ class Connector(object):
     def read_message(self):
         """Read message terminated by ENDOFMESSAGE from control channel
            Returns unicode
+           Raises ValueError if the message is larger than max_message_size
+           (after reading and discarding the rest of it)
         """
-        message = ''
+        lines = []
+        size = 0
+        line_start = True
         while True:
-            line = self.control_in.readline()
+            # never buffer more than the limit, even for a single line
+            line = self.control_in.readline(
+                max(self.max_message_size + 1 - size, 65536))
             if len(line) == 0:
                 raise IOError("Socket closed")
-            self.LOG.debug(line)
-            if line == 'ENDOFMESSAGE\n':
+            if line_start and line == b"ENDOFMESSAGE\n":
                 break
-            message += line
-        return Utils.encode(message)
+            line_start = line.endswith(b"\n")
+            size += len(line)
+            if size <= self.max_message_size:
+                lines.append(line)
+        if size > self.max_message_size:
+            raise ValueError("Message too large (%d bytes, limit is %d)" % (
+                size, self.max_message_size))
+        message = Utils.decode(b"".join(lines))
+        if self.LOG.isEnabledFor(logging.DEBUG):
+            self.LOG.debug(message)
+        return message
 
     def write_message(self, message):
-        """ Write message to control channel and add newline """
+        """ Add message and newline to the reply buffer """
         if message is not None:
-            self.control_out.write(Utils.encode(message))
-            self.control_out.write(u"\n")
-            self.control_out.flush()
+            message = Utils.encode(message)
+            self.reply.append(message)
+            self.reply.append("\n")
+            self.reply_size += len(message) + 1
+            if self.reply_size > self.max_reply_size:
+                self.flush()
+
+    def flush(self):
+        """ Send the buffered reply to the control channel """
+        if len(self.reply) > 0:
+            reply = "".join(self.reply)
+            self.reply = []
+            self.reply_size = 0
+            if Utils.have_p3:
+                reply = reply.encode("utf-8")
+            self.command.sendall(reply)
 
     def read_data(self, maxlen):
         limit = min(maxlen, self.buf_size)
@@ -64,6 +110,23 @@ class Connector(object):
             written = len(data)
         return written
 
+    def stop_reading(self):
+        """ Shut down the reading side of the command connection, so that
+        a pending or later read_message() fails with IOError. A request
+        that was already read can still be answered.
+        """
+        try:
+            # use a plain socket, shutdown() of an SSL socket would
+            # also affect the writing side
+            sock = socket.fromfd(self.command.fileno(), socket.AF_INET,
+                                 socket.SOCK_STREAM)
+            try:
+                sock.shutdown(socket.SHUT_RD)
+            finally:
+                sock.close()
+        except EnvironmentError:
+            pass
+
     def close(self):
         try:
             self.command.close()
@@ -73,3 +136,14 @@ class Connector(object):
             self.data.close()
         except:
             pass
+
+
+def create_connector(command, data, config, LOG):
+    """ Creates the Connector for the command and data sockets, with the
+    configured message size limit and data channel buffer size
+    """
+    return Connector(command, data, LOG,
+                     int(config.get('tsi.max_message_size',
+                                    MAX_MESSAGE_SIZE)),
+                     int(config.get('tsi.data_buffer_size',
+                                    DATA_BUFFER_SIZE)))
@@ -1,7 +1,10 @@
-"""File I/O functionality: get_file_chunk(), put_file_chunk()
-   and helper functions
+"""File I/O functionality: get_file_chunk(), put_file_chunk(),
+   get_archive(), put_archive(), checksum() and helper functions
 """
 
+import bz2
+import errno
+import hashlib
 import io
 import grp
 import pwd
@@ -9,7 +12,94 @@ import re
 import os
 import os.path
 import stat
-from Utils import expand_variables, extract_parameter, run_command
+import struct
+import tarfile
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+from Utils import expand_variables, extract_parameter, have_p3, run_command
+
+
+# Codecs for compressing file chunks on the data channel, see
+# get_compression(). Each entry is a pair of functions
+# compress(data, level) and decompressor() (returning an object with
+# the zlib decompressobj interface)
+_codecs = {
+    "zlib": (zlib.compress, zlib.decompressobj),
+}
+
+
+def get_compression(message, config):
+    """ Returns the (codec, level) pair requested by the XNJS via
+           TSI_COMPRESSION - <codec>[:<level>], e.g. 'zlib' or 'zlib:1',
+                             or 'none'
+        or None if no compression is requested
+        If no level is given, 'tsi.compression_level' is used.
+    """
+    spec = extract_parameter(message, "COMPRESSION")
+    if spec is None or spec == "none":
+        return None
+    parts = spec.split(":")
+    codec = parts[0]
+    if codec not in _codecs:
+        raise ValueError("Unsupported compression: '%s', must be one of "
+                         "%s or 'none'" % (codec, sorted(_codecs.keys())))
+    if len(parts) > 1:
+        level = int(parts[1])
+    else:
+        level = int(config.get('tsi.compression_level', 6))
+    return codec, level
+
+
+def compress_chunk(data, codec, level, config):
+    """ Compresses data with the given codec and level. To avoid wasting CPU
+        time on data that does not compress well (e.g. already compressed
+        files), a sample is compressed first.
+        Returns (codec, compressed data), or ('none', data) if the
+        compression ratio is worse than 'tsi.compression_min_ratio'.
+    """
+    compress = _codecs[codec][0]
+    min_ratio = float(config.get('tsi.compression_min_ratio', 0.9))
+    sample_size = 65536
+    if len(data) > 2 * sample_size:
+        sample = bytes(data[:sample_size])
+        if len(compress(sample, 1)) > min_ratio * sample_size:
+            return "none", data
+    compressed = compress(bytes(data), level)
+    if len(compressed) > min_ratio * len(data):
+        return "none", data
+    return codec, compressed
+
+
+def get_data_extents(fd, start, end):
+    """ Returns the list of (offset, length) data extents of the open file
+        within [start, end), skipping holes. If the OS does not support
+        SEEK_DATA / SEEK_HOLE, the whole range is returned as one extent.
+    """
+    if not hasattr(os, "SEEK_DATA"):
+        return [(start, end - start)] if end > start else []
+    extents = []
+    pos = start
+    while pos < end:
+        try:
+            data_start = os.lseek(fd, pos, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # no more data up to the end of the file
+                break
+            if e.errno == errno.EINVAL:
+                return [(start, end - start)]
+            raise
+        if data_start >= end:
+            break
+        data_end = min(os.lseek(fd, data_start, os.SEEK_HOLE), end)
+        extents.append((data_start, data_end - data_start))
+        pos = data_end
+    return extents
 
 
 def get_file_chunk(message, connector, config, LOG):
@@ -18,49 +108,147 @@ def get_file_chunk(message, connector, config, LOG):
            TSI_FILE   - name of file to return
            TSI_START  - start byte
            TSI_LENGTH - how many bytes to return
+           TSI_COMPRESSION - optional compression (see get_compression())
+           TSI_SPARSE - if 'true', only the data extents of a sparse file
+                        are sent, holes are skipped
+
+       If compression is requested, the reply contains
+           TSI_LENGTH - number of bytes sent on the data channel
+           TSI_RAW_LENGTH - number of bytes read from the file
+           TSI_COMPRESSION - the codec used, which is 'none' if the data
+                             does not compress well
+
+       In sparse mode, the reply additionally contains
+           TSI_SPARSE_LENGTH - number of bytes of the file covered by this
+                               chunk (data and holes)
+           TSI_EXTENTS - comma separated list of <offset>:<length> file
+                         extents, their data is sent in this order
     """
     path = extract_parameter(message, 'FILE')
     path = expand_variables(path)
     start = int(extract_parameter(message, 'START'))
     length = int(extract_parameter(message, 'LENGTH'))
+    compression = get_compression(message, config)
+    sparse = "true" == extract_parameter(message, "SPARSE", "false")
 
     LOG.debug("Getting data from %s start at %d length %d" % (path, start,
                                                               length))
 
     with io.FileIO(path, "rb") as f:
-        if f.seekable():
-            f.seek(start)
-        buf = bytearray(length)
+        if sparse:
+            end = min(start + length, os.fstat(f.fileno()).st_size)
+            extents = get_data_extents(f.fileno(), start, end)
+        else:
+            extents = [(start, length)]
+        buf = bytearray(sum([extent[1] for extent in extents]))
+        view = memoryview(buf)
         total_bytes_read = 0
-        remaining = length
-
-        while remaining > 0:
-            read = f.readinto(buf)
-            if read == 0:
-                break
-            total_bytes_read += read
-            remaining -= read
 
-        # reply and report total bytes read
-        connector.ok("TSI_LENGTH %s\nENDOFMESSAGE" % total_bytes_read)
+        for (offset, extent_length) in extents:
+            if f.seekable():
+                f.seek(offset)
+            remaining = extent_length
+            while remaining > 0:
+                read = f.readinto(view[total_bytes_read:
+                                       total_bytes_read + remaining])
+                if read == 0:
+                    break
+                total_bytes_read += read
+                remaining -= read
+
+        data = buf
+        data_length = total_bytes_read
+        reply = []
+        if compression is not None:
+            (codec, level) = compression
+            (codec, data) = compress_chunk(buf[:total_bytes_read], codec,
+                                           level, config)
+            data_length = len(data)
+            reply.append("TSI_RAW_LENGTH %s" % total_bytes_read)
+            reply.append("TSI_COMPRESSION %s" % codec)
+            LOG.debug("Sending %d bytes (%s), raw length %d" % (
+                data_length, codec, total_bytes_read))
+        if sparse:
+            reply.append("TSI_SPARSE_LENGTH %s" % max(0, end - start))
+            reply.append("TSI_EXTENTS %s" % ",".join(
+                ["%d:%d" % extent for extent in extents]))
+
+        # reply and report total bytes to be sent
+        connector.ok("\n".join(["TSI_LENGTH %s" % data_length] + reply +
+                                ["ENDOFMESSAGE"]))
+        connector.flush()
 
         # write it out, taking care to handle partial writes
         write_offset = 0
-        must_write = total_bytes_read
+        must_write = data_length
         while must_write > 0:
-            written = connector.write_data(buf[write_offset:total_bytes_read])
+            written = connector.write_data(data[write_offset:data_length])
             if written is None:
                 break
             write_offset += written
             must_write -= written
 
 
+def _write_sparse(f, buf, block_size):
+    """ Writes buf to the file at the current position, seeking over
+        (instead of writing) blocks that contain only zeros, so they become
+        holes. Blocks are aligned to block_size with respect to the file
+        offset.
+    """
+    zero_block = bytes(bytearray(block_size))
+    pos = f.tell()
+    offset = 0
+    # start of the current run of non-zero data to be written
+    run_start = 0
+    while offset < len(buf):
+        block_end = min(offset + block_size - (pos + offset) % block_size,
+                        len(buf))
+        block = buf[offset:block_end]
+        if block == zero_block[:len(block)]:
+            _write_run(f, buf, run_start, offset)
+            f.seek(block_end - offset, os.SEEK_CUR)
+            run_start = block_end
+        offset = block_end
+    _write_run(f, buf, run_start, len(buf))
+
+
+def _write_run(f, buf, start, end):
+    """ write buf[start:end], taking care to handle partial writes """
+    while start < end:
+        written = f.write(buf[start:end])
+        start += written
+
+
+def _sync(f):
+    """ Flush file data to stable storage """
+    if hasattr(os, "fdatasync"):
+        os.fdatasync(f.fileno())
+    else:
+        os.fsync(f.fileno())
+
+
 def put_file_chunk(message, connector, config, LOG):
     """Write part of a file, reading data from the XNJS via the data_in stream.
        The message sent by the XNJS is scanned for:
            TSI_FILE   - name of file to write and mode
            TSI_FILESACTION  - what to do (overwrite = 1 , append = 3)
-           TSI_LENGTH - how many bytes to return
+           TSI_LENGTH - how many bytes to read from the data channel
+           TSI_COMPRESSION - optional compression of the data sent by the
+                             XNJS (see get_compression()). In this case
+                             the TSI replies with TSI_LENGTH and
+                             TSI_RAW_LENGTH (bytes written to the file)
+                             after the data has been written.
+           TSI_SPARSE - if 'true', blocks containing only zeros are not
+                        written but turned into holes (overwrite only)
+
+       Data is collected into blocks of 'tsi.write_buffer_size' bytes before
+       being written. In overwrite mode, the space for uncompressed,
+       non-sparse data is allocated up front if 'tsi.preallocate' is true.
+       Data is synced to disk according to 'tsi.file_sync':
+         none     - leave it to the OS (default)
+         end      - fdatasync() after all data has been written
+         periodic - fdatasync() every 'tsi.file_sync_interval' bytes and
+                    at the end
     """
     path_and_mode = extract_parameter(message, "FILE")
     mode_index = path_and_mode.rindex(" ")
@@ -73,35 +261,123 @@ def put_file_chunk(message, connector, config, LOG):
         action = "1"
 
     length = int(extract_parameter(message, "LENGTH"))
+    compression = get_compression(message, config)
+    decompressor = None
+    if compression is not None:
+        decompressor = _codecs[compression[0]][1]()
+    raw_length = 0
+
+    sync_policy = config.get('tsi.file_sync', 'none')
+    if sync_policy not in ['none', 'end', 'periodic']:
+        raise ValueError("Invalid value '%s' for 'tsi.file_sync', must be "
+                         "'none', 'end' or 'periodic'" % sync_policy)
+    sync_interval = int(config.get('tsi.file_sync_interval', 67108864))
+    write_buffer_size = int(config.get('tsi.write_buffer_size', 1048576))
+    alloc_time = write_time = sync_time = 0.0
+    unsynced = 0
 
     LOG.debug("Writing %d bytes of data to %s" % (length, path))
 
     if action == "3":
         open_mode = "ab"
+        # cannot seek in append mode
+        sparse = False
     else:
         open_mode = "wb"
+        sparse = "true" == extract_parameter(message, "SPARSE", "false")
+
+    preallocate = open_mode == "wb" and not sparse and compression is None \
+        and length > 0 and hasattr(os, "posix_fallocate") \
+        and config.get('tsi.preallocate', True)
 
     with io.FileIO(path, open_mode) as f:
+        block_size = os.fstat(f.fileno()).st_blksize
+        if preallocate:
+            t = time.time()
+            try:
+                os.posix_fallocate(f.fileno(), 0, length)
+            except OSError as e:
+                # not supported by the file system
+                LOG.debug("Could not preallocate %s: %s" % (path, str(e)))
+                preallocate = False
+            alloc_time = time.time() - t
+
         # the next message tells the XNJS to start sending data
         connector.ok("ENDOFMESSAGE")
-        remaining = length
-
-        while remaining > 0:
-            buf = connector.read_data(remaining)
-            bytes_read = len(buf)
-            remaining -= bytes_read
-
-            # write it out, taking care to handle partial writes
-            write_offset = 0
-            must_write = bytes_read
-            while must_write > 0:
-                written = f.write(buf[write_offset:bytes_read])
-                write_offset += written
-                must_write -= written
+        connector.flush()
+        chunks = _read_data(connector, length, decompressor,
+                            write_buffer_size)
+        done = length == 0
+        pending = bytearray()
+        try:
+            while not done or len(pending) > 0:
+                if not done:
+                    buf = next(chunks, None)
+                    if buf is None:
+                        done = True
+                    else:
+                        raw_length += len(buf)
+                        pending += buf
+                    if len(pending) < write_buffer_size and not done:
+                        continue
+
+                t = time.time()
+                if sparse:
+                    _write_sparse(f, pending, block_size)
+                else:
+                    _write_run(f, pending, 0, len(pending))
+                write_time += time.time() - t
+                unsynced += len(pending)
+                pending = bytearray()
+
+                if sync_policy == "periodic" and unsynced >= sync_interval:
+                    t = time.time()
+                    _sync(f)
+                    sync_time += time.time() - t
+                    unsynced = 0
+        finally:
+            if sparse or preallocate:
+                # a trailing hole needs to be created explicitly, and
+                # preallocated space must not extend the file
+                f.truncate(f.tell())
+
+        if sync_policy != "none" and unsynced > 0:
+            t = time.time()
+            _sync(f)
+            sync_time += time.time() - t
+
+    LOG.debug("Wrote %d bytes to %s: allocate %.3fs, write %.3fs, "
+              "sync %.3fs" % (raw_length, path, alloc_time, write_time,
+                              sync_time))
 
     # change mode to requested mode
     os.chmod(path, int(mode, 8))
 
+    if compression is not None:
+        connector.write_message("TSI_LENGTH %s\nTSI_RAW_LENGTH %s" % (
+            length, raw_length))
+
+
+def _read_data(connector, length, decompressor, max_length):
+    """ Yields the data read from the data channel. Decompressed data is
+        yielded in pieces of at most max_length bytes, so that a small
+        amount of compressed data cannot fill up the memory
+    """
+    remaining = length
+    while remaining > 0:
+        buf = connector.read_data(remaining)
+        if len(buf) == 0:
+            raise IOError("Data stream closed")
+        remaining -= len(buf)
+        if decompressor is None:
+            yield buf
+            continue
+        while len(buf) > 0:
+            yield decompressor.decompress(buf, max_length)
+            buf = decompressor.unconsumed_tail
+    if decompressor is not None:
+        yield decompressor.flush()
+
 
 _mode_table = (
     (stat.S_IRUSR, "r"),
@@ -279,6 +555,61 @@ def ls(message, connector, config, LOG):
     connector.write_message("END_LISTING")
 
 
+# per-process caches used by df(), keyed by file system device ID
+# (and user name for the quota values). Entries are (timestamp, value)
+_df_cache = {}
+_quota_cache = {}
+
+
+def _cached(cache, key, ttl):
+    """ Returns the cached value for key, or None if missing or expired """
+    entry = cache.get(key)
+    if entry is None or entry[0] + ttl < time.time():
+        return None
+    return entry[1]
+
+
+def get_fs_info(path, config):
+    """ Returns (device, total, free) for the file system holding path,
+        'free' being the space available to unprivileged users.
+        Results are cached per device for 'tsi.df_cache_ttl' seconds.
+    """
+    device = os.stat(path).st_dev
+    ttl = float(config.get('tsi.df_cache_ttl', 30))
+    info = _cached(_df_cache, device, ttl)
+    if info is None:
+        st = os.statvfs(path)
+        info = (st.f_frsize * st.f_blocks, st.f_frsize * st.f_bavail)
+        _df_cache[device] = (time.time(), info)
+    return (device,) + info
+
+
+def get_user_quota(path, device, config, LOG):
+    """ Returns the quota (in bytes) of the current user on the file system
+        holding path, or -1 if not available.
+        The quota is established by running the 'tsi.quota_cmd' with the
+        path as argument; the first number in its output is used.
+        Results are cached per user and device for 'tsi.quota_cache_ttl'
+        seconds.
+    """
+    quota_cmd = config.get('tsi.quota_cmd')
+    if quota_cmd is None:
+        return -1
+    key = (os.environ.get('USER'), device)
+    ttl = float(config.get('tsi.quota_cache_ttl', 300))
+    quota = _cached(_quota_cache, key, ttl)
+    if quota is None:
+        quota = -1
+        (success, result) = run_command("%s %s" % (quota_cmd, quote(path)))
+        m = re.search(r"(\d+)", result) if success else None
+        if m is not None:
+            quota = int(m.group(1))
+        else:
+            LOG.debug("Could not get user quota for %s: %s" % (path, result))
+        _quota_cache[key] = (time.time(), quota)
+    return quota
+
+
 def df(message, connector, config, LOG):
     """ determines the free space on a given partition
     and reports results on stdout in the format that the XNJS expects.
@@ -296,31 +627,390 @@ def df(message, connector, config, LOG):
     Every line is terminated by \n
     """
 
-    path = extract_parameter(message, "FILE")
-    path = expand_variables(path)
+    path = expand_variables(extract_parameter(message, "FILE"))
 
-    # TODO might want to add a cache or do not check
-    # free space for certain paths
+    try:
+        (device, total, free) = get_fs_info(path, config)
+        user = get_user_quota(path, device, config, LOG)
+    except EnvironmentError as e:
+        connector.failed("Cannot determine free space for '%s': %s"
+                         % (path, str(e)))
+        return
+    connector.write_message("START_DF")
+    connector.write_message("TOTAL %s" % total)
+    connector.write_message("FREE %s" % free)
+    connector.write_message("USER %s" % user)
+    connector.write_message("END_DF")
+
+
+class _ZlibChecksum(object):
+    """ hashlib-like wrapper around the fast zlib checksum functions """
+
+    def __init__(self, function):
+        self.function = function
+        self.value = function(b"")
+
+    def update(self, data):
+        if not have_p3:
+            # Python 2 zlib does not accept memoryviews
+            data = data.tobytes()
+        self.value = self.function(data, self.value)
+
+    def hexdigest(self):
+        return "%08x" % (self.value & 0xffffffff)
+
+
+_checksum_algorithms = {
+    "MD5": hashlib.md5,
+    "SHA1": hashlib.sha1,
+    "SHA256": hashlib.sha256,
+    "SHA512": hashlib.sha512,
+    "ADLER32": lambda: _ZlibChecksum(zlib.adler32),
+    "CRC32": lambda: _ZlibChecksum(zlib.crc32),
+}
+
+# checksums of unchanged files, keyed by
+# (path, device, inode, size, mtime, algorithm, start, length)
+_checksum_cache = {}
+_checksum_cache_max_entries = 10000
+
+
+def compute_checksum(path, algorithm, start=0, length=-1,
+                     block_size=1048576):
+    """ Computes the checksum of a file (or of 'length' bytes starting at
+        'start'), reading in blocks aligned to block_size.
+        The result is cached as long as the file does not change.
+        Returns the checksum as hex string.
+    """
+    with io.FileIO(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        key = (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime,
+               algorithm, start, length)
+        digest = _checksum_cache.get(key)
+        if digest is not None:
+            return digest
+
+        h = _checksum_algorithms[algorithm]()
+        buf = bytearray(block_size)
+        view = memoryview(buf)
+        if start > 0:
+            f.seek(start)
+        remaining = length if length >= 0 else st.st_size - start
+        # first read up to the next block boundary, aligned reads after that
+        want = block_size - (start % block_size)
+        while remaining > 0:
+            read = f.readinto(view[:min(want, remaining)])
+            if not read:
+                break
+            h.update(view[:read])
+            remaining -= read
+            want = block_size
+        digest = h.hexdigest()
+
+    if len(_checksum_cache) >= _checksum_cache_max_entries:
+        _checksum_cache.clear()
+    _checksum_cache[key] = digest
+    return digest
+
+
+def checksum(message, connector, config, LOG):
+    """ Computes checksums of one or more files.
+        The message sent by the XNJS is scanned for:
+           TSI_FILE      - name of file (can be given multiple times)
+           TSI_CHECKSUM_ALGORITHM - MD5, SHA1, SHA256 (default), SHA512,
+                           or the fast non-cryptographic ADLER32 and CRC32
+           TSI_START     - start byte (optional)
+           TSI_LENGTH    - how many bytes to use (optional, default: all)
+
+       The TSI replies with TSI_OK and one line '<checksum> <file>'
+       per requested file, in the order they were given.
+       Multiple files are processed in parallel using a pool of
+       'tsi.checksum_threads' threads.
+    """
+    paths = [expand_variables(p) for p in
+             re.findall(r"^#TSI_FILE (.+)\n", message, re.M)]
+    algorithm = extract_parameter(message, "CHECKSUM_ALGORITHM", "SHA256")
+    algorithm = algorithm.upper().replace("-", "")
+    start = int(extract_parameter(message, "START", "0"))
+    length = int(extract_parameter(message, "LENGTH", "-1"))
+    block_size = int(config.get('tsi.checksum_block_size', 1048576))
+
+    if len(paths) == 0:
+        connector.failed("No file(s) given")
+        return
+    if algorithm not in _checksum_algorithms:
+        connector.failed("Unsupported checksum algorithm: '%s'" % algorithm)
+        return
 
-    command = "df -P -B 1 %s" % path
-    (success, result) = run_command(command)
-    total = free = user = '-1'
+    LOG.debug("Computing %s checksum of %s" % (algorithm, paths))
 
-    if success:
+    def compute(path):
         try:
-            for line in result.splitlines():
-                m = re.match(r"(\S+)\s+(\d+)\s+(\d+)\s+(\d+).+", line)
-                if m is not None:
-                    total = m.group(2)
-                    free = m.group(4)
-        except:
-            connector.failed("Wrong or unexpected output from 'df' "
-                             "command: %s" % result)
-            return
-        connector.write_message("START_DF")
-        connector.write_message("TOTAL %s" % total)
-        connector.write_message("FREE %s" % free)
-        connector.write_message("USER %s" % user)
-        connector.write_message("END_DF")
+            return True, compute_checksum(path, algorithm, start, length,
+                                          block_size)
+        except EnvironmentError as e:
+            return False, "%s: %s" % (path, e.strerror)
+
+    num_threads = min(len(paths), int(config.get('tsi.checksum_threads', 4)))
+    if num_threads > 1:
+        pool = ThreadPool(num_threads)
+        try:
+            results = pool.map(compute, paths)
+        finally:
+            pool.close()
+            pool.join()
     else:
-        connector.failed(result)
+        results = [compute(path) for path in paths]
+
+    errors = [result for (success, result) in results if not success]
+    if errors:
+        connector.failed("Error computing checksum: " + ", ".join(errors))
+        return
+    connector.ok("\n".join(["%s %s" % (result, path) for
+                             ((_, result), path) in zip(results, paths)]))
+
+
+#
+# Archive streaming
+#
+# Archives are sent over the data channel as a sequence of frames, each
+# consisting of an 8 byte (network byte order) length followed by that
+# many bytes of data. A frame of length zero marks the end of the stream.
+#
+
+_frame_header = struct.Struct("!Q")
+
+
+def _write_fully(connector, data):
+    """ Write all of data to the data channel, handling partial writes """
+    write_offset = 0
+    must_write = len(data)
+    while must_write > 0:
+        written = connector.write_data(data[write_offset:])
+        if written is None:
+            break
+        write_offset += written
+        must_write -= written
+
+
+def _read_fully(connector, length):
+    """ Read exactly length bytes from the data channel """
+    buf = bytearray()
+    while len(buf) < length:
+        data = connector.read_data(length - len(buf))
+        if len(data) == 0:
+            raise IOError("Data stream closed")
+        buf += data
+    return bytes(buf)
+
+
+class FramedWriter(object):
+    """ File-like object writing framed data to the data channel.
+        Data is collected up to the connector's buffer size before
+        being sent, optionally passing through a compressor object
+        (zlib / bz2 compressor interface).
+    """
+
+    def __init__(self, connector, compressor=None):
+        self.connector = connector
+        self.compressor = compressor
+        self.buf = bytearray()
+        self.total = 0
+
+    def write(self, data):
+        length = len(data)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.buf += data
+        if len(self.buf) >= self.connector.buf_size:
+            self._send_frame()
+        return length
+
+    def _send_frame(self):
+        if len(self.buf) > 0:
+            _write_fully(self.connector, _frame_header.pack(len(self.buf)))
+            _write_fully(self.connector, self.buf)
+            self.total += len(self.buf)
+            self.buf = bytearray()
+
+    def close(self):
+        """ Send remaining data and the end-of-stream marker """
+        if self.compressor is not None:
+            self.buf += self.compressor.flush()
+            self.compressor = None
+        self._send_frame()
+        _write_fully(self.connector, _frame_header.pack(0))
+
+
+class FramedReader(object):
+    """ File-like object reading framed data from the data channel """
+
+    def __init__(self, connector):
+        self.connector = connector
+        self.remaining = 0
+        self.eof = False
+        self.total = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.connector.buf_size
+        while self.remaining == 0 and not self.eof:
+            header = _read_fully(self.connector, _frame_header.size)
+            self.remaining = _frame_header.unpack(header)[0]
+            self.eof = self.remaining == 0
+        if self.eof or size == 0:
+            return b""
+        data = self.connector.read_data(min(size, self.remaining))
+        if len(data) == 0:
+            raise IOError("Data stream closed")
+        self.remaining -= len(data)
+        self.total += len(data)
+        return data
+
+    def drain(self):
+        """ Skip remaining data up to the end-of-stream marker """
+        while len(self.read()) > 0:
+            pass
+
+
+def _get_compressor(compression, level):
+    if compression == "gz":
+        # gzip format
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif compression == "bz2":
+        return bz2.BZ2Compressor(level)
+    elif compression == "none":
+        return None
+    raise ValueError("Unsupported archive compression: '%s', must be one of "
+                     "'none', 'gz' or 'bz2'" % compression)
+
+
+def get_archive(message, connector, config, LOG):
+    """ Streams a tar archive of one or more files or directories (which are
+        added recursively) to the XNJS via the data_out stream.
+        The message sent by the XNJS is scanned for:
+           TSI_FILE     - file or directory to add (can be given multiple
+                          times)
+           TSI_ARCHIVE_BASE - directory which archive entry names are
+                          relative to (optional, by default the entries are
+                          named by the last path element)
+           TSI_ARCHIVE_COMPRESSION - 'none' (default), 'gz' or 'bz2'
+
+       The TSI replies with TSI_OK and ENDOFMESSAGE and then writes the
+       archive as a sequence of frames (see FramedWriter) to the data
+       channel, followed by a line 'TSI_LENGTH <n>' with the number of
+       (compressed) bytes sent.
+    """
+    paths = [expand_variables(p) for p in
+             re.findall(r"^#TSI_FILE (.+)\n", message, re.M)]
+    base = extract_parameter(message, "ARCHIVE_BASE")
+    if base is not None:
+        base = expand_variables(base)
+    compression = extract_parameter(message, "ARCHIVE_COMPRESSION", "none")
+    level = int(config.get('tsi.archive_compression_level', 6))
+
+    if len(paths) == 0:
+        connector.failed("No file(s) given")
+        return
+    compressor = _get_compressor(compression, level)
+    for path in paths:
+        if not os.path.exists(path):
+            connector.failed("File not found: %s" % path)
+            return
+
+    LOG.debug("Sending archive of %s (compression: %s)" % (paths,
+                                                            compression))
+    connector.ok("ENDOFMESSAGE")
+    connector.flush()
+    writer = FramedWriter(connector, compressor)
+    try:
+        tar = tarfile.open(fileobj=writer, mode="w|",
+                           bufsize=connector.buf_size)
+        try:
+            for path in paths:
+                if base is not None:
+                    name = os.path.relpath(path, base)
+                else:
+                    name = os.path.basename(os.path.normpath(path))
+                tar.add(path, arcname=name)
+        finally:
+            tar.close()
+    finally:
+        # always terminate the stream so the XNJS does not hang
+        writer.close()
+    connector.write_message("TSI_LENGTH %s" % writer.total)
+
+
+def _is_within(path, directory):
+    path = os.path.realpath(path)
+    return path == directory or path.startswith(directory + os.sep)
+
+
+def _is_safe_member(member, target):
+    """ Checks that an archive entry cannot be written outside of the
+        target directory (given as real path), and is a regular file,
+        directory or link. Symbolic links already extracted into the
+        target directory are resolved, so that chains of links cannot
+        point outside of it either.
+    """
+    if not (member.isfile() or member.isdir() or member.issym()
+            or member.islnk()):
+        return False
+    name = os.path.normpath(member.name)
+    if os.path.isabs(name) or name == ".." or name.startswith("../"):
+        return False
+    path = os.path.join(target, name)
+    if not _is_within(path, target):
+        return False
+    if member.issym():
+        return _is_within(os.path.join(os.path.dirname(path),
+                                       member.linkname), target)
+    if member.islnk():
+        return not os.path.isabs(member.linkname) and _is_within(
+            os.path.join(target, member.linkname), target)
+    return True
+
+
+def put_archive(message, connector, config, LOG):
+    """ Unpacks a tar archive (optionally compressed with gzip or bzip2)
+        read from the XNJS via the data_in stream into a directory.
+        The message sent by the XNJS is scanned for:
+           TSI_FILE     - target directory (created if it does not exist)
+
+       The TSI replies with TSI_OK and ENDOFMESSAGE, and then expects the
+       archive as a sequence of frames (see FramedReader) on the data
+       channel. Entries that would end up outside the target directory,
+       as well as device files and FIFOs, are skipped and reported as
+       an error after the archive has been read.
+    """
+    target = expand_variables(extract_parameter(message, "FILE"))
+
+    LOG.debug("Unpacking archive into %s" % target)
+    if not os.path.isdir(target):
+        os.makedirs(target)
+
+    connector.ok("ENDOFMESSAGE")
+    connector.flush()
+    reader = FramedReader(connector)
+    skipped = []
+    try:
+        tar = tarfile.open(fileobj=reader, mode="r|*",
+                           bufsize=connector.buf_size)
+        if hasattr(tarfile, "data_filter"):
+            tar.extraction_filter = tarfile.data_filter
+        try:
+            real_target = os.path.realpath(target)
+            for member in tar:
+                if _is_safe_member(member, real_target):
+                    tar.extract(member, target)
+                else:
+                    skipped.append(member.name)
+        finally:
+            tar.close()
+    finally:
+        # keep the data channel in sync even in case of errors
+        reader.drain()
+
+    if len(skipped) > 0:
+        connector.failed("Skipped unsafe archive entries: %s" %
+                         ", ".join(skipped))
@@ -0,0 +1,395 @@
+"""
+Live statistics about the TSI shepherd and its workers.
+
+The shepherd collects
+ - the list of workers with their current command and user
+ - per-command latency histograms reported by the workers
+ - timings of the accept-to-fork path and of the connection setup
+   (SSL handshake, callback to the XNJS) done by the workers
+ - the time needed to resolve the user's identity (uid, groups)
+
+Workers report events to the shepherd as JSON datagrams via a socket
+pair created before forking. Workers also report the fingerprints of
+XNJS certificates they verified against the ACL, so that workers forked
+later can skip the check.
+
+If 'tsi.control_socket' is set, the shepherd listens on a UNIX domain
+socket with that path. A client connecting to it sends a single line
+with the request ('status' is the only one supported) and receives the
+statistics as JSON.
+
+Usage
+
+  'export PYTHONPATH=lib; python lib/Monitor.py conf/tsi.properties'
+
+will query a running TSI and print the statistics.
+"""
+
+import bisect
+import errno
+import fcntl
+import json
+import os
+import re
+import socket
+import stat
+import sys
+import time
+from SSL import add_verified
+
+
+class Histogram(object):
+    """ Latency histogram with fixed bucket bounds (in milliseconds) """
+
+    bounds = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+              10000, 30000, 60000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, millis):
+        self.counts[bisect.bisect_left(self.bounds, millis)] += 1
+        self.count += 1
+        self.total += millis
+        self.max = max(self.max, millis)
+
+    def to_dict(self):
+        buckets = {}
+        for (bound, count) in zip(self.bounds, self.counts):
+            if count > 0:
+                buckets["<=%d" % bound] = count
+        if self.counts[-1] > 0:
+            buckets[">%d" % self.bounds[-1]] = self.counts[-1]
+        return {"count": self.count,
+                "mean_ms": round(self.total / max(1, self.count), 3),
+                "max_ms": round(self.max, 3),
+                "buckets": buckets}
+
+
+def _set_cloexec(sock):
+    """ make sure the socket is not inherited by user processes """
+    flags = fcntl.fcntl(sock.fileno(), fcntl.F_GETFD)
+    fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+class Monitor(object):
+    """ Collects statistics in the shepherd, and reports events from
+    the workers. After fork, the worker process must call
+    worker_started().
+    """
+
+    # seconds a control client may take to send its request and
+    # read the reply
+    client_timeout = 2
+
+    def __init__(self, config, LOG):
+        self.LOG = LOG
+        self.started = time.time()
+        self.workers = {}
+        self.histograms = {}
+        (self.events_in, self.events_out) = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_DGRAM)
+        _set_cloexec(self.events_in)
+        _set_cloexec(self.events_out)
+        # reporting must never block, it is also done in signal handlers
+        self.events_out.setblocking(False)
+        self.control = None
+        # connected control clients, with the request read so far
+        self.clients = {}
+        # control clients with the part of their reply not yet sent
+        self.replies = {}
+        # when the control clients connected
+        self.connected = {}
+        self.control_path = path = config.get('tsi.control_socket')
+        if path is not None:
+            if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+            self.control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.control.bind(path)
+            os.chmod(path, 0o600)
+            self.control.listen(5)
+            _set_cloexec(self.control)
+            LOG.info("Control socket listening on %s" % path)
+
+    #
+    # shepherd side
+    #
+
+    def sockets(self):
+        """ Sockets the shepherd must handle via handle() when readable """
+        result = [self.events_in]
+        if self.control is not None:
+            result.append(self.control)
+        result.extend(self.clients)
+        return result
+
+    def writers(self):
+        """ Sockets the shepherd must handle via handle() when writable """
+        return list(self.replies)
+
+    def timeout(self):
+        """ Maximum time (in seconds) the shepherd may wait before calling
+        expire(), or None if there are no control clients
+        """
+        if len(self.connected) > 0:
+            return 0.5
+        return None
+
+    def handle(self, sock):
+        if sock is self.events_in:
+            self._read_event()
+        elif sock is self.control:
+            self._accept_control()
+        elif sock in self.clients:
+            self._read_control(sock)
+        elif sock in self.replies:
+            self._send_reply(sock)
+
+    def expire(self):
+        """ Drop control clients that did not send their request or did
+        not read the reply within client_timeout seconds
+        """
+        deadline = time.time() - self.client_timeout
+        for (client, connected) in list(self.connected.items()):
+            if connected < deadline:
+                self.LOG.debug("Control client timed out")
+                self._close_client(client)
+
+    def close(self):
+        """ Close all sockets and remove the control socket file """
+        for sock in self.sockets() + self.writers() + [self.events_out]:
+            sock.close()
+        self.clients = {}
+        self.replies = {}
+        self.connected = {}
+        if self.control is not None:
+            self.control = None
+            try:
+                os.unlink(self.control_path)
+            except OSError:
+                pass
+
+    def record(self, name, millis):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = Histogram()
+            self.histograms[name] = histogram
+        histogram.add(millis)
+
+    def worker_forked(self, pid, worker_id, xnjs_host):
+        self.workers[pid] = {"id": worker_id, "host": xnjs_host,
+                             "started": time.time(), "command": None,
+                             "user": None, "since": None, "requests": 0}
+
+    def worker_exited(self, pid):
+        self.workers.pop(pid, None)
+
+    def _read_event(self):
+        try:
+            event = json.loads(self.events_in.recv(65536).decode("utf-8"))
+        except (EnvironmentError, ValueError) as e:
+            self.LOG.debug("Invalid event from worker: %s" % str(e))
+            return
+        worker = self.workers.get(event.get("pid"))
+        kind = event.get("event")
+        if kind == "setup":
+            self.record("handshake", event["handshake_ms"])
+            self.record("setup", event["setup_ms"])
+        elif kind == "begin" and worker is not None:
+            worker["command"] = event["command"]
+            worker["user"] = event["user"]
+            worker["since"] = event["time"]
+        elif kind == "verified":
+            add_verified(event["fingerprint"])
+        elif kind == "identity":
+            self.record("identity", event["duration_ms"])
+        elif kind == "end":
+            self.record("command:" + event["command"], event["duration_ms"])
+            if worker is not None:
+                worker["command"] = None
+                worker["since"] = None
+                worker["requests"] += 1
+
+    def status(self):
+        """ Returns the current statistics as a dictionary """
+        now = time.time()
+        workers = []
+        for pid in sorted(self.workers):
+            worker = self.workers.get(pid)
+            if worker is None:
+                # exited in the meantime
+                continue
+            worker = dict(worker)
+            worker["pid"] = pid
+            worker["uptime_s"] = round(now - worker.pop("started"), 1)
+            since = worker.pop("since")
+            if since is not None:
+                worker["busy_s"] = round(now - since, 3)
+            workers.append(worker)
+        return {"pid": os.getpid(),
+                "uptime_s": round(now - self.started, 1),
+                "workers": workers,
+                "latency": dict([(name, h.to_dict()) for (name, h) in
+                                 self.histograms.items()])}
+
+    def _accept_control(self):
+        """ Accept a control client. Its request is read and the reply
+        is sent without blocking the shepherd
+        """
+        try:
+            (client, _) = self.control.accept()
+        except EnvironmentError:
+            return
+        _set_cloexec(client)
+        client.setblocking(False)
+        self.clients[client] = b""
+        self.connected[client] = time.time()
+
+    def _read_control(self, client):
+        """ Read (part of) a request line, and reply once it is complete """
+        try:
+            chunk = client.recv(1024)
+        except EnvironmentError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.LOG.debug("Error reading control request: %s" % str(e))
+            self._close_client(client)
+            return
+        request = self.clients[client] + chunk
+        if len(chunk) > 0 and b"\n" not in request and len(request) < 1024:
+            self.clients[client] = request
+            return
+        del self.clients[client]
+        request = request.decode("utf-8", "replace").strip()
+        if request in ("", "status"):
+            reply = self.status()
+        else:
+            reply = {"error": "Unknown request '%s'" % request}
+        self.replies[client] = json.dumps(reply).encode("utf-8")
+        self._send_reply(client)
+
+    def _send_reply(self, client):
+        """ Send as much of the reply as possible, the rest is sent
+        when the client is writable again
+        """
+        reply = self.replies[client]
+        try:
+            reply = reply[client.send(reply):]
+        except EnvironmentError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.LOG.debug("Error serving control request: %s" % str(e))
+            reply = b""
+        if len(reply) > 0:
+            self.replies[client] = reply
+        else:
+            self._close_client(client)
+
+    def _close_client(self, client):
+        self.clients.pop(client, None)
+        self.replies.pop(client, None)
+        self.connected.pop(client, None)
+        client.close()
+
+    #
+    # worker side
+    #
+
+    def worker_started(self):
+        """ Called in the forked worker: closes the shepherd's sockets """
+        self.events_in.close()
+        if self.control is not None:
+            self.control.close()
+            self.control = None
+        # the control clients must see EOF when the shepherd closes them
+        for client in list(self.connected):
+            client.close()
+        self.clients = {}
+        self.replies = {}
+        self.connected = {}
+        self.histograms = {}
+        self.workers = {}
+
+    def report(self, event, **values):
+        """ Send an event to the shepherd (best effort, never blocks) """
+        values["event"] = event
+        values["pid"] = os.getpid()
+        values["time"] = time.time()
+        try:
+            self.events_out.send(json.dumps(values).encode("utf-8"))
+        except EnvironmentError:
+            pass
+
+
+def query(path, request="status"):
+    """ Query the control socket, returns the reply as dictionary """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+        client.sendall((request + "\n").encode("utf-8"))
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if len(chunk) == 0:
+                break
+            chunks.append(chunk)
+    finally:
+        client.close()
+    return json.loads(b"".join(chunks).decode("utf-8"))
+
+
+def print_status(status):
+    print("TSI shepherd PID %s, up %ss" % (status["pid"], status["uptime_s"]))
+    print("")
+    print("Workers: %d" % len(status["workers"]))
+    print("%8s %6s %-16s %8s %-24s %-12s %8s" % (
+        "PID", "ID", "XNJS", "REQS", "COMMAND", "USER", "BUSY(s)"))
+    for w in status["workers"]:
+        print("%8s %6s %-16s %8s %-24s %-12s %8s" % (
+            w["pid"], w["id"], w["host"], w["requests"],
+            w["command"] or "-", w["user"] or "-", w.get("busy_s", "-")))
+    print("")
+    print("Latencies (ms):")
+    print("%-32s %8s %10s %10s  %s" % ("NAME", "COUNT", "MEAN", "MAX",
+                                       "BUCKETS"))
+    for name in sorted(status["latency"]):
+        h = status["latency"][name]
+        buckets = " ".join(["%s:%s" % (b, h["buckets"][b]) for b in
+                            sorted(h["buckets"], key=_bucket_order)])
+        print("%-32s %8s %10s %10s  %s" % (name, h["count"], h["mean_ms"],
+                                           h["max_ms"], buckets))
+
+
+def _bucket_order(bucket):
+    return int(bucket.lstrip("<=>")) + (1 if bucket.startswith(">") else 0)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    if len(argv) < 2:
+        print("Usage: Monitor.py <tsi.properties> [--json]")
+        return 1
+    path = None
+    with open(argv[1]) as f:
+        for line in f:
+            m = re.match(r"\s*tsi\.control_socket=(\S+)\s*", line)
+            if m:
+                path = m.group(1)
+    if path is None:
+        print("'tsi.control_socket' is not set in %s" % argv[1])
+        return 1
+    status = query(path)
+    if "--json" in argv:
+        print(json.dumps(status, indent=2, sort_keys=True))
+    else:
+        print_status(status)
+    return 0
+
+
+# application entry point
+if __name__ == "__main__":
+    sys.exit(main())
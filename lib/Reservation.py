@@ -1,28 +1,407 @@
 """
-Reservation (dummy module)
+Reservations for Nuvla: warm pools of provisioned deployments
 
-Check the manual for advice on how to create a custom version.
+Starting a Nuvla deployment takes minutes (initializing, provisioning).
+To avoid this on job submission, the TSI keeps pools of deployments
+that are already provisioned and wait for their input. The application
+must wait for the job parameters (e.g. 'userspace-endpoint', the S3
+location of the job's files) that are set when a TSI_SUBMIT claims the
+deployment. Deployments are interchangeable if they belong to the same
+Nuvla user, and have the same application URI and Nuvla parameters,
+so there is one pool for each of these.
+
+The size of a pool is the sum of
+ - 'tsi.nuvla_pool_size': the number of deployments kept ready for
+   each application a user has submitted jobs for (default: 0)
+ - the sizes of the user's reservations for the application
+
+Pools are refilled after a job was submitted, and when a reservation
+is made, using the Nuvla credentials of the request. The unclaimed
+deployments and the reservations are stored in the SQLite database
+'tsi.nuvla_pool_file', shared by all TSI processes. If it is not set,
+no pools are kept and reservations are not supported.
+
+TSI_MAKE_RESERVATION
+ #TSI_CREDENTIALS <Nuvla token>
+ #TSI_RESERVATION_APPLICATION <application URI>
+ #TSI_RESERVATION_SIZE <number of deployments> (default: 1, at most
+  'tsi.nuvla_max_reservation_size')
+ NUVLA__... parameters of the deployments as for TSI_SUBMIT
+ Reply: the reservation ID
+
+TSI_QUERY_RESERVATION
+ #TSI_CREDENTIALS <Nuvla token>
+ #TSI_RESERVATION_REFERENCE <reservation ID>
+ Reply: 'READY' if as many deployments as reserved are ready,
+ 'WAITING' otherwise, and a description on the next line
+
+TSI_CANCEL_RESERVATION
+ #TSI_CREDENTIALS <Nuvla token>
+ #TSI_RESERVATION_REFERENCE <reservation ID>
+ Unclaimed deployments exceeding the new size of the pool are terminated.
 """
 
+import json
+import os
+import pwd
+import sqlite3
+import time
+import uuid
+from abc import ABCMeta
+from abc import abstractmethod
+
+import Utils
+from Store import Store
+
+# Nuvla states of deployments that are being started
+STARTING_STATES = ("initializing", "provisioning")
+
+# Nuvla state of provisioned deployments waiting for their input
+READY_STATE = "executing"
+
 
 def get_variant():
-    return "dummy"
+    return "nuvla"
 
 
 def init(config, LOG):
     pass
 
 
+class NuvlaClient(object):
+    """ The Nuvla operations used for the pools of a Nuvla user """
+
+    __metaclass__ = ABCMeta
+
+    username = None
+
+    @abstractmethod
+    def deploy(self, app, parameters):
+        """ Starts a deployment, returns its ID """
+
+    @abstractmethod
+    def get_state(self, duid):
+        """ Returns the Nuvla state of the deployment """
+
+    @abstractmethod
+    def set_parameter(self, duid, name, value):
+        """ Sets a runtime parameter ('<node>.<index>:<name>') """
+
+    @abstractmethod
+    def terminate(self, duid):
+        """ Terminates the deployment """
+
+
+class SlipStreamClient(NuvlaClient):
+    """ Nuvla operations via the SlipStream API """
+
+    def __init__(self, api):
+        self.api = api
+        self.username = api.username
+
+    def deploy(self, app, parameters):
+        # use default cloud for all nodes
+        return str(self.api.deploy(app, cloud={}, parameters=parameters,
+                                   keep_running='never'))
+
+    def get_state(self, duid):
+        return self.api.get_deployment_parameter(duid, 'ss:state',
+                                                 ignore_abort=True)
+
+    def set_parameter(self, duid, name, value):
+        self.api.set_deployment_parameter(duid, name, value)
+
+    def terminate(self, duid):
+        self.api.terminate(duid)
+
+
+def nuvla_request(message):
+    """ Returns the NuvlaClient for the credentials and the Nuvla
+        parameters given in the message
+    """
+    from BSS import BSS
+    return SlipStreamClient(BSS.nuvla(message)), \
+        BSS._nuvla_parameter_dict(message)
+
+
+class PoolStore(Store):
+    """
+    The unclaimed deployments of all pools, and the reservations.
+    Deployments are claimed by removing them, so each one is claimed
+    by one TSI process only.
+    """
+
+    description = "Nuvla pool store"
+
+    tables = ["CREATE TABLE IF NOT EXISTS deployments (duid TEXT PRIMARY "
+              "KEY, pool TEXT, state TEXT, created REAL)",
+              "CREATE TABLE IF NOT EXISTS reservations (id TEXT PRIMARY KEY, "
+              "pool TEXT, size INTEGER, created REAL)"]
+
+    def _db(self):
+        db = self.connection()
+        if db is None:
+            raise EnvironmentError("Cannot use %s %s" % (self.description,
+                                                         self.path))
+        return db
+
+    def deployments(self, pool):
+        """ returns the list of (duid, state), oldest first """
+        return self._db().execute("SELECT duid, state FROM deployments WHERE "
+                                  "pool=? ORDER BY created",
+                                  (pool,)).fetchall()
+
+    def add_deployment(self, duid, pool, state):
+        with self._db() as db:
+            db.execute("INSERT INTO deployments VALUES (?,?,?,?)",
+                       (duid, pool, state, time.time()))
+
+    def set_state(self, duid, state):
+        with self._db() as db:
+            db.execute("UPDATE deployments SET state=? WHERE duid=?",
+                       (state, duid))
+
+    def remove_deployment(self, duid):
+        """ returns False if the deployment was removed by someone else """
+        with self._db() as db:
+            return db.execute("DELETE FROM deployments WHERE duid=?",
+                              (duid,)).rowcount == 1
+
+    def get_reservation(self, reservation_id):
+        """ returns (pool, size) or None """
+        return self._db().execute("SELECT pool, size FROM reservations WHERE "
+                                  "id=?", (reservation_id,)).fetchone()
+
+    def add_reservation(self, reservation_id, pool, size):
+        with self._db() as db:
+            db.execute("INSERT INTO reservations VALUES (?,?,?,?)",
+                       (reservation_id, pool, size, time.time()))
+
+    def remove_reservation(self, reservation_id):
+        with self._db() as db:
+            db.execute("DELETE FROM reservations WHERE id=?",
+                       (reservation_id,))
+
+    def reserved(self, pool):
+        """ returns the number of deployments reserved in the pool """
+        row = self._db().execute("SELECT SUM(size) FROM reservations WHERE "
+                                 "pool=?", (pool,)).fetchone()
+        return row[0] or 0
+
+
+def get_store(config, LOG):
+    """ Returns the PoolStore, or None if pools are not configured.
+        A '%s' in 'tsi.nuvla_pool_file' is replaced by the user name.
+        The stores are kept, so that their connections are reused.
+    """
+    path = config.get('tsi.nuvla_pool_file')
+    if path is None:
+        return None
+    if "%s" in path:
+        path = path % pwd.getpwuid(os.geteuid()).pw_name
+    stores = config.get('tsi.nuvla_pool_stores')
+    if stores is None:
+        stores = {}
+        config['tsi.nuvla_pool_stores'] = stores
+    store = stores.get(path)
+    if store is None:
+        store = PoolStore(path, LOG)
+        if store.connection() is not None:
+            stores[path] = store
+    return store
+
+
+def pool_key(owner, app, parameters):
+    return json.dumps([owner, app, parameters], sort_keys=True)
+
+
+def refresh(store, client, pool, LOG):
+    """ Updates the state of the deployments that are being started,
+        and removes the ones that failed
+    """
+    for (duid, state) in store.deployments(pool):
+        if state == READY_STATE:
+            continue
+        try:
+            new_state = client.get_state(duid).lower()
+        except Exception as e:
+            LOG.warning("Cannot get state of deployment %s: %s" % (duid, e))
+            continue
+        if new_state == state:
+            continue
+        if new_state in STARTING_STATES or new_state == READY_STATE:
+            store.set_state(duid, new_state)
+        else:
+            LOG.info("Removing deployment %s in state '%s' from the pool" % (
+                duid, new_state))
+            store.remove_deployment(duid)
+
+
+def claim(store, client, pool, job_parameters, LOG):
+    """ Claims a ready deployment of the pool and sets the job
+        parameters. Returns the deployment ID, or None if no
+        deployment is ready
+    """
+    refresh(store, client, pool, LOG)
+    for (duid, state) in store.deployments(pool):
+        if state != READY_STATE or not store.remove_deployment(duid):
+            continue
+        try:
+            if client.get_state(duid).lower() != READY_STATE:
+                LOG.info("Deployment %s is no longer ready" % duid)
+                continue
+            for (name, value) in job_parameters.items():
+                client.set_parameter(duid, name, value)
+        except Exception as e:
+            LOG.warning("Cannot use deployment %s: %s" % (duid, e))
+            _terminate(client, duid, LOG)
+            continue
+        LOG.info("Claimed deployment %s from the pool" % duid)
+        return duid
+    return None
+
+
+def resize(store, client, pool, config, LOG):
+    """ Starts or terminates deployments, so that the pool has the
+        configured size plus the reserved number of deployments
+    """
+    (_, app, parameters) = json.loads(pool)
+    size = int(config.get('tsi.nuvla_pool_size', 0)) + store.reserved(pool)
+    deployments = store.deployments(pool)
+    for _ in range(len(deployments), size):
+        duid = str(client.deploy(app, parameters))
+        store.add_deployment(duid, pool, STARTING_STATES[0])
+        LOG.info("Started deployment %s for the pool" % duid)
+    # terminate deployments that are not ready yet first
+    surplus = sorted(deployments, key=lambda d: d[1] == READY_STATE)
+    for (duid, _) in surplus[:max(0, len(deployments) - size)]:
+        if store.remove_deployment(duid):
+            _terminate(client, duid, LOG)
+
+
+def _terminate(client, duid, LOG):
+    try:
+        client.terminate(duid)
+    except Exception as e:
+        LOG.warning("Cannot terminate deployment %s: %s" % (duid, e))
+
+
+def _job_parameters(parameters, job_parameters):
+    """ The runtime parameters to set on a pool deployment: the job
+        parameters that differ from the pool's parameters
+    """
+    result = {}
+    for (node, values) in job_parameters.items():
+        for (name, value) in values.items():
+            if parameters.get(node, {}).get(name) != value:
+                result["%s.1:%s" % (node, name)] = value
+    return result
+
+
+def deploy_job(client, app, parameters, job_parameters, config, LOG):
+    """
+    Returns the ID of a deployment running the job: a deployment
+    claimed from the pool for the application and parameters if one is
+    ready, otherwise a new one. The pool is refilled afterwards.
+    The job parameters are the parameters plus the job's input.
+    """
+    duid = None
+    pool = None
+    try:
+        store = get_store(config, LOG)
+        if store is not None:
+            pool = pool_key(client.username, app, parameters)
+            duid = claim(store, client, pool,
+                         _job_parameters(parameters, job_parameters), LOG)
+    except (EnvironmentError, sqlite3.Error) as e:
+        LOG.warning("Cannot use the pool of deployments: %s" % e)
+    if duid is None:
+        duid = client.deploy(app, job_parameters)
+    if pool is not None:
+        try:
+            resize(store, client, pool, config, LOG)
+        except Exception as e:
+            LOG.warning("Cannot refill the pool of deployments: %s" % e)
+    return duid
+
+
+def _reservation(message, store, client, connector):
+    """ returns (reservation ID, pool) or None after replying """
+    reservation_id = Utils.extract_parameter(message, "RESERVATION_REFERENCE")
+    if reservation_id is None:
+        connector.failed("Missing parameter TSI_RESERVATION_REFERENCE")
+        return None
+    reservation = store.get_reservation(reservation_id)
+    if reservation is None or json.loads(reservation[0])[0] != \
+            client.username:
+        connector.failed("No such reservation: %s" % reservation_id)
+        return None
+    return reservation_id, reservation[0]
+
+
 def make_reservation(message, connector, config, LOG):
     """ Make a reservation """
-    connector.failed("Reservation not supported!")
+    store = get_store(config, LOG)
+    if store is None:
+        connector.failed("Reservation not supported!")
+        return
+    app = Utils.extract_parameter(message, "RESERVATION_APPLICATION")
+    if app is None:
+        connector.failed("Missing parameter TSI_RESERVATION_APPLICATION")
+        return
+    size = Utils.extract_parameter(message, "RESERVATION_SIZE", "1")
+    max_size = int(config.get('tsi.nuvla_max_reservation_size', 20))
+    try:
+        size = int(size)
+    except ValueError:
+        size = 0
+    if not 0 < size <= max_size:
+        connector.failed("Invalid TSI_RESERVATION_SIZE, must be a number "
+                         "between 1 and %d" % max_size)
+        return
+    (client, parameters) = nuvla_request(message)
+    pool = pool_key(client.username, app, parameters)
+    reservation_id = str(uuid.uuid4())
+    store.add_reservation(reservation_id, pool, size)
+    LOG.info("Reserved %d deployment(s) of %s: %s" % (size, app,
+                                                      reservation_id))
+    resize(store, client, pool, config, LOG)
+    connector.ok(reservation_id)
 
 
 def query_reservation(message, connector, config, LOG):
     """ Query a reservation """
-    connector.failed("Reservation not supported!")
+    store = get_store(config, LOG)
+    if store is None:
+        connector.failed("Reservation not supported!")
+        return
+    (client, _) = nuvla_request(message)
+    reservation = _reservation(message, store, client, connector)
+    if reservation is None:
+        return
+    (reservation_id, pool) = reservation
+    refresh(store, client, pool, LOG)
+    deployments = store.deployments(pool)
+    ready = len([d for d in deployments if d[1] == READY_STATE])
+    if ready >= store.get_reservation(reservation_id)[1]:
+        status = "READY"
+    else:
+        status = "WAITING"
+    connector.ok("%s\n%d of %d deployment(s) in the pool ready" % (
+        status, ready, len(deployments)))
 
 
 def cancel_reservation(message, connector, config, LOG):
     """ Cancel a reservation """
-    connector.failed("Reservation not supported!")
+    store = get_store(config, LOG)
+    if store is None:
+        connector.failed("Reservation not supported!")
+        return
+    (client, _) = nuvla_request(message)
+    reservation = _reservation(message, store, client, connector)
+    if reservation is None:
+        return
+    (reservation_id, pool) = reservation
+    store.remove_reservation(reservation_id)
+    resize(store, client, pool, config, LOG)
+    connector.ok()
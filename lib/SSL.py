@@ -3,39 +3,123 @@
 #
 
 
+import hashlib
+import select
 import ssl
 import re
+import time
+
+
+def create_context(config, server_mode=False):
+    """ Creates an SSL context for server or client side use, with
+    the TSI key and certificate, the truststore and modern protocol
+    defaults (TLS 1.2 or later)
+    """
+    if server_mode:
+        protocol = getattr(ssl, "PROTOCOL_TLS_SERVER", None)
+    else:
+        protocol = getattr(ssl, "PROTOCOL_TLS_CLIENT", None)
+    if protocol is None:
+        protocol = getattr(ssl, "PROTOCOL_TLS", ssl.PROTOCOL_SSLv23)
+    context = ssl.SSLContext(protocol)
+    if hasattr(context, "minimum_version"):
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+    else:
+        context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 \
+            | ssl.OP_NO_TLSv1 | getattr(ssl, "OP_NO_TLSv1_1", 0)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.load_cert_chain(certfile=config.get('tsi.certificate'),
+                            keyfile=config.get('tsi.keystore'),
+                            password=config.get('tsi.keypass'))
+    context.load_verify_locations(cafile=config.get('tsi.truststore'))
+    return context
+
+
+def init_ssl(config, LOG):
+    """ Creates the server and client SSL contexts once, and stores them
+    in the config for use by setup_ssl()
+    """
+    try:
+        config['tsi.ssl_server_context'] = create_context(config, True)
+        config['tsi.ssl_client_context'] = create_context(config, False)
+        LOG.info("SSL contexts initialized (%s)" % ssl.OPENSSL_VERSION)
+    except AttributeError:
+        # Python pre 2.7.9 does not have the SSLContext
+        LOG.info("SSLContext not available, using ssl.wrap_socket()")
 
 
-def setup_ssl(config, socket, LOG, server_mode=False):
-    """ Wraps the given socket with an SSL context """
+def setup_ssl(config, socket, LOG, server_mode=False, session=None,
+              handshake=True):
+    """ Wraps the given socket with an SSL context. On the client side,
+    a session from a previous connection can be given for resumption.
+    If handshake is False, the handshake is not done automatically after
+    connect/accept, and do_handshake() must be called explicitly.
+    """
     keystore = config.get('tsi.keystore')
-    keypass = config.get('tsi.keypass')
     cert = config.get('tsi.certificate')
     truststore = config.get('tsi.truststore')
-    try:
-        # TODO: probably it is better not to specify the protocol and instead
-        # rely on system defaults!
-        context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-        context.verify_mode = ssl.CERT_REQUIRED
-        context.check_hostname = False
-        context.load_cert_chain(certfile=cert, keyfile=keystore,
-                                password=keypass)
-        context.load_verify_locations(cafile=truststore)
-        wrapped = context.wrap_socket(socket, server_side=server_mode)
-    except AttributeError:
+    if server_mode:
+        context = config.get('tsi.ssl_server_context')
+    else:
+        context = config.get('tsi.ssl_client_context')
+    if context is None:
         # Python pre 2.7.9 does not have the SSLContext
-        wrapped = ssl.wrap_socket(socket,
-                                  cert_reqs=ssl.CERT_REQUIRED,
-                                  keyfile=keystore,
-                                  certfile=cert,
-                                  server_side=server_mode,
-                                  ssl_version=ssl.PROTOCOL_TLSv1,
-                                  ca_certs=truststore,
-                                  ciphers=None)
+        return ssl.wrap_socket(socket,
+                               cert_reqs=ssl.CERT_REQUIRED,
+                               keyfile=keystore,
+                               certfile=cert,
+                               server_side=server_mode,
+                               ssl_version=ssl.PROTOCOL_SSLv23,
+                               ca_certs=truststore,
+                               ciphers=None,
+                               do_handshake_on_connect=handshake)
+    start = time.time()
+    if session is not None:
+        wrapped = context.wrap_socket(socket, server_side=server_mode,
+                                      do_handshake_on_connect=handshake,
+                                      session=session)
+    else:
+        wrapped = context.wrap_socket(socket, server_side=server_mode,
+                                      do_handshake_on_connect=handshake)
+    if not server_mode:
+        LOG.info("SSL handshake took %.1f ms (%s, session reused: %s)" % (
+            1000 * (time.time() - start), wrapped.version(),
+            getattr(wrapped, "session_reused", False)))
     return wrapped
 
 
+def get_session(socket):
+    """ Returns the SSL session of the socket (if it can be resumed) """
+    return getattr(socket, "session", None)
+
+
+def receive_session_ticket(socket, timeout=0.2):
+    """ With TLS 1.3, the server sends the session ticket after the
+    handshake, and it is only processed when reading from the socket.
+    Waits (at most timeout seconds) for the ticket, so that the session
+    can be resumed by another connection.
+    Raises EnvironmentError if application data is received instead.
+    """
+    session = get_session(socket)
+    if session is None or session.has_ticket \
+            or socket.version() != "TLSv1.3":
+        return
+    if not select.select([socket], [], [], timeout)[0]:
+        return
+    previous = socket.gettimeout()
+    socket.setblocking(False)
+    try:
+        data = socket.recv(1)
+    except ssl.SSLWantReadError:
+        return
+    finally:
+        socket.settimeout(previous)
+    if len(data) > 0:
+        raise EnvironmentError("Unexpected data before the connection "
+                               "was set up")
+
+
 rdn_map = {"C": "countryName",
            "CN": "commonName",
            "O": "organizationName",
@@ -47,55 +131,75 @@ rdn_map = {"C": "countryName",
 
 
 def convert_rdn(rdn):
-    split = rdn.split("=")
-    translated = rdn_map.get(split[0])
+    """ Convert 'C=DE' to a normalized ('countryName', 'DE') pair,
+    or None if the attribute is not supported
+    """
+    split = rdn.split("=", 1)
+    if len(split) != 2:
+        return None
+    translated = rdn_map.get(split[0].strip().upper())
     if translated is None:
         return None
-    val = split[1]
-    return translated, val
+    return translated, split[1].strip()
 
 
 def convert_dn(dn):
-    """ Convert X500 DN in RFC format to a tuple """
-    converted = []
+    """ Convert X500 DN in RFC format to a frozenset of
+    (attribute, value) pairs. RDNs with unsupported attributes
+    are not checked.
+    """
+    converted = set()
     # split dn and strip leading/trailing whitespace
     elements = [x.strip() for x in re.split(r"[,/]", dn)]
     for element in elements:
         if element != '':
             rdn = convert_rdn(element)
-            if rdn is None:
-                # there is no LOG here...
-                # LOG.info("*** will not check : %s " % element)
-                pass
-            converted.append(rdn)
-    return converted
-
-
-def match_rdn(rdn, subject):
-    for x in subject:
-        for y in x:
-            if str(y[0]) == str(rdn[0]) and str(y[1]) == str(rdn[1]):
-                return True
-    return False
+            if rdn is not None:
+                converted.add(rdn)
+    return frozenset(converted)
+
+
+def convert_subject(subject):
+    """ Convert the subject of a peer certificate (as returned by
+    getpeercert()) to a set of (attribute, value) pairs
+    """
+    return set([(x[0], x[1]) for rdn in subject for x in rdn])
 
 
 def match(subject, acl):
+    """ Check if every RDN of one of the ACL entries is in the
+    (converted) subject
+    """
     for dn in acl:
-        accept = True
-        # every RDN of the ACL entry has to be in the subject
-        for rdn in dn:
-            accept = accept and match_rdn(rdn, subject)
-            if not accept:
-                break
-        if accept:
+        if dn <= subject:
             return True
     return False
 
 
+# SHA-256 fingerprints of peer certificates that were already
+# verified against the ACL
+_verified_fingerprints = set()
+
+
 def verify_peer(config, socket, LOG):
-    """ check that the peer is OK by comparing the DN to our ACL """
+    """ check that the peer is OK by comparing the DN to our ACL.
+    Returns the fingerprint of the peer certificate if it was newly
+    verified, None if it had been verified before
+    """
+    fingerprint = hashlib.sha256(socket.getpeercert(True)).hexdigest()
+    if fingerprint in _verified_fingerprints:
+        return None
     acl = config.get('tsi.allowed_dns', [])
     subject = socket.getpeercert()['subject']
     LOG.debug("Verify XNJS certificate with subject %s" % str(subject))
-    if not match(subject, acl):
+    if not match(convert_subject(subject), acl):
         raise EnvironmentError("Connection not allowed by ACL")
+    add_verified(fingerprint)
+    return fingerprint
+
+
+def add_verified(fingerprint):
+    """ Remember a certificate fingerprint verified against the ACL,
+    e.g. one reported by a worker to the shepherd
+    """
+    _verified_fingerprints.add(fingerprint)
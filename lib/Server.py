@@ -1,31 +1,38 @@
 #
 # Initialise connection to the XNJS
 #  - waits for a connection
-#  - validates that it is from the XNJS
-#  - if validated, command and data connections are opened
-#    via callback to the XNJS
-#  - a child process is forked which further communicates
-#    with the XNJS via the command/data sockets
+#  - a child process is forked which
+#    - validates that the connection is from the XNJS
+#    - if validated, opens command and data connections
+#      via callback to the XNJS
+#    - further communicates with the XNJS via the command/data sockets
 
 import errno
 import os
 import re
+import resource
+import select
 import signal
 import socket
 import sys
 import time
 import Utils
-from SSL import setup_ssl, verify_peer
+from Monitor import Monitor
+from SSL import get_session, init_ssl, receive_session_ticket, \
+    setup_ssl, verify_peer
 
 
-def configure_socket(sock, LOG):
+def configure_socket(sock, LOG, nodelay=False):
     """
-    Setup socket options (keepalive).
+    Setup socket options (keepalive, and optionally disable Nagle's
+    algorithm for low latency request/reply traffic).
     """
     after_idle = 5
     interval = 1
     max_fails = 3
     sock.settimeout(None)
+    if nodelay:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     if not sys.platform.startswith("win"):
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
     if sys.platform.startswith("darwin"):
@@ -37,14 +44,115 @@ def configure_socket(sock, LOG):
         sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, max_fails)
 
 
+def set_buffer_sizes(sock, configuration):
+    """
+    Set the socket send/receive buffer sizes, if configured.
+    Must be called before connecting for the receive window to be
+    scaled accordingly.
+    """
+    sndbuf = configuration.get('tsi.socket_sndbuf')
+    rcvbuf = configuration.get('tsi.socket_rcvbuf')
+    if sndbuf is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, int(sndbuf))
+    if rcvbuf is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(rcvbuf))
+
+
+def log_buffer_sizes(sock, name, LOG):
+    LOG.info("%s socket buffers: send %s, receive %s bytes" % (
+        name, sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+        sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)))
+
+
+def create_connection(address, configuration, timeout=10):
+    """
+    Connect to the given (host, port), applying the configured socket
+    buffer sizes before connecting.
+    """
+    (host, port) = address
+    error = None
+    for (family, socktype, proto, _, sockaddr) in socket.getaddrinfo(
+            host, port, 0, socket.SOCK_STREAM):
+        sock = None
+        try:
+            sock = socket.socket(family, socktype, proto)
+            set_buffer_sizes(sock, configuration)
+            sock.settimeout(timeout)
+            sock.connect(sockaddr)
+            return sock
+        except EnvironmentError as e:
+            error = e
+            if sock is not None:
+                close_quietly(sock)
+    if error is None:
+        error = EnvironmentError("Cannot resolve %s" % host)
+    raise error
+
+
 def worker_completed(signal, frame):
+    """ Clean up finished workers, returns the list of their PIDs """
+    pids = []
     try:
         while True:
             (pid,state,ru) = os.wait3(os.WNOHANG)
             if pid == 0:
                 break
+            pids.append(pid)
     except:
         pass
+    return pids
+
+
+def drain_workers(monitor, timeout, LOG):
+    """
+    Ask all workers to exit after finishing their current request,
+    and kill the ones still running after 'timeout' seconds
+    """
+    for pid in list(monitor.workers):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            monitor.worker_exited(pid)
+    LOG.info("Waiting up to %s seconds for %d worker(s) to finish" % (
+        timeout, len(monitor.workers)))
+    deadline = time.time() + timeout
+    while len(monitor.workers) > 0 and time.time() < deadline:
+        # finished workers are removed by the SIGCHLD handler
+        time.sleep(0.1)
+    for pid in list(monitor.workers):
+        LOG.info("Killing worker %s" % pid)
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def get_rss():
+    """ Current resident set size of this process in kB """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+    except (EnvironmentError, ValueError, IndexError):
+        # peak value, but the best we can get
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def recycle_reason(configuration, requests):
+    """
+    Check whether a worker that has processed the given number of
+    requests should exit (so the XNJS opens a fresh connection).
+    Returns the reason, or None
+    """
+    max_requests = int(configuration.get('tsi.worker_max_requests', 0))
+    if 0 < max_requests <= requests:
+        return "processed %d requests" % requests
+    max_rss = int(configuration.get('tsi.worker_max_rss', 0))
+    if max_rss > 0:
+        rss = get_rss() // 1024
+        if rss >= max_rss:
+            return "memory usage %d MB exceeds limit" % rss
+    return None
 
 
 def verify_ip(configuration, xnjs_host, LOG):
@@ -64,6 +172,28 @@ def close_quietly(closeable):
     except:
         pass
 
+
+def create_server(configuration, ssl_mode, LOG):
+    """
+    Create the listening socket on the configured address, with the
+    configured backlog. In SSL mode, the handshake is not done on
+    accept, but must be done by the worker.
+    """
+    host = configuration['tsi.my_addr']
+    port = int(configuration['tsi.my_port'])
+    backlog = int(configuration.get('tsi.listen_backlog', 64))
+    LOG.info("Listening on %s:%s (backlog %s)" % (host, port, backlog))
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    if ssl_mode:
+        init_ssl(configuration, LOG)
+        server = setup_ssl(configuration, server, LOG, True,
+                           handshake=False)
+    server.listen(backlog)
+    return server
+
+
 def connect(configuration, LOG):
     """
     Accept connection from the XNJS.
@@ -74,40 +204,58 @@ def connect(configuration, LOG):
     Parameters: dictionary of config settings, logger
     """
 
-    # register a handler to clean up finished worker TSIs
-    signal.signal(signal.SIGCHLD, worker_completed)
-
-    buffer_size = 1024
-    host = configuration['tsi.my_addr']
-    port = int(configuration['tsi.my_port'])
     ssl_mode = configuration.get('tsi.keystore') is not None
-
-    LOG.info("Listening on %s:%s" % (host, port))
     LOG.info("SSL enabled: %s" % ssl_mode)
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind((host, port))
-    if ssl_mode:
-        server = setup_ssl(configuration, server, LOG, True)
+    LOG.info("Socket buffer sizes: send %s, receive %s, data channel "
+             "buffer %s" % (configuration.get('tsi.socket_sndbuf', 'default'),
+                            configuration.get('tsi.socket_rcvbuf', 'default'),
+                            configuration.get('tsi.data_buffer_size')))
+    server = create_server(configuration, ssl_mode, LOG)
+
+    monitor = Monitor(configuration, LOG)
+    configuration['tsi.monitor'] = monitor
+
+    # register a handler to clean up finished worker TSIs
+    def on_worker_completed(signum, frame):
+        for pid in worker_completed(signum, frame):
+            monitor.worker_exited(pid)
+    signal.signal(signal.SIGCHLD, on_worker_completed)
+
+    # on SIGTERM, stop accepting and let the workers finish
+    draining = []
 
-    server.listen(2)
+    def on_terminate(signum, frame):
+        draining.append(signum)
+        # wake up the accept loop
+        monitor.report("drain")
+    signal.signal(signal.SIGTERM, on_terminate)
 
     while True:
+        if draining:
+            LOG.info("Received SIGTERM, stopping the TSI.")
+            close_quietly(server)
+            drain_workers(monitor,
+                          float(configuration.get('tsi.drain_timeout', 300)),
+                          LOG)
+            monitor.close()
+            LOG.info("TSI stopped.")
+            sys.exit(0)
         try:
+            (readable, writable, _) = select.select(
+                [server] + monitor.sockets(), monitor.writers(), [],
+                monitor.timeout())
+            for sock in readable + writable:
+                if sock is not server:
+                    monitor.handle(sock)
+            monitor.expire()
+            if server not in readable:
+                continue
             (xnjs, (xnjs_host, _)) = server.accept()
-        except EnvironmentError as e:
-            if e.errno != errno.EINTR:
+        except (select.error, EnvironmentError) as e:
+            if e.args[0] != errno.EINTR:
                 LOG.info("Error waiting for new connection: " + str(e))
             continue
-
-        if ssl_mode:
-            try:
-                verify_peer(configuration, xnjs, LOG)
-            except EnvironmentError as e:
-                LOG.info("Error verifying connection from %s : %s" % (
-                    xnjs_host, str(e)))
-                close_quietly(xnjs)
-                continue
+        accepted = time.time()
 
         try:
             verify_ip(configuration, xnjs_host, LOG)
@@ -117,67 +265,101 @@ def connect(configuration, LOG):
             close_quietly(xnjs)
             continue
 
-        configure_socket(xnjs, LOG)
-        try:
-            msg = xnjs.recv(buffer_size)
-        except EnvironmentError as e:
-            LOG.info("Error reading from XNJS: %s " % str(e))
-            close_quietly(xnjs)
-            continue
-        
-        LOG.info("message : %s" % msg)
-        if msg == "shutdown\n":
-            LOG.info("Received shutdown message, exiting.")
-            server.close()
-            exit(0)
-
-        LOG.info("Accepted connection from %s" % xnjs_host)
-        try:
-            # write to the XNJS to tell it everything is OK
-            xnjs.sendall(b'OK\n')
-            # callback to the XNJS
-            xnjs_port = get_xnjs_port(configuration, Utils.decode(msg), LOG)
-            if xnjs_port is None:
-                raise EnvironmentError("Received invalid message")
-            address = (xnjs_host, xnjs_port)
-            LOG.info("Contacting XNJS on %s port %s" % address)
-            # allow some time for XNJS to start listening
-            time.sleep(1)
-            command = socket.create_connection(address, 10)
-            data = socket.create_connection(address, 10)
-        except EnvironmentError as e:
-            LOG.info("Error communicating with XNJS : %s" % str(e))
-            close_quietly(xnjs)
-            continue
-
-        if ssl_mode:
-            try:
-                command = setup_ssl(configuration, command, LOG)
-                data = setup_ssl(configuration, data, LOG)
-            except EnvironmentError as e:
-                LOG.info("Error setting up SSL connections to XNJS : %s" % str(e))
-                close_quietly(xnjs)
-                continue
-
-        LOG.info("Connection to XNJS at %s:%s established." % address)
         worker_id = configuration.get('tsi.worker.id', 1)
-        LOG.info("Starting tsi-worker-%d" % worker_id)
-        # fork, cleanup and return sockets to the caller (main loop)
+        LOG.info("Starting tsi-worker-%d for connection from %s" % (
+            worker_id, xnjs_host))
+        # fork, so that a slow peer cannot block the accept loop.
+        # The child sets up the connection to the XNJS and returns
+        # the command/data sockets to the caller (main loop)
         pid = os.fork()
         if pid == 0:
-            # child: close unneeded server socket and
-            # return command/data sockets to caller
+            # child: close unneeded server socket
             server.close()
-            configure_socket(command, LOG)
-            configure_socket(data, LOG)
-            return command, data
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            monitor.worker_started()
+            try:
+                return setup_worker_connection(configuration, xnjs,
+                                               xnjs_host, ssl_mode, LOG)
+            except EnvironmentError as e:
+                LOG.info("Error setting up connection with XNJS at %s : %s"
+                         % (xnjs_host, str(e)))
+                close_quietly(xnjs)
+                os._exit(1)
         else:
-            # parent, close unneeded command/data sockets and
+            # parent, close the connection (now handled by the child) and
             # continue with accept loop
-            # TODO check if SSL session is OK with this!
-            command.close()
-            data.close()
+            close_quietly(xnjs)
             configuration['tsi.worker.id'] = worker_id + 1
+            monitor.worker_forked(pid, worker_id, xnjs_host)
+            monitor.record("accept", 1000 * (time.time() - accepted))
+
+
+def setup_worker_connection(configuration, xnjs, xnjs_host, ssl_mode, LOG):
+    """
+    Complete a connection accepted by the shepherd: SSL handshake and peer
+    verification, reading the XNJS message and opening the command and
+    data connections via callback to the XNJS.
+
+    Returns a pair (command,data) of sockets for communicating
+    with the XNJS.
+    Raises EnvironmentError if anything goes wrong.
+    """
+    buffer_size = 1024
+    start = time.time()
+    handshake_time = 0.0
+    # make sure a slow or malicious peer cannot keep the worker busy
+    xnjs.settimeout(float(configuration.get('tsi.handshake_timeout', 10)))
+    if ssl_mode:
+        xnjs.do_handshake()
+        handshake_time = 1000 * (time.time() - start)
+        LOG.info("SSL handshake with %s took %.1f ms" % (
+            xnjs_host, handshake_time))
+        fingerprint = verify_peer(configuration, xnjs, LOG)
+        monitor = configuration.get('tsi.monitor')
+        if fingerprint is not None and monitor is not None:
+            # the shepherd remembers it for the workers forked later
+            monitor.report("verified", fingerprint=fingerprint)
+
+    msg = Utils.decode(xnjs.recv(buffer_size))
+    configure_socket(xnjs, LOG)
+
+    LOG.info("message : %s" % msg)
+    if msg == "shutdown\n":
+        LOG.info("Received shutdown message, stopping the TSI.")
+        os.kill(os.getppid(), signal.SIGTERM)
+        os._exit(0)
+
+    LOG.info("Accepted connection from %s" % xnjs_host)
+    # write to the XNJS to tell it everything is OK
+    xnjs.sendall(b'OK\n')
+    # callback to the XNJS
+    xnjs_port = get_xnjs_port(configuration, msg, LOG)
+    if xnjs_port is None:
+        raise EnvironmentError("Received invalid message")
+    address = (xnjs_host, xnjs_port)
+    LOG.info("Contacting XNJS on %s port %s" % address)
+    # allow some time for XNJS to start listening
+    time.sleep(1)
+    command = create_connection(address, configuration)
+    data = create_connection(address, configuration)
+
+    if ssl_mode:
+        command = setup_ssl(configuration, command, LOG)
+        receive_session_ticket(command)
+        # resume the command connection's session if possible
+        data = setup_ssl(configuration, data, LOG,
+                         session=get_session(command))
+
+    LOG.info("Connection to XNJS at %s:%s established." % address)
+    monitor = configuration.get('tsi.monitor')
+    if monitor is not None:
+        monitor.report("setup", handshake_ms=handshake_time,
+                       setup_ms=1000 * (time.time() - start))
+    configure_socket(command, LOG, nodelay=True)
+    configure_socket(data, LOG)
+    log_buffer_sizes(command, "Command", LOG)
+    log_buffer_sizes(data, "Data", LOG)
+    return command, data
 
 
 def setup_streams(command, data):
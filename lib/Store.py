@@ -0,0 +1,67 @@
+#
+# SQLite databases shared by the shepherd and all workers
+#
+import os
+import sqlite3
+import stat
+
+
+class Store(object):
+    """
+    Base class for data stored in an SQLite database file that is
+    shared by all TSI processes. Subclasses define the tables, and a
+    description of the store for error messages.
+    The database is used in WAL mode, i.e. readers never wait for
+    writers. With synchronous=NORMAL (the default), committed data can
+    only be lost on power failure, and the database stays consistent.
+    Stores of data that can be rebuilt may use synchronous=OFF.
+    """
+
+    description = "store"
+
+    tables = []
+
+    synchronous = "NORMAL"
+
+    def __init__(self, path, LOG):
+        self.path = path
+        self.LOG = LOG
+        self.db = None
+        self.pid = None
+        db = self.connection()
+        if db is not None:
+            with db:
+                for sql in self.tables:
+                    db.execute(sql)
+
+    def connection(self):
+        """ Returns the connection of this process, or None if the
+        database cannot be used
+        """
+        # connections must not be shared with a forked process
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.db = None
+            umask = os.umask(0o077)
+            try:
+                os.close(os.open(self.path, os.O_RDWR | os.O_CREAT |
+                                 os.O_NOFOLLOW, 0o600))
+                self.check_owner()
+                db = sqlite3.connect(self.path, timeout=1)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=%s" % self.synchronous)
+                self.db = db
+            except (sqlite3.Error, EnvironmentError) as e:
+                self.LOG.warning("Cannot use %s %s: %s" % (
+                    self.description, self.path, str(e)))
+            finally:
+                os.umask(umask)
+        return self.db
+
+    def check_owner(self):
+        # make sure nobody else can have created or modified the file
+        st = os.lstat(self.path)
+        if st.st_uid != os.geteuid() or st.st_mode & 0o022 != 0 \
+                or not stat.S_ISREG(st.st_mode):
+            raise EnvironmentError("file is not a regular file owned by "
+                                   "the TSI user, or is writable by others")
@@ -9,8 +9,10 @@ import logging
 import logging.config
 import os
 import re
+import signal
 import socket
 import sys
+import time
 import ACL, BecomeUser, BSS, Connector, Local, Reservation, Server, SSL, IO, Utils
 
 #
@@ -81,12 +83,36 @@ def setup_defaults(config):
     config['tsi.logfacility'] = 'LOG_USER'
     config['tsi.loghost'] = ''
     config['tsi.userCacheTtl'] = 600
+    config['tsi.userCacheNegativeTtl'] = 60
+    config['tsi.userCacheMaxStale'] = 3600
+    config['tsi.userCacheMaxEntries'] = 10000
+    config['tsi.userCachePrewarmThreads'] = 4
     config['tsi.enforce_os_gids'] = True
     config['tsi.fail_on_invalid_gids'] = False
     config['tsi.debug'] = 0
     config['tsi.worker.id'] = 1
     config['tsi.njs_machine'] = 'localhost'
     config['tsi.safe_dir'] = '/tmp'
+    config['tsi.df_cache_ttl'] = 30
+    config['tsi.quota_cache_ttl'] = 300
+    config['tsi.checksum_threads'] = 4
+    config['tsi.compression_level'] = 6
+    config['tsi.compression_min_ratio'] = 0.9
+    config['tsi.preallocate'] = True
+    config['tsi.posix_acl_native'] = True
+    config['tsi.setfacl_threads'] = 4
+    config['tsi.file_sync'] = 'none'
+    config['tsi.file_sync_interval'] = 67108864
+    config['tsi.write_buffer_size'] = 1048576
+    config['tsi.max_message_size'] = Connector.MAX_MESSAGE_SIZE
+    config['tsi.data_buffer_size'] = Connector.DATA_BUFFER_SIZE
+    config['tsi.listen_backlog'] = 64
+    config['tsi.handshake_timeout'] = 10
+    config['tsi.drain_timeout'] = 300
+    config['tsi.worker_max_requests'] = 0
+    config['tsi.worker_max_rss'] = 0
+    config['tsi.nuvla_pool_size'] = 0
+    config['tsi.nuvla_max_reservation_size'] = 20
 
 def process_config_value(key, value, config, LOG):
     """
@@ -110,6 +136,28 @@ def process_config_value(key, value, config, LOG):
         else:
             raise KeyError("Invalid value '%s' for parameter '%s', "
                            "must be 'true' or 'false'" % (value, key))
+    elif 'tsi.preallocate' == key:
+        if 'true' == value:
+            config['tsi.preallocate'] = True
+        elif 'false' == value:
+            config['tsi.preallocate'] = False
+        else:
+            raise KeyError("Invalid value '%s' for parameter '%s', "
+                           "must be 'true' or 'false'" % (value, key))
+    elif 'tsi.posix_acl_native' == key:
+        if 'true' == value:
+            config['tsi.posix_acl_native'] = True
+        elif 'false' == value:
+            config['tsi.posix_acl_native'] = False
+        else:
+            raise KeyError("Invalid value '%s' for parameter '%s', "
+                           "must be 'true' or 'false'" % (value, key))
+    elif 'tsi.file_sync' == key:
+        if value in ['none', 'end', 'periodic']:
+            config[key] = value
+        else:
+            raise KeyError("Invalid value '%s' for parameter '%s', "
+                           "must be 'none', 'end' or 'periodic'" % (value, key))
     elif key.startswith('tsi.acl'):
         if 'NONE' == value or 'POSIX' == value or 'NFS' == value:
             path = key[8:]
@@ -122,8 +170,12 @@ def process_config_value(key, value, config, LOG):
     elif key.startswith('tsi.allowed_dn.'):
         allowed_dns = config.get('tsi.allowed_dns', [])
         dn = SSL.convert_dn(value)
+        if len(dn) == 0:
+            raise KeyError("Invalid value '%s' for parameter '%s', "
+                           "no supported attributes in DN" % (value, key))
         LOG.info("Allowing SSL connections for %s" % value)
-        allowed_dns.append(dn)
+        if dn not in allowed_dns:
+            allowed_dns.append(dn)
         config['tsi.allowed_dns'] = allowed_dns
     else:
         config[key] = value
@@ -147,6 +199,8 @@ def setup_acl(config, LOG):
         config['tsi.nfsacl_enabled'] = False
         LOG.info("NFS ACL support disabled (commands not configured)")
 
+    ACL.get_acl_index(config)
+
 
 def setup_allowed_ips(config, LOG):
     """
@@ -236,6 +290,9 @@ def init_functions(bss):
         "TSI_PUTFILECHUNK": IO.put_file_chunk,
         "TSI_LS": IO.ls,
         "TSI_DF": IO.df,
+        "TSI_FILE_CHECKSUM": IO.checksum,
+        "TSI_GET_ARCHIVE": IO.get_archive,
+        "TSI_PUT_ARCHIVE": IO.put_archive,
         "TSI_SUBMIT": bss.submit,
         "TSI_GETSTATUSLISTING": bss.get_status_listing,
         "TSI_GETJOBDETAILS": bss.get_job_details,
@@ -250,6 +307,26 @@ def init_functions(bss):
     }
 
 
+# worker state for graceful shutdown
+_worker_state = {"busy": False, "stop": False, "connector": None}
+
+
+def on_terminate(signum, frame):
+    """
+    SIGTERM handler for the worker: exit after the current request is
+    finished. If waiting for a request, reading from the XNJS is stopped,
+    but a request that has already been read is still processed.
+    """
+    _worker_state["stop"] = True
+    if _worker_state["busy"]:
+        return
+    connector = _worker_state["connector"]
+    if connector is None:
+        # nothing read yet
+        raise SystemExit(0)
+    connector.stop_reading()
+
+
 def process(connector, config, LOG):
     """
     Main processing loop. Reads commands from control_in and invokes the
@@ -266,20 +343,37 @@ def process(connector, config, LOG):
     os.umask(my_umask)
     bss = config.get('tsi.bss', BSS.BSS())
     functions = init_functions(bss)
+    monitor = config.get('tsi.monitor')
+    _worker_state["connector"] = connector
 
     # read message from control
     first = True
+    requests = 0
     while True:
         if config.get('tsi.testing', False) and not first:
             LOG.info("Testing mode, exiting main loop")
             break
         first = False
+        _worker_state["busy"] = False
+        if _worker_state["stop"]:
+            # SIGTERM received while still busy with the last request
+            connector.stop_reading()
         try:
             message = Utils.encode(connector.read_message())
+            _worker_state["busy"] = True
         except IOError:
-            LOG.info("Peer shutdown, exiting")
+            if _worker_state["stop"]:
+                LOG.info("Received SIGTERM, exiting")
+            else:
+                LOG.info("Peer shutdown, exiting")
             connector.close()
             return
+        except ValueError as e:
+            LOG.warning(str(e))
+            connector.failed(str(e))
+            connector.write_message("ENDOFMESSAGE")
+            connector.flush()
+            continue
         do_set_uid = setting_uids
         # check for command and invoke appropriate function
         legal_cmd = False
@@ -290,6 +384,12 @@ def process(connector, config, LOG):
                 legal_cmd = True
                 if "TSI_PING" == cmd:
                     do_set_uid = False
+                start = time.time()
+                if monitor is not None:
+                    identity = Utils.extract_parameter(message, "IDENTITY",
+                                                       "n/a")
+                    monitor.report("begin", command=cmd,
+                                   user=identity.split(" ")[0])
                 try:
                     if do_set_uid:
                         id_info = re.search(r".*^#TSI_IDENTITY (\S+) (\S+)\n.*",
@@ -306,6 +406,9 @@ def process(connector, config, LOG):
                     connector.failed(str(sys.exc_info()[1]))
                     # log exception info and stacktrace
                     LOG.exception("Error executing %s" % cmd)
+                if monitor is not None:
+                    monitor.report("end", command=cmd,
+                                   duration_ms=1000 * (time.time() - start))
                 break
 
         if not legal_cmd:
@@ -319,6 +422,19 @@ def process(connector, config, LOG):
 
         # and terminate the current "transaction" with the XNJS
         connector.write_message("ENDOFMESSAGE")
+        connector.flush()
+
+        requests += 1
+        if _worker_state["stop"]:
+            LOG.info("Received SIGTERM, exiting")
+            connector.close()
+            return
+        reason = Server.recycle_reason(config, requests)
+        if reason is not None:
+            # the XNJS will open a new connection to a fresh worker
+            LOG.info("Worker %s, exiting" % reason)
+            connector.close()
+            return
 
 
 def main(argv=None):
@@ -347,7 +463,8 @@ def main(argv=None):
     (command, data) = Server.connect(config, LOG)
     LOG = get_worker_logger(config)
     LOG.info("Worker started.")
-    connector = Connector.Connector(command, data, LOG)
+    signal.signal(signal.SIGTERM, on_terminate)
+    connector = Connector.create_connector(command, data, config, LOG)
     process(connector, config, LOG)
     return 0
 
@@ -4,42 +4,343 @@
 #
 # The cache time is configurable
 #
+# Optionally, the cached entries are shared between the shepherd
+# and all workers via an SQLite database (e.g. in /dev/shm)
+#
+import fnmatch
+import sqlite3
+import sys
+import threading
 import time
 import pwd
 import grp
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from Store import Store
+
+
+class SharedStore(Store):
+    """
+    User and group entries stored in an SQLite database, so that
+    entries resolved by one process can be used by all others.
+    All errors are logged and otherwise ignored, the store is only an
+    optimisation.
+    """
+
+    description = "shared user cache"
+
+    tables = ["CREATE TABLE IF NOT EXISTS users (name TEXT PRIMARY KEY, "
+              "uid INTEGER, gid INTEGER, home TEXT, gids TEXT, "
+              "timestamp REAL)",
+              "CREATE TABLE IF NOT EXISTS groups (name TEXT PRIMARY KEY, "
+              "gid INTEGER, members TEXT, timestamp REAL)"]
+
+    # entries can always be looked up again
+    synchronous = "OFF"
+
+    def _query(self, sql, key):
+        db = self.connection()
+        if db is None:
+            return None
+        try:
+            return db.execute(sql, (key,)).fetchone()
+        except sqlite3.Error as e:
+            self.LOG.debug("Error reading shared user cache: %s" % str(e))
+            return None
+
+    def _update(self, sql, values):
+        db = self.connection()
+        if db is None:
+            return
+        try:
+            with db:
+                db.execute(sql, values)
+        except sqlite3.Error as e:
+            self.LOG.debug("Error writing shared user cache: %s" % str(e))
+
+    def get_user(self, user):
+        """ returns (uid, gid, home, gids, timestamp) or None """
+        row = self._query("SELECT uid, gid, home, gids, timestamp FROM users "
+                          "WHERE name=?", user)
+        if row is None:
+            return None
+        return row[0], row[1], row[2], _split_ints(row[3]), row[4]
+
+    def put_user(self, user, uid, gid, home, gids, timestamp):
+        self._update("INSERT OR REPLACE INTO users VALUES (?,?,?,?,?,?)",
+                     (user, uid, gid, home, _join(gids), timestamp))
+
+    def get_group(self, group):
+        """ returns (gid, members, timestamp) or None """
+        row = self._query("SELECT gid, members, timestamp FROM groups "
+                          "WHERE name=?", group)
+        if row is None:
+            return None
+        return row[0], _split(row[1]), row[2]
+
+    def put_group(self, group, gid, members, timestamp):
+        self._update("INSERT OR REPLACE INTO groups VALUES (?,?,?,?)",
+                     (group, gid, _join(members), timestamp))
+
+
+def _join(values):
+    return ",".join([str(v) for v in values])
+
+
+def _split(value):
+    if len(value) == 0:
+        return []
+    return value.split(",")
+
+
+def _split_ints(value):
+    return [int(v) for v in _split(value)]
+
+
+class UserEntry(object):
+    """ Cached user information, uid is None for unknown users """
+    __slots__ = ("uid", "gid", "home", "gids", "timestamp")
+
+    def __init__(self, uid, gid, home, gids, timestamp):
+        self.uid = uid
+        self.gid = gid
+        self.home = home
+        self.gids = gids
+        self.timestamp = timestamp
+
+
+class GroupEntry(object):
+    """ Cached group information, gid is None for unknown groups """
+    __slots__ = ("gid", "members", "timestamp")
+
+    def __init__(self, gid, members, timestamp):
+        self.gid = gid
+        self.members = members
+        self.timestamp = timestamp
+
+
+class IdentityEntry(object):
+    """ Resolved identity for a user and list of requested groups """
+    __slots__ = ("uid", "gid", "gids", "home", "timestamp")
+
+    def __init__(self, uid, gid, gids, home, timestamp):
+        self.uid = uid
+        self.gid = gid
+        self.gids = gids
+        self.home = home
+        self.timestamp = timestamp
 
 
 class UserCache(object):
-    def __init__(self, cache_ttl, LOG):
+    def __init__(self, cache_ttl, LOG, shared_file=None, negative_ttl=60,
+                 max_stale=3600, max_entries=10000):
         self.cache_ttl = cache_ttl
+        self.negative_ttl = negative_ttl
+        self.max_stale = max_stale
+        self.max_entries = max(1, max_entries)
         self.LOG = LOG
-        self.all_groups = {}
-        self.groups_cache = {}
-        self.uids = {}
-        self.gids = {}
-        self.homes = {}
-        self.groups = {}
-        self.members = {}
-        self.users_timestamps = {}
-        self.groups_timestamps = {}
+        self.shared = None
+        if shared_file is not None:
+            self.shared = SharedStore(shared_file, LOG)
+        # user/group name -> entry, in least recently used order
+        self.users = _lru_dict()
+        self.groups = _lru_dict()
+        # (user, requested groups) -> identity
+        self.identities = _lru_dict()
+        self.hits = 0
+        self.misses = 0
+        self.identity_hits = 0
+        self.identity_misses = 0
+        self.evictions = 0
+        self.memberships = {}
+        self.memberships_timestamp = None
+        # only one thread rebuilds the membership index
+        self.memberships_lock = threading.Lock()
+        # background refreshes of expired entries
+        self.refreshing = set()
+        self.refreshed = []
+
+    def statistics(self):
+        return {"users": len(self.users), "groups": len(self.groups),
+                "identities": len(self.identities),
+                "max_entries": self.max_entries, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions,
+                "identity_hits": self.identity_hits,
+                "identity_misses": self.identity_misses}
+
+    # returns the entry if it can be used, updating the LRU order
+    def get_entry(self, table, name):
+        entry = table.get(name)
+        if entry is None:
+            return None
+        if entry.timestamp is not None:
+            ttl = self.cache_ttl
+            if entry.gid is None:
+                # unknown user or group
+                ttl = self.negative_ttl
+            if not self.expired(entry.timestamp, ttl):
+                _touch(table, name)
+                return entry
+        return None
+
+    def put_entry(self, table, name, entry):
+        table.pop(name, None)
+        table[name] = entry
+        while len(table) > self.max_entries:
+            del table[next(iter(table))]
+            self.evictions += 1
 
     def prepare_users(self, user):
-        timestamp = self.users_timestamps.get(user)
-        if self.expired(timestamp):
-            self.update_user_info(user)
-            if self.users_timestamps.get(user) is None:
-                self.LOG.debug("Unknown user name requested: %s" % user)
+        self.apply_refreshed()
+        if self.get_entry(self.users, user) is not None:
+            self.hits += 1
+            return
+        self.misses += 1
+        if self.load_shared_user(user):
+            return
+        entry = self.users.get(user)
+        if entry is not None and entry.uid is not None and \
+                not self.expired(entry.timestamp, self.max_stale):
+            # serve the old entry while it is being refreshed
+            _touch(self.users, user)
+            self.refresh_async("user", user)
+            return
+        self.update_user_info(user)
+        if self.users[user].uid is None:
+            self.LOG.debug("Unknown user name requested: %s" % user)
 
     def prepare_groups(self, group):
-        timestamp = self.groups_timestamps.get(group)
-        if self.expired(timestamp):
-            self.update_group_info(group)
-        if self.groups_timestamps.get(group) is None:
+        self.apply_refreshed()
+        if self.get_entry(self.groups, group) is not None:
+            self.hits += 1
+            return
+        self.misses += 1
+        if self.load_shared_group(group):
+            return
+        entry = self.groups.get(group)
+        if entry is not None and entry.gid is not None and \
+                not self.expired(entry.timestamp, self.max_stale):
+            # serve the old entry while it is being refreshed
+            _touch(self.groups, group)
+            self.refresh_async("group", group)
+            return
+        self.update_group_info(group)
+        if self.groups[group].gid is None:
             self.LOG.debug("Unknown group name requested: %s" % group)
 
-    # checks if cache TTL is expired
-    def expired(self, timestamp):
-        if timestamp is None or timestamp + self.cache_ttl < time.time():
+    # Starts a lookup of the user or group in a background thread,
+    # unless one is already running. The result is stored by the
+    # main thread via apply_refreshed()
+    def refresh_async(self, kind, name):
+        if (kind, name) in self.refreshing:
+            return
+        self.refreshing.add((kind, name))
+        thread = threading.Thread(target=self.refresh, args=(kind, name))
+        thread.daemon = True
+        thread.start()
+
+    def refresh(self, kind, name):
+        try:
+            if kind == "user":
+                result = self.lookup_user(name)
+            else:
+                result = self.lookup_group(name)
+        except Exception as e:
+            self.LOG.debug("Error refreshing %s %s: %s" % (kind, name, str(e)))
+            result = False
+        self.refreshed.append((kind, name, result))
+
+    def apply_refreshed(self):
+        while len(self.refreshed) > 0:
+            (kind, name, result) = self.refreshed.pop(0)
+            self.refreshing.discard((kind, name))
+            if result is False:
+                # lookup failed, keep serving the old entry
+                continue
+            if kind == "user":
+                self.store_user_info(name, result)
+            else:
+                self.store_group_info(name, result)
+
+    # returns the cached (uid, gid, gids, home) for the user and
+    # requested groups, or None
+    def get_identity(self, user, requested_groups):
+        entry = self.get_entry(self.identities,
+                               (user, tuple(requested_groups)))
+        if entry is None:
+            self.identity_misses += 1
+            return None
+        self.identity_hits += 1
+        return entry.uid, entry.gid, list(entry.gids), entry.home
+
+    def put_identity(self, user, requested_groups, identity):
+        (uid, gid, gids, home) = identity
+        self.put_entry(self.identities, (user, tuple(requested_groups)),
+                       IdentityEntry(uid, gid, tuple(gids), home,
+                                     time.time()))
+
+    # Loads the given users and groups into the (shared) cache before
+    # they are needed. Names may contain wildcards ('*', '?' or '[...]'),
+    # which are matched against the users and groups that NSS can
+    # enumerate. Other names are looked up using up to 'threads' threads.
+    def prewarm(self, users, groups=(), threads=4):
+        start = time.time()
+        with self.memberships_lock:
+            self.update_memberships()
+        (user_names, user_patterns) = _split_patterns(users)
+        if user_patterns:
+            for pw in pwd.getpwall():
+                (name, _, uid, gid, _, home, _) = pw
+                if _matches(name, user_patterns):
+                    user_names.discard(name)
+                    self.store_user_info(name, (uid, gid, home,
+                                                self.get_gids_4user_nc(name,
+                                                                       gid)))
+        for (name, info) in _lookup_all(self.lookup_user, user_names,
+                                        threads, self.LOG):
+            self.store_user_info(name, info)
+        (group_names, group_patterns) = _split_patterns(groups)
+        if group_patterns:
+            for g in grp.getgrall():
+                if _matches(g.gr_name, group_patterns):
+                    group_names.discard(g.gr_name)
+                    self.store_group_info(g.gr_name, (g.gr_gid, g.gr_mem))
+        for (name, info) in _lookup_all(self.lookup_group, group_names,
+                                        threads, self.LOG):
+            self.store_group_info(name, info)
+        self.LOG.info("User cache prewarmed in %.1f ms: %s" % (
+            1000 * (time.time() - start), self.statistics()))
+
+    # takes a user entry from the shared store, if present and not expired
+    def load_shared_user(self, user):
+        if self.shared is None:
+            return False
+        entry = self.shared.get_user(user)
+        if entry is None or self.expired(entry[4]):
+            return False
+        (uid, gid, home, all_groups, timestamp) = entry
+        self.put_entry(self.users, user, UserEntry(uid, gid, home,
+                                                   tuple(all_groups),
+                                                   timestamp))
+        return True
+
+    # takes a group entry from the shared store, if present and not expired
+    def load_shared_group(self, group):
+        if self.shared is None:
+            return False
+        entry = self.shared.get_group(group)
+        if entry is None or self.expired(entry[2]):
+            return False
+        (gid, members, timestamp) = entry
+        self.put_entry(self.groups, group, GroupEntry(gid, tuple(members),
+                                                      timestamp))
+        return True
+
+    # checks if cache TTL (or the given TTL) is expired
+    def expired(self, timestamp, ttl=None):
+        if ttl is None:
+            ttl = self.cache_ttl
+        if timestamp is None or timestamp + ttl < time.time():
             return True
         else:
             return False
@@ -47,35 +348,34 @@ class UserCache(object):
     # retrieves all gids the username is member of
     def get_gids_4user(self, user):
         self.prepare_users(user)
-        gids = self.all_groups.get(user)
+        gids = self.users[user].gids
         if gids is None:
             return []
         else:
-            return gids
+            return list(gids)
 
     # resolves the group name
     def get_gid_4group(self, group):
         self.prepare_groups(group)
-        gid = self.groups.get(group)
+        gid = self.groups[group].gid
         if gid is None:
             return -1
         else:
             return gid
 
-            # returns all members of a given group name
-
+    # returns all members of a given group name
     def get_members_4group(self, group):
         self.prepare_groups(group)
-        members = self.members.get(group)
+        members = self.groups[group].members
         if members is None:
             return []
         else:
-            return members
+            return list(members)
 
     # returns primary gid for a username
     def get_gid_4user(self, user):
         self.prepare_users(user)
-        gid = self.gids.get(user)
+        gid = self.users[user].gid
         if gid is None:
             return -1
         else:
@@ -84,7 +384,7 @@ class UserCache(object):
     # returns uid for a username
     def get_uid_4user(self, user):
         self.prepare_users(user)
-        uid = self.uids.get(user)
+        uid = self.users[user].uid
         if uid is None:
             return -1
         else:
@@ -93,57 +393,153 @@ class UserCache(object):
     # returns home for a username
     def get_home_4user(self, user):
         self.prepare_users(user)
-        return self.homes.get(user)
+        return self.users[user].home
+
+    # Builds the index user name -> supplementary gids from a single
+    # enumeration of all groups. Done at most once per cache TTL.
+    # The caller must hold memberships_lock.
+    def update_memberships(self):
+        start = time.time()
+        memberships = {}
+        for g in grp.getgrall():
+            for member in g.gr_mem:
+                gids = memberships.get(member)
+                if gids is None:
+                    gids = []
+                    memberships[member] = gids
+                gids.append(g.gr_gid)
+        self.memberships = memberships
+        self.memberships_timestamp = time.time()
+        self.LOG.debug("Group membership index built for %d users in %.1f ms"
+                       % (len(memberships),
+                          1000 * (self.memberships_timestamp - start)))
 
     # Establish the list of all (including supplementary) groups the user
     # is member of.
-    # The results are cached.
+    # The group membership index is refreshed if expired.
     # Arguments: user name and primary group id.
     def get_gids_4user_nc(self, user, gid):
-        all_groups = [g.gr_gid for g in
-                      filter(lambda g: user in g.gr_mem, grp.getgrall())]
+        if self.expired(self.memberships_timestamp):
+            with self.memberships_lock:
+                # another thread may have rebuilt it in the meantime
+                if self.expired(self.memberships_timestamp):
+                    self.update_memberships()
+        all_groups = list(self.memberships.get(user, []))
         all_groups.append(gid)
 
         self.LOG.debug("Established groups list for the user %s : %s" % (
             user, str(all_groups)))
         return all_groups
 
-    # Fills up all per group caches with a freshly obtained information
-    # Argument: group name
-    def update_group_info(self, group):
-        self.groups[group] = None
-        self.members[group] = None
-        self.groups_timestamps[group] = None
+    # Looks up a group, returns (gid, members) or None if unknown
+    def lookup_group(self, group):
         try:
             g = grp.getgrnam(group)
         except KeyError:
-            self.LOG.debug("Unknown group requested: %s" % group)
-            return []  # TODO is this the correct behaviour?
+            return None
+        return g.gr_gid, g.gr_mem
 
-        self.groups[group] = g.gr_gid
-        self.members[group] = g.gr_mem
-        self.groups_timestamps[group] = time.time()
+    # Looks up a user, returns (uid, gid, home, all gids) or None if unknown
+    def lookup_user(self, user):
+        try:
+            (name, _, uid, gid, _, home, _) = pwd.getpwnam(user)
+        except KeyError:
+            return None
+        return uid, gid, home, self.get_gids_4user_nc(user, gid)
+
+    # Fills up the group cache with a freshly obtained information
+    # Argument: group name
+    def update_group_info(self, group):
+        self.store_group_info(group, self.lookup_group(group))
+
+    def store_group_info(self, group, info):
+        if info is None:
+            self.LOG.debug("Unknown group requested: %s" % group)
+            self.put_entry(self.groups, group,
+                           GroupEntry(None, None, time.time()))
+            return
+        (gid, members) = info
+        entry = GroupEntry(gid, tuple(members), time.time())
+        self.put_entry(self.groups, group, entry)
         self.LOG.debug("New group information obtained for %s (%s %s)" % (
-            group, g.gr_gid, g.gr_mem))
+            group, gid, members))
+        if self.shared is not None:
+            self.shared.put_group(group, gid, members, entry.timestamp)
 
-    # Fills up all per user caches with freshly obtained information
+    # Fills up the user cache with freshly obtained information
     # Argument: user name
     def update_user_info(self, user):
-        self.uids[user] = None
-        self.gids[user] = None
-        self.homes[user] = None
-        self.all_groups[user] = None
-        self.users_timestamps[user] = None
-        try:
-            (name, _, uid, gid, _, home, _) = pwd.getpwnam(user)
-        except KeyError:
+        self.store_user_info(user, self.lookup_user(user))
+
+    def store_user_info(self, user, info):
+        if info is None:
             self.LOG.debug("No such user: %s" % user)
+            self.put_entry(self.users, user,
+                           UserEntry(None, None, None, None, time.time()))
             return
-
+        (uid, gid, home, all_groups) = info
         self.LOG.debug(
             "New user information obtained for %s (%s %s)" % (user, uid, gid))
-        self.uids[user] = uid
-        self.gids[user] = gid
-        self.homes[user] = home
-        self.all_groups[user] = self.get_gids_4user_nc(user, gid)
-        self.users_timestamps[user] = time.time()
+        entry = UserEntry(uid, gid, home, tuple(all_groups), time.time())
+        self.put_entry(self.users, user, entry)
+        if self.shared is not None:
+            self.shared.put_user(user, uid, gid, home, all_groups,
+                                 entry.timestamp)
+
+
+def _split_patterns(names):
+    """ returns the set of plain names and the list of wildcard patterns """
+    plain = set()
+    patterns = []
+    for name in names:
+        if any([c in name for c in "*?["]):
+            patterns.append(name)
+        else:
+            plain.add(name)
+    return plain, patterns
+
+
+def _matches(name, patterns):
+    for pattern in patterns:
+        if fnmatch.fnmatchcase(name, pattern):
+            return True
+    return False
+
+
+def _lookup_all(lookup, names, threads, LOG):
+    """
+    Calls lookup(name) for all names using a thread pool,
+    returns a list of (name, result) for successful lookups
+    """
+    def call(name):
+        try:
+            return name, lookup(name)
+        except Exception as e:
+            LOG.warning("Error looking up %s: %s" % (name, str(e)))
+            return name, False
+
+    names = sorted(names)
+    num_threads = min(len(names), threads)
+    if num_threads > 1:
+        pool = ThreadPool(num_threads)
+        try:
+            results = pool.map(call, names)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [call(name) for name in names]
+    return [(name, info) for (name, info) in results if info is not False]
+
+
+def _touch(table, name):
+    """ mark the entry as most recently used """
+    table[name] = table.pop(name)
+
+
+# dictionaries keep the insertion order since Python 3.7,
+# and need much less memory than an OrderedDict
+if sys.version_info >= (3, 7):
+    _lru_dict = dict
+else:
+    _lru_dict = OrderedDict
@@ -9,10 +9,16 @@ Will run validation on the output from 'cmd'
 
 where 'arg' is
  - 'qstat' (or nothing) : run qstat output conversion
+ - 'timing [N]' : parse the qstat output N times (default: 10) and report
+                  the number of lines parsed per second, e.g.
+
+  'qstat > qstat.txt'
+  'PYTHONPATH=lib python lib/Validation.py timing < qstat.txt'
 
 """
 
 import sys
+import time
 from BSS import BSS
 
 
@@ -28,8 +34,35 @@ def validate_qstat():
           "please check the BSS.py file!")
 
 
+def time_qstat(repeat=10):
+    """
+    Measures the time for running stdin through parse_status_listing()
+    'repeat' times. Raises ValueError if repeat is less than 1
+    """
+    if repeat < 1:
+        raise ValueError("Number of repetitions must be at least 1")
+    qstat = sys.stdin.read()
+    lines = len(qstat.splitlines())
+    bss = BSS()
+    start = time.time()
+    for _ in range(repeat):
+        result = bss.parse_status_listing(qstat)
+    duration = max(time.time() - start, 1e-9)
+    print("Parsed %d lines (%d jobs) %d times in %.3f seconds: "
+          "%.0f lines/sec" % (lines, result.count("\n") - 1, repeat,
+                              duration, repeat * lines / duration))
+
+
 def main(argv=None):
-    validate_qstat()
+    if argv is None:
+        argv = sys.argv
+    if len(argv) > 1 and argv[1] == "timing":
+        repeat = 10
+        if len(argv) > 2:
+            repeat = int(argv[2])
+        time_qstat(repeat)
+    else:
+        validate_qstat()
 
 
 # application entry point
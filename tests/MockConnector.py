@@ -45,6 +45,9 @@ class MockConnector(object):
             self.control_out.write(u"\n")
             self.control_out.flush()
 
+    def flush(self):
+        self.control_out.flush()
+
     def failed(self, message):
         """
         Write single line of TSI_FAILED and error message to control channel
@@ -0,0 +1,24 @@
+""" Throwaway self-signed certificate for testing SSL connections """
+
+import os
+import subprocess
+
+
+def create_certificate(directory):
+    """ Creates a key and self-signed certificate in the given directory
+    using the openssl command. Returns the SSL settings (with the
+    certificate as truststore), or None if openssl is not available
+    """
+    key = os.path.join(directory, "key.pem")
+    cert = os.path.join(directory, "cert.pem")
+    try:
+        subprocess.check_call(["openssl", "req", "-x509", "-newkey",
+                               "rsa:2048", "-nodes", "-keyout", key,
+                               "-out", cert, "-days", "1", "-subj",
+                               "/CN=TSI Test/O=UNICORE/C=EU"],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+    except (EnvironmentError, subprocess.CalledProcessError):
+        return None
+    return {'tsi.keystore': key, 'tsi.certificate': cert,
+            'tsi.truststore': cert}
@@ -0,0 +1,64 @@
+"""
+Time needed for reading and changing POSIX ACLs via extended attributes
+(native) and via the getfacl/setfacl commands.
+
+  export PYTHONPATH=lib:tests; python tests/benchmark_ACL.py [directory]
+
+The directory must be on a file system with ACL support (default: the
+temporary directory).
+"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import ACL
+from MockConnector import MockConnector
+
+CALLS = 200
+
+
+def measure(config, path, LOG):
+    connector = MockConnector(None, None, None, None, LOG)
+    start = time.time()
+    for i in range(CALLS):
+        ACL.setfacl_posix(path, "MODIFY", "U nobody r%s-" % "-w"[i % 2],
+                          connector, config, LOG)
+        ACL.getfacl_posix(path, connector, config, LOG)
+    duration = time.time() - start
+    failed = "TSI_FAILED" in connector.control_out.getvalue()
+    return 1000 * duration / (2 * CALLS), failed
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    LOG = logging.getLogger("benchmark")
+    directory = tempfile.mkdtemp(dir=argv[1] if len(argv) > 1 else None)
+    path = os.path.join(directory, "file")
+    with open(path, "w"):
+        pass
+    try:
+        for (name, native) in [("native", True), ("commands", False)]:
+            config = {'tsi.posix_acl_native': native,
+                      'tsi.getfacl_cmd': 'getfacl',
+                      'tsi.setfacl_cmd': 'setfacl'}
+            if native and not ACL.native_acl_supported(config):
+                print("%-10s not supported on this platform" % name)
+                continue
+            (millis, failed) = measure(config, path, LOG)
+            if failed:
+                print("%-10s failed (no ACL support or commands missing?)"
+                      % name)
+            else:
+                print("%-10s %8.3f ms per call" % (name, millis))
+    finally:
+        shutil.rmtree(directory)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+"""
+Memory used by the user cache for 10000 users.
+
+Compares the previous layout (one dictionary per attribute, see
+PreviousCache) with the current UserCache entries. Requires Python 3
+(tracemalloc).
+
+  export PYTHONPATH=lib; python tests/benchmark_UserCache.py
+"""
+
+import gc
+import logging
+import sys
+import time
+import tracemalloc
+
+import UserCache
+
+USERS = 10000
+
+
+# the same input for both layouts, created before measuring
+USER_INFO = [("user%d" % uid, uid, uid, "/home/user%d" % uid, [100, 200, uid])
+             for uid in range(10000, 10000 + USERS)]
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    start = time.time()
+    result = build()
+    duration = time.time() - start
+    gc.collect()
+    (size, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size, duration
+
+
+class PreviousCache(object):
+    """ the attributes and store_user_info() of the previous UserCache,
+    without logging and the shared store
+    """
+
+    def __init__(self):
+        self.all_groups = {}
+        self.groups_cache = {}
+        self.uids = {}
+        self.gids = {}
+        self.homes = {}
+        self.groups = {}
+        self.members = {}
+        self.users_timestamps = {}
+        self.groups_timestamps = {}
+        self.unknown_users = {}
+        self.unknown_groups = {}
+        self.memberships = {}
+        self.memberships_timestamp = None
+        self.refreshing = set()
+        self.refreshed = []
+
+    def store_user_info(self, user, info):
+        self.uids[user] = None
+        self.gids[user] = None
+        self.homes[user] = None
+        self.all_groups[user] = None
+        self.users_timestamps[user] = None
+        if info is None:
+            self.unknown_users[user] = time.time()
+            return
+        self.unknown_users.pop(user, None)
+        (uid, gid, home, all_groups) = info
+        self.uids[user] = uid
+        self.gids[user] = gid
+        self.homes[user] = home
+        self.all_groups[user] = all_groups
+        self.users_timestamps[user] = time.time()
+
+
+def build_dicts():
+    cache = PreviousCache()
+    for (user, uid, gid, home, groups) in USER_INFO:
+        cache.store_user_info(user, (uid, gid, home, list(groups)))
+    return cache
+
+
+def build_cache():
+    cache = UserCache.UserCache(600, logging.getLogger("benchmark"),
+                                max_entries=USERS)
+    for (user, uid, gid, home, groups) in USER_INFO:
+        cache.store_user_info(user, (uid, gid, home, groups))
+    return cache
+
+
+def main():
+    for (name, build) in [("dictionaries", build_dicts),
+                          ("UserCache", build_cache)]:
+        (_, size, duration) = measure(build)
+        print("%-14s %6d kB for %d users (%5.0f bytes/user), %.2f s" % (
+            name, size // 1024, USERS, float(size) / USERS, duration))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+import errno
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from multiprocessing.pool import ThreadPool
+
+import ACL
+import pytest
+from MockConnector import MockConnector
+from test_IO import JoiningPool
+
+pytestmark = pytest.mark.local
+
+
+def xattr_acl_supported():
+    if not hasattr(os, "getxattr") or not sys.platform.startswith("linux"):
+        return False
+    try:
+        os.getxattr(tempfile.gettempdir(), ACL.ACL_XATTR_ACCESS)
+    except OSError as e:
+        return e.errno == errno.ENODATA
+    return True
+
+
+class TestACL(unittest.TestCase):
+    def test_check_support(self):
+        acl = {"/": "NONE", "/home": "POSIX", "/mnt/apps/": "POSIX",
+               "/home/nfs": "NFS"}
+        index = ACL.ACLIndex(acl)
+        for (path, expected) in [("/tmp/x", "NONE"),
+                                 ("/home", "POSIX"),
+                                 ("/home/", "POSIX"),
+                                 ("/home/alice/file", "POSIX"),
+                                 ("/home2/alice", "NONE"),
+                                 ("/home/nfs", "NFS"),
+                                 ("/home/nfs/data/x", "NFS"),
+                                 ("/home/nfsx", "POSIX"),
+                                 ("/home/nfs/../alice", "POSIX"),
+                                 ("/mnt/apps", "POSIX"),
+                                 ("/mnt", "NONE"),
+                                 ("/", "NONE")]:
+            self.assertEqual(expected, index.lookup(path), path)
+            self.assertEqual(expected, ACL.check_support(path, acl), path)
+        # results are memoized per directory
+        self.assertTrue("/home/alice" in index.memo)
+
+    def test_no_configuration(self):
+        self.assertEqual("NONE", ACL.check_support("/home", {}))
+
+    def test_index_from_config(self):
+        config = {'tsi.acl': {"/data": "POSIX"}}
+        index = ACL.get_acl_index(config)
+        self.assertTrue(index is ACL.get_acl_index(config))
+        self.assertEqual("POSIX", index.lookup("/data/x"))
+
+
+@unittest.skipUnless(xattr_acl_supported(), "no POSIX ACL support")
+class TestNativeACL(unittest.TestCase):
+    def setUp(self):
+        self.LOG = logging.getLogger("tsi.testing")
+        self.path = tempfile.mkdtemp()
+        self.file = os.path.join(self.path, "file")
+        with open(self.file, "w"):
+            pass
+        os.chmod(self.file, 0o640)
+        os.chmod(self.path, 0o750)
+        self.config = {'tsi.posix_acl_native': True}
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def getfacl(self, path):
+        connector = MockConnector(None, None, None, None, self.LOG)
+        ACL.getfacl_posix(path, connector, self.config, self.LOG)
+        return connector.control_out.getvalue().splitlines()
+
+    def setfacl(self, path, op, val=None):
+        connector = MockConnector(None, None, None, None, self.LOG)
+        ACL.setfacl_posix(path, op, val, connector, self.config, self.LOG)
+        return connector.control_out.getvalue()
+
+    def test_encode_decode(self):
+        entries = [(ACL.ACL_OTHER, 4, ACL.ACL_UNDEFINED_ID),
+                   (ACL.ACL_USER, 7, 1000),
+                   (ACL.ACL_USER_OBJ, 6, ACL.ACL_UNDEFINED_ID)]
+        self.assertEqual(sorted(entries),
+                         ACL.decode_acl(ACL.encode_acl(entries)))
+
+    def test_getfacl_minimal(self):
+        self.assertEqual(["TSI_OK", "user::rw-", "group::r--"],
+                         self.getfacl(self.file))
+
+    def test_modify_and_remove(self):
+        self.assertEqual("TSI_OK\n", self.setfacl(self.file, "MODIFY",
+                                                  "U nobody rwx"))
+        self.assertEqual(["TSI_OK", "user::rw-", "user:nobody:rwx",
+                          "group::r--"], self.getfacl(self.file))
+        # mode group bits show the mask
+        self.assertEqual(0o670, os.stat(self.file).st_mode & 0o777)
+        self.setfacl(self.file, "MODIFY", "G  r--")
+        self.setfacl(self.file, "RM", "U nobody")
+        self.assertEqual(["TSI_OK", "user::rw-", "group::r--"],
+                         self.getfacl(self.file))
+        self.assertEqual(0o640, os.stat(self.file).st_mode & 0o777)
+        self.assertTrue("TSI_FAILED" in self.setfacl(
+            self.file, "MODIFY", "U no-such-user-here rwx"))
+
+    def test_effective_permissions(self):
+        self.setfacl(self.file, "MODIFY", "U nobody rwx")
+        os.chmod(self.file, 0o640)
+        self.assertEqual(["TSI_OK", "user::rw-",
+                          "user:nobody:rwx\t\t\t#effective:r--",
+                          "group::r--"], self.getfacl(self.file))
+
+    def test_default_acl_and_recursion(self):
+        self.setfacl(self.path, "MODIFY RECURSIVE", "DU nobody r-x")
+        self.assertEqual(["TSI_OK", "user::rwx", "group::r-x",
+                          "default:user::rwx", "default:user:nobody:r-x",
+                          "default:group::r-x"], self.getfacl(self.path))
+        # skipped for files
+        self.assertEqual(["TSI_OK", "user::rw-", "group::r--"],
+                         self.getfacl(self.file))
+        self.assertTrue("Only directories" in self.setfacl(
+            self.file, "MODIFY", "DU nobody r-x"))
+        self.setfacl(self.path, "MODIFY RECURSIVE", "G daemon rw-")
+        self.assertTrue("group:daemon:rw-" in self.getfacl(self.file))
+        self.setfacl(self.path, "RM_ALL RECURSIVE")
+        self.assertEqual(["TSI_OK", "user::rwx", "group::r-x"],
+                         self.getfacl(self.path))
+        self.assertEqual(["TSI_OK", "user::rw-", "group::r--"],
+                         self.getfacl(self.file))
+
+    def process(self, paths, op, specs):
+        message = "#TSI_ACL_OPERATION SETFACL\n#TSI_ACL_COMMAND %s\n" % op
+        for path in paths:
+            message += "#TSI_ACL_PATH %s\n" % path
+        for spec in specs:
+            message += "#TSI_ACL_COMMAND_SPEC %s\n" % spec
+        connector = MockConnector(None, None, None, None, self.LOG)
+        ACL.process_acl(message, connector, self.config, self.LOG)
+        return connector.control_out.getvalue()
+
+    def test_batch(self):
+        self.config['tsi.acl'] = {'/': 'POSIX'}
+        other = os.path.join(self.path, "other")
+        with open(other, "w"):
+            pass
+        os.chmod(other, 0o640)
+        self.assertEqual("TSI_OK\n", self.process(
+            [self.file, other], "MODIFY", ["U nobody rwx", "G daemon r--"]))
+        for path in (self.file, other):
+            self.assertEqual(["TSI_OK", "user::rw-", "user:nobody:rwx",
+                              "group::r--", "group:daemon:r--"],
+                             self.getfacl(path))
+
+    def test_batch_not_supported_for_nfs(self):
+        self.config['tsi.acl'] = {'/': 'NFS'}
+        reply = self.process([self.file, self.file + "2"], "MODIFY",
+                             ["U nobody rwx"])
+        self.assertTrue(reply.startswith("TSI_FAILED: ERROR: Batch requests "
+                                         "are not supported"))
+
+    def test_batch_reports_failed_paths(self):
+        self.config['tsi.acl'] = {'/': 'POSIX'}
+        missing = os.path.join(self.path, "missing")
+        reply = self.process([missing, self.file], "MODIFY",
+                             ["U nobody rwx"])
+        self.assertTrue(reply.startswith(
+            "TSI_FAILED: Setting ACL failed for 1 path(s): %s: " % missing))
+        self.assertTrue("user:nobody:rwx" in self.getfacl(self.file))
+
+    def test_parallel_recursion(self):
+        self.config['tsi.setfacl_threads'] = 4
+        files = []
+        for d in range(5):
+            directory = os.path.join(self.path, "dir%d" % d, "sub")
+            os.makedirs(directory)
+            for i in range(40):
+                files.append(os.path.join(directory, "file%d" % i))
+                with open(files[-1], "w"):
+                    pass
+        joined = len(JoiningPool.joined)
+        ACL.ThreadPool = JoiningPool
+        try:
+            self.assertEqual("TSI_OK\n", self.setfacl(
+                self.path, "MODIFY RECURSIVE", "U nobody r--"))
+        finally:
+            ACL.ThreadPool = ThreadPool
+        self.assertEqual(joined + 1, len(JoiningPool.joined))
+        for path in files:
+            self.assertTrue("user:nobody:r--" in self.getfacl(path))
+        self.assertTrue("user:nobody:r--" in
+                        self.getfacl(os.path.dirname(files[0])))
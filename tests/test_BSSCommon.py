@@ -0,0 +1,52 @@
+import re
+import unittest
+
+from BSSCommon import BSSBase
+import pytest
+
+pytestmark = pytest.mark.local
+
+STATES = {"R": "RUNNING", "Q": "QUEUED", "C": "COMPLETED", "S": "SUSPENDED"}
+
+
+class PatternBSS(BSSBase):
+    qstat_pattern = re.compile(
+        r"(?P<bssid>\d+)\s+(?P<state>\w)(?:\s+(?P<queue>\S+))?$")
+
+    def create_submit_script(self, message, config, LOG):
+        return []
+
+    def convert_status(self, bss_state):
+        return STATES.get(bss_state, "UNKNOWN")
+
+
+class LineBSS(PatternBSS):
+    qstat_pattern = None
+
+    def extract_info(self, qstat_line):
+        m = PatternBSS.qstat_pattern.match(qstat_line)
+        if m is None:
+            return None, None, None
+        return m.group("bssid", "state", "queue")
+
+
+class TestBSSCommon(unittest.TestCase):
+
+    qstat = "\n".join(["JOBID STATE QUEUE",
+                       "1 Q batch",
+                       "2 R",
+                       "1 R batch",
+                       "1 C batch",
+                       "3 X batch",
+                       "3 S batch",
+                       ""])
+
+    def test_parse_status_listing(self):
+        for bss in (PatternBSS(), LineBSS()):
+            result = bss.parse_status_listing(self.qstat).splitlines()
+            self.assertEqual("QSTAT", result[0])
+            self.assertEqual([" 1 RUNNING batch", " 2 RUNNING None",
+                              " 3 SUSPENDED batch"], sorted(result[1:]))
+
+    def test_parse_empty_listing(self):
+        self.assertEqual("QSTAT\n", PatternBSS().parse_status_listing(""))
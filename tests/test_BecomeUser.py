@@ -0,0 +1,100 @@
+import logging
+import os
+import unittest
+
+import BecomeUser
+import UserCache
+import pytest
+from test_UserCache import FakeGrp, FakePwd, Group
+
+pytestmark = pytest.mark.local
+
+
+class FakeOs(object):
+    """ replaces the os module, recording the identity changes """
+
+    def __init__(self):
+        self.uid = self.gid = 0
+        self.groups = [0]
+        self.environ = {}
+
+    def setgid(self, gid):
+        self.gid = gid
+
+    setegid = setgid
+
+    def setgroups(self, gids):
+        self.groups = list(gids)
+
+    def setresuid(self, ruid, euid, suid):
+        self.uid = ruid
+
+    def getuid(self):
+        return self.uid
+
+    geteuid = getuid
+
+    def getgid(self):
+        return self.gid
+
+    getegid = getgid
+
+    def getgroups(self):
+        return self.groups
+
+
+class TestBecomeUser(unittest.TestCase):
+    def setUp(self):
+        self.LOG = logging.getLogger("tsi.testing")
+        self.grp = UserCache.grp
+        self.pwd = UserCache.pwd
+        UserCache.grp = FakeGrp([Group("users", "x", 100, ["alice"]),
+                                 Group("hpc", "x", 200, ["alice"]),
+                                 Group("other", "x", 300, [])])
+        UserCache.pwd = FakePwd()
+        self.config = {'tsi.enforce_os_gids': True,
+                       'tsi.fail_on_invalid_gids': False,
+                       'tsi.user_cache': UserCache.UserCache(600, self.LOG)}
+
+    def tearDown(self):
+        UserCache.grp = self.grp
+        UserCache.pwd = self.pwd
+        BecomeUser.os = os
+
+    def resolve(self, groups):
+        return BecomeUser.resolve_identity("alice", groups, self.config,
+                                           self.LOG)
+
+    def test_resolve_identity(self):
+        self.assertEqual((1000, 1000, [100, 200, 1000], "/home/alice"),
+                         self.resolve(["NONE"]))
+        (uid, gid, gids, home) = self.resolve(["hpc", "users"])
+        self.assertEqual(200, gid)
+        self.assertEqual(set([100, 200]), set(gids))
+        # not a member: default group is used
+        (uid, gid, gids, home) = self.resolve(["other"])
+        self.assertEqual(1000, gid)
+        self.config['tsi.fail_on_invalid_gids'] = True
+        self.assertTrue("not a member" in self.resolve(["other"]))
+        self.assertTrue("unknown" in BecomeUser.resolve_identity(
+            "bob", ["NONE"], self.config, self.LOG))
+
+    def test_become_user_memo(self):
+        BecomeUser.os = FakeOs()
+        self.config['tsi.effective_uid'] = 0
+        self.config['tsi.switch_uid'] = True
+        self.assertEqual(True, BecomeUser.become_user(
+            "alice", ["hpc"], self.config, self.LOG))
+        self.assertEqual((1000, 200), (BecomeUser.os.uid, BecomeUser.os.gid))
+        self.assertEqual("/home/alice", BecomeUser.os.environ['HOME'])
+        lookups = UserCache.pwd.lookups
+        self.assertTrue(lookups > 0)
+        # the resolved identity is reused, without looking up the user
+        BecomeUser.os = FakeOs()
+        self.assertEqual(True, BecomeUser.become_user(
+            "alice", ["hpc"], self.config, self.LOG))
+        self.assertEqual((1000, 200), (BecomeUser.os.uid, BecomeUser.os.gid))
+        self.assertEqual(lookups, UserCache.pwd.lookups)
+        self.assertEqual((1000, 200, [200], "/home/alice"),
+                         self.config['tsi.user_cache'].get_identity(
+                             "alice", ["hpc"]))
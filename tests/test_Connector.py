@@ -0,0 +1,131 @@
+import logging
+import socket
+import threading
+import time
+import unittest
+
+import Connector
+import pytest
+
+pytestmark = pytest.mark.local
+
+
+class RecordingReader(object):
+    """ records the size limits passed to readline() """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.sizes = []
+
+    def readline(self, size=-1):
+        self.sizes.append(size)
+        return self.stream.readline(size)
+
+
+class TestConnector(unittest.TestCase):
+    def setUp(self):
+        self.LOG = logging.getLogger("tsi.testing")
+        (self.command, self.xnjs_command) = socket.socketpair()
+        (self.data, self.xnjs_data) = socket.socketpair()
+        self.connector = Connector.Connector(self.command, self.data, self.LOG)
+
+    def tearDown(self):
+        self.connector.close()
+        self.xnjs_command.close()
+        self.xnjs_data.close()
+
+    def receive(self):
+        self.xnjs_command.settimeout(1)
+        return self.xnjs_command.recv(65536).decode("utf-8")
+
+    def test_buffered_reply(self):
+        self.connector.ok()
+        for i in range(100):
+            self.connector.write_message("line %d" % i)
+        self.connector.failed(u"some\nerror \u00e4")
+        self.xnjs_command.setblocking(False)
+        self.assertRaises(socket.error, self.xnjs_command.recv, 1024)
+        self.connector.flush()
+        expected = "TSI_OK\n" + "".join(["line %d\n" % i for i in range(100)])
+        expected += u"TSI_FAILED: some:error \u00e4\n"
+        self.assertEqual(expected, self.receive())
+
+    def test_large_reply_is_sent_in_parts(self):
+        self.connector.max_reply_size = 100
+        for i in range(10):
+            self.connector.write_message("x" * 20)
+        self.assertTrue(len(self.receive()) > 100)
+
+    def test_read_message(self):
+        script = u"#!/bin/bash\n#TSI_SUBMIT\necho \u00e4\n" * 1000
+        self.xnjs_command.sendall(
+            (script + u"ENDOFMESSAGE\n#TSI_PING\nENDOFMESSAGE\n")
+            .encode("utf-8"))
+        message = self.connector.read_message()
+        if not isinstance(message, type(u"")):
+            message = message.decode("utf-8")
+        self.assertEqual(script, message)
+        self.assertEqual("#TSI_PING\n", self.connector.read_message())
+
+    def test_read_message_too_large(self):
+        self.connector.max_message_size = 100
+        self.xnjs_command.sendall(
+            b"x" * 200 + b"\nENDOFMESSAGE\n#TSI_PING\nENDOFMESSAGE\n")
+        self.assertRaises(ValueError, self.connector.read_message)
+        self.assertEqual("#TSI_PING\n", self.connector.read_message())
+
+    def test_read_message_long_line(self):
+        self.connector.max_message_size = 100
+        control_in = RecordingReader(self.connector.control_in)
+        self.connector.control_in = control_in
+        # a split line must not be mistaken for the end of the message
+        sender = threading.Thread(target=self.xnjs_command.sendall, args=(
+            b"x" * 65530 + b"ENDOFMESSAGE\n" + b"x" * 200000 +
+            b"\nENDOFMESSAGE\n#TSI_PING\nENDOFMESSAGE\n",))
+        sender.start()
+        self.assertRaises(ValueError, self.connector.read_message)
+        sender.join()
+        self.assertTrue(0 < max(control_in.sizes) <= 65536)
+        self.assertEqual("#TSI_PING\n", self.connector.read_message())
+
+    def test_read_message_closed(self):
+        self.xnjs_command.sendall(b"#TSI_PING\n")
+        self.xnjs_command.close()
+        self.assertRaises(IOError, self.connector.read_message)
+
+    def test_data_buffer_size(self):
+        connector = Connector.create_connector(
+            self.command, self.data, {'tsi.data_buffer_size': 4096,
+                                      'tsi.max_message_size': 1000},
+            self.LOG)
+        self.assertEqual(1000, connector.max_message_size)
+        self.xnjs_data.sendall(b"x" * 100000)
+        self.assertEqual(4096, len(connector.read_data(100000)))
+        if hasattr(connector.data_in, "peek"):
+            # the buffered stream reads at most the buffer size at once
+            self.assertTrue(len(connector.data_in.peek(1)) <= 4096)
+        # the default is the one documented in the configuration
+        default = Connector.create_connector(self.command, self.data, {},
+                                             self.LOG)
+        self.assertEqual(262144, default.buf_size)
+
+    def test_stop_reading(self):
+        errors = []
+
+        def read():
+            try:
+                self.connector.read_message()
+            except IOError as e:
+                errors.append(e)
+        reader = threading.Thread(target=read)
+        reader.daemon = True
+        reader.start()
+        time.sleep(0.2)
+        self.connector.stop_reading()
+        reader.join(2)
+        self.assertFalse(reader.is_alive())
+        self.assertEqual(1, len(errors))
+        # replies can still be sent
+        self.connector.ok()
+        self.connector.flush()
+        self.assertEqual("TSI_OK\n", self.receive())
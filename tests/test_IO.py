@@ -0,0 +1,363 @@
+import hashlib
+import io
+import logging
+import os
+import re
+import shutil
+import struct
+import tarfile
+import tempfile
+import unittest
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import IO
+from MockConnector import MockConnector
+import pytest
+
+pytestmark = pytest.mark.local
+
+
+class JoiningPool(ThreadPool):
+    """ ThreadPool recording the pools that were joined """
+
+    joined = []
+
+    def join(self):
+        ThreadPool.join(self)
+        JoiningPool.joined.append(self)
+
+
+class TestIO(unittest.TestCase):
+    def setUp(self):
+        self.LOG = logging.getLogger("tsi.testing")
+        self.path = tempfile.mkdtemp()
+        for var in ['HOME', 'USER', 'LOGNAME']:
+            os.environ.setdefault(var, 'nobody')
+        IO._df_cache.clear()
+        IO._quota_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_df(self):
+        config = {}
+        msg = "#TSI_DF\n#TSI_FILE %s\n" % self.path
+        connector = MockConnector(None, None, None, None, self.LOG)
+        IO.df(msg, connector, config, self.LOG)
+        lines = connector.control_out.getvalue().splitlines()
+        self.assertEqual("START_DF", lines[0])
+        total = int(lines[1].split(" ")[1])
+        free = int(lines[2].split(" ")[1])
+        self.assertTrue(total >= free > 0)
+        self.assertEqual("USER -1", lines[3])
+        self.assertEqual("END_DF", lines[4])
+        self.assertEqual(1, len(IO._df_cache))
+
+    def test_df_cached(self):
+        config = {'tsi.df_cache_ttl': 3600}
+        device = os.stat(self.path).st_dev
+        IO._df_cache[device] = (0, (1000, 500))
+        self.assertNotEqual((device, 1000, 500),
+                            IO.get_fs_info(self.path, config))
+        IO._df_cache[device] = (float("inf"), (1000, 500))
+        self.assertEqual((device, 1000, 500),
+                         IO.get_fs_info(self.path, config))
+
+    def test_df_quota(self):
+        config = {'tsi.quota_cmd': 'echo 12345 #'}
+        msg = "#TSI_DF\n#TSI_FILE %s\n" % self.path
+        connector = MockConnector(None, None, None, None, self.LOG)
+        IO.df(msg, connector, config, self.LOG)
+        self.assertTrue("USER 12345\n" in connector.control_out.getvalue())
+        # cached value is used
+        config['tsi.quota_cmd'] = 'echo 0 #'
+        connector = MockConnector(None, None, None, None, self.LOG)
+        IO.df(msg, connector, config, self.LOG)
+        self.assertTrue("USER 12345\n" in connector.control_out.getvalue())
+
+    def test_quota_path_is_quoted(self):
+        path = os.path.join(self.path, "it's; echo 999 #")
+        os.mkdir(path)
+        config = {'tsi.quota_cmd': "sh -c 'test -d \"$0\" && echo 777'"}
+        self.assertEqual(777, IO.get_user_quota(path, 1, config, self.LOG))
+
+    def test_df_missing_path(self):
+        msg = "#TSI_DF\n#TSI_FILE %s/nonexistent\n" % self.path
+        connector = MockConnector(None, None, None, None, self.LOG)
+        IO.df(msg, connector, {}, self.LOG)
+        self.assertTrue(connector.control_out.getvalue().startswith(
+            "TSI_FAILED"))
+
+    def test_checksum(self):
+        data = b"some test data\n" * 1000
+        files = []
+        for i in range(3):
+            name = os.path.join(self.path, "file%d" % i)
+            with open(name, "wb") as f:
+                f.write(data[i:])
+            files.append(name)
+        config = {'tsi.checksum_block_size': 4096}
+        msg = "#TSI_FILE_CHECKSUM\n#TSI_CHECKSUM_ALGORITHM SHA-256\n"
+        msg += "".join(["#TSI_FILE %s\n" % f for f in files])
+        connector = MockConnector(None, None, None, None, self.LOG)
+        joined = len(JoiningPool.joined)
+        IO.ThreadPool = JoiningPool
+        try:
+            IO.checksum(msg, connector, config, self.LOG)
+        finally:
+            IO.ThreadPool = ThreadPool
+        # the pool's threads are finished when the request returns
+        self.assertEqual(joined + 1, len(JoiningPool.joined))
+        lines = connector.control_out.getvalue().splitlines()
+        self.assertEqual("TSI_OK", lines[0])
+        for i in range(3):
+            expected = hashlib.sha256(data[i:]).hexdigest()
+            self.assertEqual("%s %s" % (expected, files[i]), lines[i + 1])
+
+    def test_checksum_range(self):
+        data = b"0123456789" * 1000
+        name = os.path.join(self.path, "file")
+        with open(name, "wb") as f:
+            f.write(data)
+        for algorithm in ["MD5", "ADLER32", "CRC32"]:
+            digest = IO.compute_checksum(name, algorithm, 7, 5000, 4096)
+            if algorithm == "MD5":
+                expected = hashlib.md5(data[7:5007]).hexdigest()
+            elif algorithm == "ADLER32":
+                expected = "%08x" % (zlib.adler32(data[7:5007]) & 0xffffffff)
+            else:
+                expected = "%08x" % (zlib.crc32(data[7:5007]) & 0xffffffff)
+            self.assertEqual(expected, digest)
+
+    def test_checksum_errors(self):
+        msg = "#TSI_FILE_CHECKSUM\n#TSI_CHECKSUM_ALGORITHM FOO\n" \
+              "#TSI_FILE %s\n" % self.path
+        connector = MockConnector(None, None, None, None, self.LOG)
+        IO.checksum(msg, connector, {}, self.LOG)
+        self.assertTrue(connector.control_out.getvalue().startswith(
+            "TSI_FAILED"))
+        msg = "#TSI_FILE_CHECKSUM\n#TSI_FILE %s/nonexistent\n" % self.path
+        connector = MockConnector(None, None, None, None, self.LOG)
+        IO.checksum(msg, connector, {}, self.LOG)
+        self.assertTrue(connector.control_out.getvalue().startswith(
+            "TSI_FAILED"))
+
+    def test_archive(self):
+        source = os.path.join(self.path, "source")
+        os.makedirs(os.path.join(source, "sub"))
+        for i in range(50):
+            with open(os.path.join(source, "sub", "f%d" % i), "w") as f:
+                f.write("content %d\n" % i * 100)
+        for compression in ["none", "gz", "bz2"]:
+            msg = "#TSI_GET_ARCHIVE\n#TSI_FILE %s\n" \
+                  "#TSI_ARCHIVE_COMPRESSION %s\n" % (source, compression)
+            connector = MockConnector(None, None, None, None, self.LOG)
+            connector.buf_size = 1024
+            IO.get_archive(msg, connector, {}, self.LOG)
+            reply = connector.control_out.getvalue()
+            self.assertTrue(reply.startswith("TSI_OK\nENDOFMESSAGE\n"))
+            self.assertTrue("TSI_LENGTH " in reply)
+
+            target = os.path.join(self.path, "target-" + compression)
+            msg = "#TSI_PUT_ARCHIVE\n#TSI_FILE %s\n" % target
+            data_in = io.BytesIO(connector.data_out.getvalue())
+            connector = MockConnector(None, None, data_in, None, self.LOG)
+            IO.put_archive(msg, connector, {}, self.LOG)
+            self.assertEqual("TSI_OK\nENDOFMESSAGE\n",
+                             connector.control_out.getvalue())
+            self.assertEqual(data_in.tell(), len(data_in.getvalue()))
+            for i in range(50):
+                name = os.path.join(target, "source", "sub", "f%d" % i)
+                with open(name) as f:
+                    self.assertEqual("content %d\n" % i * 100, f.read())
+
+    def test_archive_unsafe_entries(self):
+        buf = io.BytesIO()
+        tar = tarfile.open(fileobj=buf, mode="w")
+        info = tarfile.TarInfo("../evil")
+        tar.addfile(info, io.BytesIO(b""))
+        info = tarfile.TarInfo("link")
+        info.type = tarfile.SYMTYPE
+        info.linkname = "/etc/passwd"
+        tar.addfile(info)
+        info = tarfile.TarInfo("good")
+        info.size = 4
+        tar.addfile(info, io.BytesIO(b"good"))
+        tar.close()
+        data = buf.getvalue()
+        stream = struct.pack("!Q", len(data)) + data + struct.pack("!Q", 0)
+
+        target = os.path.join(self.path, "target")
+        msg = "#TSI_PUT_ARCHIVE\n#TSI_FILE %s\n" % target
+        connector = MockConnector(None, None, io.BytesIO(stream), None,
+                                  self.LOG)
+        IO.put_archive(msg, connector, {}, self.LOG)
+        reply = connector.control_out.getvalue()
+        self.assertTrue("TSI_FAILED" in reply)
+        self.assertTrue("../evil" in reply and "link" in reply)
+        self.assertEqual(["good"], os.listdir(target))
+        self.assertFalse(os.path.exists(os.path.join(self.path, "evil")))
+
+    def test_archive_symlink_chain(self):
+        buf = io.BytesIO()
+        tar = tarfile.open(fileobj=buf, mode="w")
+        for (name, linkname) in [("l1", "."), ("l1/l2", ".."),
+                                 ("l1/l2/l3", "target")]:
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.SYMTYPE
+            info.linkname = linkname
+            tar.addfile(info)
+        info = tarfile.TarInfo("l1/l2/evil")
+        info.size = 4
+        tar.addfile(info, io.BytesIO(b"evil"))
+        tar.close()
+        data = buf.getvalue()
+        stream = struct.pack("!Q", len(data)) + data + struct.pack("!Q", 0)
+
+        target = os.path.join(self.path, "target")
+        msg = "#TSI_PUT_ARCHIVE\n#TSI_FILE %s\n" % target
+        connector = MockConnector(None, None, io.BytesIO(stream), None,
+                                  self.LOG)
+        # check without the extraction filter of newer Python versions
+        data_filter = getattr(tarfile, "data_filter", None)
+        if data_filter is not None:
+            del tarfile.data_filter
+        try:
+            IO.put_archive(msg, connector, {}, self.LOG)
+        finally:
+            if data_filter is not None:
+                tarfile.data_filter = data_filter
+        reply = connector.control_out.getvalue()
+        self.assertTrue("TSI_FAILED" in reply and "l1/l2" in reply)
+        self.assertEqual(["target"], os.listdir(self.path))
+        self.assertTrue(os.path.islink(os.path.join(target, "l1")))
+
+    def test_get_file_chunk(self):
+        data = os.urandom(100000)
+        name = os.path.join(self.path, "file")
+        with open(name, "wb") as f:
+            f.write(data)
+        msg = "#TSI_GETFILECHUNK\n#TSI_FILE %s\n#TSI_START 10\n" \
+              "#TSI_LENGTH 200000\n" % name
+        connector = MockConnector(None, None, None, None, self.LOG)
+        IO.get_file_chunk(msg, connector, {}, self.LOG)
+        self.assertEqual("TSI_OK\nTSI_LENGTH 99990\nENDOFMESSAGE\n",
+                         connector.control_out.getvalue())
+        self.assertEqual(data[10:], connector.data_out.getvalue())
+
+    def test_compressed_file_chunks(self):
+        text = b"some highly compressible text\n" * 10000
+        name = os.path.join(self.path, "file")
+        msg = "#TSI_PUTFILECHUNK\n#TSI_FILE %s 644\n#TSI_LENGTH %d\n" \
+              "#TSI_COMPRESSION zlib\n"
+        compressed = zlib.compress(text)
+        connector = MockConnector(None, None, io.BytesIO(compressed), None,
+                                  self.LOG)
+        IO.put_file_chunk(msg % (name, len(compressed)), connector, {},
+                          self.LOG)
+        self.assertEqual("TSI_OK\nENDOFMESSAGE\nTSI_LENGTH %d\n"
+                         "TSI_RAW_LENGTH %d\n" % (len(compressed), len(text)),
+                         connector.control_out.getvalue())
+        with open(name, "rb") as f:
+            self.assertEqual(text, f.read())
+
+        msg = "#TSI_GETFILECHUNK\n#TSI_FILE %s\n#TSI_START 0\n" \
+              "#TSI_LENGTH %d\n#TSI_COMPRESSION zlib:1\n" % (name, len(text))
+        connector = MockConnector(None, None, None, None, self.LOG)
+        IO.get_file_chunk(msg, connector, {}, self.LOG)
+        lines = connector.control_out.getvalue().splitlines()
+        sent = connector.data_out.getvalue()
+        self.assertEqual("TSI_LENGTH %d" % len(sent), lines[1])
+        self.assertEqual("TSI_RAW_LENGTH %d" % len(text), lines[2])
+        self.assertEqual("TSI_COMPRESSION zlib", lines[3])
+        self.assertEqual(text, zlib.decompress(sent))
+
+    def test_decompression_is_bounded(self):
+        compressed = zlib.compress(b"\0" * 10000000)
+        connector = MockConnector(None, None, io.BytesIO(compressed), None,
+                                  self.LOG)
+        pieces = list(IO._read_data(connector, len(compressed),
+                                    zlib.decompressobj(), 65536))
+        self.assertTrue(max([len(p) for p in pieces]) <= 65536)
+        self.assertEqual(10000000, sum([len(p) for p in pieces]))
+
+        name = os.path.join(self.path, "file")
+        msg = "#TSI_PUTFILECHUNK\n#TSI_FILE %s 644\n#TSI_LENGTH %d\n" \
+              "#TSI_COMPRESSION zlib\n" % (name, len(compressed))
+        connector = MockConnector(None, None, io.BytesIO(compressed), None,
+                                  self.LOG)
+        IO.put_file_chunk(msg, connector, {'tsi.write_buffer_size': 65536},
+                          self.LOG)
+        self.assertEqual(10000000, os.path.getsize(name))
+
+    def test_incompressible_file_chunk(self):
+        data = os.urandom(300000)
+        name = os.path.join(self.path, "file")
+        with open(name, "wb") as f:
+            f.write(data)
+        msg = "#TSI_GETFILECHUNK\n#TSI_FILE %s\n#TSI_START 0\n" \
+              "#TSI_LENGTH %d\n#TSI_COMPRESSION zlib\n" % (name, len(data))
+        connector = MockConnector(None, None, None, None, self.LOG)
+        IO.get_file_chunk(msg, connector, {}, self.LOG)
+        self.assertTrue("TSI_COMPRESSION none\n" in
+                        connector.control_out.getvalue())
+        self.assertEqual(data, connector.data_out.getvalue())
+
+    def test_sparse_file_chunks(self):
+        block = os.statvfs(self.path).f_bsize
+        data = b"x" * block + b"\0" * (64 * block) + b"y" * 10 \
+            + b"\0" * (4 * block)
+        name = os.path.join(self.path, "file")
+        msg = "#TSI_PUTFILECHUNK\n#TSI_FILE %s 644\n#TSI_LENGTH %d\n" \
+              "#TSI_SPARSE true\n" % (name, len(data))
+        connector = MockConnector(None, None, io.BytesIO(data), None,
+                                  self.LOG)
+        IO.put_file_chunk(msg, connector, {}, self.LOG)
+        with open(name, "rb") as f:
+            self.assertEqual(data, f.read())
+        st = os.stat(name)
+        self.assertEqual(len(data), st.st_size)
+        # some file systems (e.g. tmpfs) might not support holes
+        holes_supported = st.st_blocks * 512 < len(data)
+
+        msg = "#TSI_GETFILECHUNK\n#TSI_FILE %s\n#TSI_START 0\n" \
+              "#TSI_LENGTH %d\n#TSI_SPARSE true\n" % (name, len(data) + 100)
+        connector = MockConnector(None, None, None, None, self.LOG)
+        IO.get_file_chunk(msg, connector, {}, self.LOG)
+        reply = connector.control_out.getvalue()
+        sent = connector.data_out.getvalue()
+        self.assertTrue("TSI_SPARSE_LENGTH %d\n" % len(data) in reply)
+        extents = re.search(r"^TSI_EXTENTS (.*)$", reply, re.M).group(1)
+        # reconstruct the file from the extents
+        result = bytearray(len(data))
+        pos = 0
+        for extent in extents.split(","):
+            (offset, length) = [int(x) for x in extent.split(":")]
+            result[offset:offset + length] = sent[pos:pos + length]
+            pos += length
+        self.assertEqual(pos, len(sent))
+        self.assertEqual(data, bytes(result))
+        if holes_supported and hasattr(os, "SEEK_DATA"):
+            self.assertTrue(len(sent) < 3 * block)
+
+    def test_put_file_chunk_preallocate_and_sync(self):
+        data = os.urandom(100000)
+        name = os.path.join(self.path, "file")
+        msg = "#TSI_PUTFILECHUNK\n#TSI_FILE %s 600\n#TSI_LENGTH %d\n" % (
+            name, len(data))
+        for policy in ["none", "end", "periodic"]:
+            config = {'tsi.preallocate': True, 'tsi.file_sync': policy,
+                      'tsi.file_sync_interval': 30000,
+                      'tsi.write_buffer_size': 20000}
+            connector = MockConnector(None, None, io.BytesIO(data), None,
+                                      self.LOG)
+            IO.put_file_chunk(msg, connector, config, self.LOG)
+            with open(name, "rb") as f:
+                self.assertEqual(data, f.read())
+        # data stream ends early: preallocated space is not kept
+        connector = MockConnector(None, None, io.BytesIO(data[:500]), None,
+                                  self.LOG)
+        self.assertRaises(IOError, IO.put_file_chunk, msg, connector,
+                          {}, self.LOG)
+        self.assertTrue(os.path.getsize(name) <= 500)
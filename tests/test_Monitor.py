@@ -0,0 +1,150 @@
+import logging
+import os
+import select
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import Monitor
+import SSL
+import pytest
+
+pytestmark = pytest.mark.local
+
+
+class TestMonitor(unittest.TestCase):
+    def setUp(self):
+        self.LOG = logging.getLogger("tsi.testing")
+        self.path = tempfile.mkdtemp()
+        self.config = {'tsi.control_socket':
+                       os.path.join(self.path, "control.sock")}
+        self.monitor = Monitor.Monitor(self.config, self.LOG)
+
+    def tearDown(self):
+        self.monitor.close()
+        shutil.rmtree(self.path)
+
+    def test_histogram(self):
+        h = Monitor.Histogram()
+        for millis in [0.5, 1, 3, 70000]:
+            h.add(millis)
+        d = h.to_dict()
+        self.assertEqual(4, d["count"])
+        self.assertEqual(70000, d["max_ms"])
+        self.assertEqual({"<=1": 2, "<=5": 1, ">60000": 1}, d["buckets"])
+
+    def test_worker_events(self):
+        pid = os.getpid()
+        self.monitor.worker_forked(pid, 1, "127.0.0.1")
+        self.monitor.record("accept", 2.0)
+        self.monitor.report("setup", handshake_ms=3.0, setup_ms=1003.0)
+        self.monitor.report("begin", command="TSI_LS", user="alice")
+        for _ in range(2):
+            self.monitor.handle(self.monitor.events_in)
+        status = self.monitor.status()
+        self.assertEqual("TSI_LS", status["workers"][0]["command"])
+        self.assertEqual("alice", status["workers"][0]["user"])
+        self.assertTrue("busy_s" in status["workers"][0])
+        self.assertEqual(1, status["latency"]["handshake"]["count"])
+        self.assertEqual(1, status["latency"]["setup"]["count"])
+        self.assertEqual(1, status["latency"]["accept"]["count"])
+
+        self.monitor.report("end", command="TSI_LS", duration_ms=12.0)
+        self.monitor.handle(self.monitor.events_in)
+        status = self.monitor.status()
+        self.assertEqual(None, status["workers"][0]["command"])
+        self.assertEqual(1, status["workers"][0]["requests"])
+        self.assertEqual(12.0, status["latency"]["command:TSI_LS"]["max_ms"])
+
+        self.monitor.worker_exited(pid)
+        self.assertEqual([], self.monitor.status()["workers"])
+
+    def test_verified_fingerprints(self):
+        SSL._verified_fingerprints.clear()
+        try:
+            self.monitor.report("verified", fingerprint="0123abcd")
+            self.monitor.handle(self.monitor.events_in)
+            self.assertEqual(set(["0123abcd"]), SSL._verified_fingerprints)
+        finally:
+            SSL._verified_fingerprints.clear()
+
+    def serve(self, thread, timeout=5):
+        """ handle the monitor's sockets (like the shepherd does) until
+        the given thread is finished
+        """
+        deadline = time.time() + timeout
+        while thread.is_alive() and time.time() < deadline:
+            (readable, writable, _) = select.select(
+                self.monitor.sockets(), self.monitor.writers(), [], 0.1)
+            for sock in readable + writable:
+                self.monitor.handle(sock)
+            self.monitor.expire()
+        thread.join(1)
+
+    def query(self, request="status"):
+        replies = []
+        thread = threading.Thread(target=lambda: replies.append(
+            Monitor.query(self.config['tsi.control_socket'], request)))
+        thread.daemon = True
+        thread.start()
+        self.serve(thread)
+        return replies[0]
+
+    def test_query(self):
+        self.monitor.worker_forked(1234, 1, "127.0.0.1")
+        status = self.query()
+        self.assertEqual(os.getpid(), status["pid"])
+        self.assertEqual(1234, status["workers"][0]["pid"])
+        self.assertTrue("Unknown request" in self.query("foo")["error"])
+        self.assertEqual([self.monitor.events_in, self.monitor.control],
+                         self.monitor.sockets())
+
+    def test_silent_client(self):
+        # a client that does not send its request does not block others
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(self.config['tsi.control_socket'])
+            start = time.time()
+            self.assertTrue("pid" in self.query())
+            self.assertTrue(time.time() - start < 2)
+            self.assertEqual(1, len(self.monitor.clients))
+        finally:
+            client.close()
+
+    def test_large_reply(self):
+        # the reply does not fit into the socket buffer
+        for pid in range(20000):
+            self.monitor.worker_forked(pid, pid, "127.0.0.1")
+        self.assertEqual(20000, len(self.query()["workers"]))
+        self.assertEqual({}, self.monitor.replies)
+
+    def test_client_timeout(self):
+        self.monitor.client_timeout = 0.2
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(self.config['tsi.control_socket'])
+            client.settimeout(2)
+            self.monitor.handle(self.monitor.control)
+            self.assertEqual(0.5, self.monitor.timeout())
+            time.sleep(0.3)
+            self.monitor.expire()
+            self.assertEqual(b"", client.recv(1))
+            self.assertEqual(None, self.monitor.timeout())
+        finally:
+            client.close()
+
+    def test_report_does_not_block(self):
+        # nobody reads the events
+        start = time.time()
+        for _ in range(10000):
+            self.monitor.report("drain")
+        self.assertTrue(time.time() - start < 5)
+
+    def test_close_removes_control_socket(self):
+        path = self.config['tsi.control_socket']
+        self.assertTrue(os.path.exists(path))
+        self.monitor.close()
+        self.assertFalse(os.path.exists(path))
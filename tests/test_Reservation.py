@@ -0,0 +1,177 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import Reservation
+import pytest
+from MockConnector import MockConnector
+
+pytestmark = pytest.mark.local
+
+
+class FakeNuvla(Reservation.NuvlaClient):
+    """ local replacement for Nuvla, deployments are started by
+    calling provision()
+    """
+
+    def __init__(self, username="alice"):
+        self.username = username
+        self.states = {}
+        self.parameters = {}
+        self.deployed = []
+        self.fail = False
+
+    def deploy(self, app, parameters):
+        if self.fail:
+            raise RuntimeError("Nuvla not available")
+        duid = "dpl-%d" % len(self.deployed)
+        self.deployed.append((app, parameters))
+        self.states[duid] = "initializing"
+        self.parameters[duid] = {}
+        return duid
+
+    def provision(self):
+        for duid in self.states:
+            if self.states[duid] == "initializing":
+                self.states[duid] = "executing"
+
+    def get_state(self, duid):
+        return self.states[duid]
+
+    def set_parameter(self, duid, name, value):
+        self.parameters[duid][name] = value
+
+    def terminate(self, duid):
+        self.states[duid] = "cancelled"
+
+
+class TestReservation(unittest.TestCase):
+    def setUp(self):
+        self.LOG = logging.getLogger("tsi.testing")
+        self.path = tempfile.mkdtemp()
+        self.config = {'tsi.nuvla_pool_file':
+                       os.path.join(self.path, "pool.db"),
+                       'tsi.nuvla_pool_size': 0}
+        self.nuvla = FakeNuvla()
+        self.nuvla_request = Reservation.nuvla_request
+        Reservation.nuvla_request = lambda message: (self.nuvla,
+                                                     {"compute": {"a": "1"}})
+
+    def tearDown(self):
+        Reservation.nuvla_request = self.nuvla_request
+        shutil.rmtree(self.path)
+
+    def request(self, function, message):
+        connector = MockConnector(None, None, None, None, self.LOG)
+        function(message, connector, self.config, self.LOG)
+        return connector.control_out.getvalue().splitlines()
+
+    def submit(self, app="app/1", parameters=None):
+        if parameters is None:
+            parameters = {"compute": {"a": "1"}}
+        job_parameters = {"compute": {"a": "1", "userspace-endpoint": "s3"}}
+        return Reservation.deploy_job(self.nuvla, app, parameters,
+                                      job_parameters, self.config, self.LOG)
+
+    def test_no_pool(self):
+        del self.config['tsi.nuvla_pool_file']
+        self.assertEqual("dpl-0", self.submit())
+        self.assertEqual("TSI_FAILED: Reservation not supported!",
+                         self.request(Reservation.make_reservation,
+                                      "#TSI_RESERVATION_APPLICATION app/1\n"
+                                      )[0])
+
+    def test_configured_pool(self):
+        self.config['tsi.nuvla_pool_size'] = 2
+        # nothing ready: new deployment, pool is filled
+        self.assertEqual("dpl-0", self.submit())
+        self.assertEqual(3, len(self.nuvla.deployed))
+        self.assertEqual({"compute": {"a": "1"}}, self.nuvla.deployed[1][1])
+        self.assertEqual("dpl-3", self.submit())
+        self.assertEqual(4, len(self.nuvla.deployed))
+        # claimed after provisioning, and refilled
+        self.nuvla.provision()
+        self.assertEqual("dpl-1", self.submit())
+        self.assertEqual({"compute.1:userspace-endpoint": "s3"},
+                         self.nuvla.parameters["dpl-1"])
+        self.assertEqual(5, len(self.nuvla.deployed))
+        # other parameters use another pool
+        self.assertEqual("dpl-5", self.submit(parameters={}))
+
+    def test_failed_deployments_are_removed(self):
+        self.config['tsi.nuvla_pool_size'] = 1
+        self.submit()
+        self.nuvla.states["dpl-1"] = "aborted"
+        self.assertEqual("dpl-2", self.submit())
+        self.nuvla.provision()
+        # dpl-3 was started to refill the pool
+        self.assertEqual("dpl-3", self.submit())
+        self.assertEqual(5, len(self.nuvla.deployed))
+
+    def test_refill_failure(self):
+        self.config['tsi.nuvla_pool_size'] = 1
+        self.submit()
+        self.nuvla.provision()
+        # claimed deployment is used even if the pool cannot be refilled
+        self.nuvla.fail = True
+        self.assertEqual("dpl-1", self.submit())
+        self.assertEqual(2, len(self.nuvla.deployed))
+        self.assertRaises(RuntimeError, self.submit)
+
+    def test_store(self):
+        store = Reservation.get_store(self.config, self.LOG)
+        self.assertEqual(1, store.connection().execute(
+            "PRAGMA synchronous").fetchone()[0])
+        # the store is reused
+        self.assertTrue(store is Reservation.get_store(self.config,
+                                                       self.LOG))
+        del self.config['tsi.nuvla_pool_stores']
+        os.chmod(self.config['tsi.nuvla_pool_file'], 0o666)
+        store = Reservation.get_store(self.config, self.LOG)
+        self.assertEqual(None, store.connection())
+        self.assertRaises(EnvironmentError, store.deployments, "pool")
+        # unusable stores are not kept
+        self.assertFalse(store is Reservation.get_store(self.config,
+                                                        self.LOG))
+        # no pool is used
+        self.assertEqual("dpl-0", self.submit())
+
+    def test_invalid_reservation_size(self):
+        for size in ("0", "-1", "x", "21"):
+            reply = self.request(Reservation.make_reservation,
+                                 "#TSI_RESERVATION_APPLICATION app/1\n"
+                                 "#TSI_RESERVATION_SIZE %s\n" % size)
+            self.assertTrue(reply[0].startswith(
+                "TSI_FAILED: Invalid TSI_RESERVATION_SIZE"))
+        self.assertEqual(0, len(self.nuvla.deployed))
+
+    def test_reservations(self):
+        reply = self.request(Reservation.make_reservation,
+                             "#TSI_RESERVATION_APPLICATION app/1\n"
+                             "#TSI_RESERVATION_SIZE 2\n")
+        self.assertEqual("TSI_OK", reply[0])
+        reference = "#TSI_RESERVATION_REFERENCE %s\n" % reply[1]
+        self.assertEqual(2, len(self.nuvla.deployed))
+        self.assertEqual(["TSI_OK", "WAITING",
+                          "0 of 2 deployment(s) in the pool ready"],
+                         self.request(Reservation.query_reservation,
+                                      reference))
+        self.nuvla.provision()
+        self.assertEqual("READY", self.request(Reservation.query_reservation,
+                                               reference)[1])
+        # submit claims a reserved deployment, which is replaced
+        self.assertEqual("dpl-0", self.submit())
+        self.assertEqual(3, len(self.nuvla.deployed))
+        # other users cannot see the reservation
+        self.nuvla.username = "bob"
+        self.assertTrue("No such reservation" in self.request(
+            Reservation.query_reservation, reference)[0])
+        self.nuvla.username = "alice"
+        self.assertEqual(["TSI_OK"], self.request(
+            Reservation.cancel_reservation, reference))
+        self.assertEqual(["cancelled", "cancelled"],
+                         [self.nuvla.states[d] for d in ("dpl-1", "dpl-2")])
+        self.assertTrue("No such reservation" in self.request(
+            Reservation.query_reservation, reference)[0])
@@ -0,0 +1,139 @@
+import logging
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import SSL
+import pytest
+from SelfSigned import create_certificate
+
+pytestmark = pytest.mark.local
+
+
+class MockSSLSocket(object):
+    def __init__(self, subject, der=b"certificate"):
+        self.subject = subject
+        self.der = der
+
+    def getpeercert(self, binary_form=False):
+        if binary_form:
+            return self.der
+        return {'subject': self.subject}
+
+
+class TestSSL(unittest.TestCase):
+    def setUp(self):
+        self.LOG = logging.getLogger("tsi.testing")
+        SSL._verified_fingerprints.clear()
+
+    def test_convert_dn(self):
+        dn = SSL.convert_dn("CN=Demo UNICORE, O=UNICORE, C=EU, "
+                            "EMAIL=foo@bar, broken")
+        self.assertEqual(frozenset([("commonName", "Demo UNICORE"),
+                                    ("organizationName", "UNICORE"),
+                                    ("countryName", "EU")]), dn)
+        dn = SSL.convert_dn("/C=DE/dc=example/OU=IT")
+        self.assertEqual(frozenset([("countryName", "DE"),
+                                    ("domainComponent", "example"),
+                                    ("organizationalUnitName", "IT")]), dn)
+        self.assertEqual(frozenset(), SSL.convert_dn("EMAIL=foo@bar"))
+
+    def test_verify_peer(self):
+        subject = ((("countryName", "EU"),),
+                   (("organizationName", "UNICORE"),),
+                   (("commonName", "Demo UNICORE"),))
+        config = {'tsi.allowed_dns': [SSL.convert_dn("CN=Other, C=EU"),
+                                      SSL.convert_dn("O=UNICORE, C=EU")]}
+        fingerprint = SSL.verify_peer(config, MockSSLSocket(subject),
+                                      self.LOG)
+        self.assertEqual(set([fingerprint]), SSL._verified_fingerprints)
+
+        config = {'tsi.allowed_dns': [SSL.convert_dn("CN=Other, C=EU")]}
+        self.assertRaises(EnvironmentError, SSL.verify_peer, config,
+                          MockSSLSocket(subject, b"other"), self.LOG)
+        self.assertRaises(EnvironmentError, SSL.verify_peer, {},
+                          MockSSLSocket(subject, b"other"), self.LOG)
+        # already verified certificate
+        self.assertEqual(None, SSL.verify_peer(config, MockSSLSocket(subject),
+                                               self.LOG))
+
+
+class TestSSLConnection(unittest.TestCase):
+    """ loopback connections using a throwaway self-signed certificate """
+
+    def setUp(self):
+        self.LOG = logging.getLogger("tsi.testing")
+        if not hasattr(SSL.ssl, "SSLContext"):
+            self.skipTest("SSLContext not available")
+        self.path = tempfile.mkdtemp()
+        self.config = create_certificate(self.path)
+        if self.config is None:
+            shutil.rmtree(self.path)
+            self.skipTest("openssl not available")
+        SSL.init_ssl(self.config, self.LOG)
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(2)
+        self.server.settimeout(5)
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.thread.join(5)
+        self.server.close()
+        shutil.rmtree(self.path)
+
+    def serve(self):
+        """ accepts the command and the data connection, and keeps
+        them open until the client closes them
+        """
+        connections = []
+        try:
+            for _ in range(2):
+                sock, _ = self.server.accept()
+                sock.settimeout(5)
+                connections.append(SSL.setup_ssl(self.config, sock, self.LOG,
+                                                 server_mode=True))
+            for connection in connections:
+                connection.recv(1)
+        except (EnvironmentError, socket.timeout):
+            pass
+        finally:
+            for connection in connections:
+                connection.close()
+
+    def connect(self, session=None):
+        sock = socket.create_connection(self.server.getsockname(), 5)
+        return SSL.setup_ssl(self.config, sock, self.LOG, session=session)
+
+    def test_minimum_version(self):
+        context = self.config['tsi.ssl_client_context']
+        if hasattr(context, "minimum_version"):
+            self.assertEqual(SSL.ssl.TLSVersion.TLSv1_2,
+                             context.minimum_version)
+        else:
+            self.assertTrue(context.options & SSL.ssl.OP_NO_TLSv1)
+        command = self.connect()
+        data = self.connect()
+        try:
+            self.assertTrue(command.version() in ("TLSv1.2", "TLSv1.3"))
+        finally:
+            command.close()
+            data.close()
+
+    def test_session_resumption(self):
+        command = self.connect()
+        if SSL.get_session(command) is None:
+            command.close()
+            self.connect().close()
+            self.skipTest("SSL sessions not supported")
+        SSL.receive_session_ticket(command)
+        data = self.connect(session=SSL.get_session(command))
+        try:
+            self.assertTrue(data.session_reused)
+        finally:
+            command.close()
+            data.close()
@@ -0,0 +1,207 @@
+import logging
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import Server
+import SSL
+from Monitor import Monitor
+import pytest
+from SelfSigned import create_certificate
+
+pytestmark = pytest.mark.local
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.LOG = logging.getLogger("tsi.testing")
+
+    def test_recycle_reason(self):
+        config = {'tsi.worker_max_requests': 0, 'tsi.worker_max_rss': 0}
+        self.assertEqual(None, Server.recycle_reason(config, 1000))
+        config['tsi.worker_max_requests'] = "10"
+        self.assertEqual(None, Server.recycle_reason(config, 9))
+        self.assertTrue("10 requests" in Server.recycle_reason(config, 10))
+        config['tsi.worker_max_requests'] = 0
+        config['tsi.worker_max_rss'] = 1
+        self.assertTrue(Server.get_rss() > 1024)
+        self.assertTrue("memory" in Server.recycle_reason(config, 1))
+
+    def test_drain_workers(self):
+        monitor = Monitor({}, self.LOG)
+        handler = signal.signal(signal.SIGCHLD,
+                                lambda s, f: [monitor.worker_exited(pid) for
+                                              pid in Server.worker_completed(
+                                                  s, f)])
+        try:
+            # one worker exits on SIGTERM, the other one ignores it
+            pids = []
+            for ignore in (False, True):
+                pid = os.fork()
+                if pid == 0:
+                    if ignore:
+                        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                    time.sleep(30)
+                    os._exit(0)
+                pids.append(pid)
+                monitor.worker_forked(pid, len(pids), "localhost")
+            time.sleep(0.2)
+            start = time.time()
+            Server.drain_workers(monitor, 1, self.LOG)
+            self.assertTrue(time.time() - start < 5)
+            time.sleep(0.2)
+            Server.worker_completed(None, None)
+            for pid in pids:
+                self.assertRaises(OSError, os.kill, pid, 0)
+        finally:
+            signal.signal(signal.SIGCHLD, handler)
+            monitor.close()
+
+
+class TestSocketOptions(unittest.TestCase):
+    def setUp(self):
+        self.LOG = logging.getLogger("tsi.testing")
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(5)
+        self.address = self.server.getsockname()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_buffer_sizes(self):
+        config = {'tsi.socket_sndbuf': 65536, 'tsi.socket_rcvbuf': "131072"}
+        sock = Server.create_connection(self.address, config)
+        try:
+            # Linux reports twice the requested size
+            self.assertTrue(sock.getsockopt(socket.SOL_SOCKET,
+                                            socket.SO_SNDBUF) >= 65536)
+            self.assertTrue(sock.getsockopt(socket.SOL_SOCKET,
+                                            socket.SO_RCVBUF) >= 131072)
+        finally:
+            sock.close()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        default = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        Server.set_buffer_sizes(sock, {})
+        self.assertEqual(default, sock.getsockopt(socket.SOL_SOCKET,
+                                                  socket.SO_SNDBUF))
+        sock.close()
+
+    def test_nodelay(self):
+        for nodelay in (False, True):
+            sock = Server.create_connection(self.address, {})
+            try:
+                Server.configure_socket(sock, self.LOG, nodelay=nodelay)
+                self.assertEqual(nodelay, 0 != sock.getsockopt(
+                    socket.IPPROTO_TCP, socket.TCP_NODELAY))
+                self.assertNotEqual(0, sock.getsockopt(
+                    socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+            finally:
+                sock.close()
+
+
+class TestWorkerConnection(unittest.TestCase):
+    def setUp(self):
+        self.LOG = logging.getLogger("tsi.testing")
+        # connection from the XNJS (peer) accepted by the shepherd
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        self.peer = socket.create_connection(server.getsockname(), 5)
+        self.xnjs = server.accept()[0]
+        server.close()
+        self.sockets = [self.xnjs, self.peer]
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+    def test_listen_backlog(self):
+        for (backlog, expected) in ((1, False), (64, True)):
+            config = {'tsi.my_addr': "127.0.0.1", 'tsi.my_port': 0,
+                      'tsi.listen_backlog': backlog}
+            server = Server.create_server(config, False, self.LOG)
+            self.sockets.append(server)
+            # nobody accepts: connections beyond the backlog time out
+            connected = 0
+            for _ in range(4):
+                client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.sockets.append(client)
+                client.settimeout(0.3)
+                try:
+                    client.connect(server.getsockname())
+                    connected += 1
+                except socket.timeout:
+                    pass
+            self.assertEqual(expected, connected == 4)
+
+    def test_handshake_timeout(self):
+        # the peer does not send anything
+        config = {'tsi.handshake_timeout': 0.2}
+        start = time.time()
+        self.assertRaises(EnvironmentError, Server.setup_worker_connection,
+                          config, self.xnjs, "127.0.0.1", False, self.LOG)
+        self.assertTrue(time.time() - start < 2)
+
+    def test_ssl_handshake_timeout(self):
+        path = tempfile.mkdtemp()
+        try:
+            config = create_certificate(path)
+            if config is None or not hasattr(SSL.ssl, "SSLContext"):
+                self.skipTest("openssl or SSLContext not available")
+            SSL.init_ssl(config, self.LOG)
+            config['tsi.handshake_timeout'] = 0.2
+            xnjs = SSL.setup_ssl(config, self.xnjs, self.LOG, True,
+                                 handshake=False)
+            self.sockets.append(xnjs)
+            start = time.time()
+            self.assertRaises(EnvironmentError,
+                              Server.setup_worker_connection, config, xnjs,
+                              "127.0.0.1", True, self.LOG)
+            self.assertTrue(time.time() - start < 2)
+        finally:
+            shutil.rmtree(path)
+
+    def test_setup_worker_connection(self):
+        # the XNJS listens for the callbacks on a local port
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sockets.append(listener)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(2)
+        listener.settimeout(5)
+        accepted = []
+
+        def accept():
+            for _ in range(2):
+                accepted.append(listener.accept()[0])
+        thread = threading.Thread(target=accept)
+        thread.daemon = True
+        thread.start()
+
+        monitor = Monitor({}, self.LOG)
+        try:
+            config = {'tsi.monitor': monitor}
+            self.peer.sendall(b"newtsiprocess %d\n"
+                              % listener.getsockname()[1])
+            (command, data) = Server.setup_worker_connection(
+                config, self.xnjs, "127.0.0.1", False, self.LOG)
+            self.sockets.extend([command, data])
+            thread.join(5)
+            self.sockets.extend(accepted)
+            self.assertEqual(b"OK\n", self.peer.recv(1024))
+            self.assertEqual(2, len(accepted))
+            command.sendall(b"c")
+            data.sendall(b"d")
+            self.assertEqual(b"c", accepted[0].recv(1))
+            self.assertEqual(b"d", accepted[1].recv(1))
+            self.assertNotEqual(0, command.getsockopt(socket.IPPROTO_TCP,
+                                                      socket.TCP_NODELAY))
+            monitor.handle(monitor.events_in)
+            self.assertEqual(1, monitor.status()["latency"]["setup"]["count"])
+        finally:
+            monitor.close()
@@ -0,0 +1,220 @@
+import collections
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from multiprocessing.pool import ThreadPool
+
+import UserCache
+import pytest
+from test_IO import JoiningPool
+
+pytestmark = pytest.mark.local
+
+Group = collections.namedtuple("Group", ["gr_name", "gr_passwd", "gr_gid",
+                                         "gr_mem"])
+
+
+class FakeGrp(object):
+    """ replaces the grp module, counting enumerations """
+
+    def __init__(self, groups):
+        self.groups = groups
+        self.enumerations = 0
+        self.delay = 0
+
+    def getgrall(self):
+        self.enumerations += 1
+        time.sleep(self.delay)
+        return list(self.groups)
+
+    def getgrnam(self, name):
+        for g in self.groups:
+            if g.gr_name == name:
+                return g
+        raise KeyError(name)
+
+
+class FakePwd(object):
+    """ replaces the pwd module, counting lookups """
+
+    def __init__(self):
+        self.lookups = 0
+
+    def getpwnam(self, user):
+        self.lookups += 1
+        if user != "alice":
+            raise KeyError(user)
+        return ("alice", "x", 1000, 1000, "", "/home/alice", "/bin/sh")
+
+    def getpwall(self):
+        return [("alice", "x", 1000, 1000, "", "/home/alice", "/bin/sh"),
+                ("bob", "x", 1001, 1001, "", "/home/bob", "/bin/sh")]
+
+
+class TestUserCache(unittest.TestCase):
+    def setUp(self):
+        self.LOG = logging.getLogger("tsi.testing")
+        self.grp = UserCache.grp
+        self.pwd = UserCache.pwd
+        self.fake = FakeGrp([Group("users", "x", 100, ["alice", "bob"]),
+                             Group("hpc", "x", 200, ["alice"]),
+                             Group("empty", "x", 300, [])])
+        self.fake_pwd = FakePwd()
+        UserCache.grp = self.fake
+        UserCache.pwd = self.fake_pwd
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        UserCache.grp = self.grp
+        UserCache.pwd = self.pwd
+        shutil.rmtree(self.path)
+
+    def test_membership_index(self):
+        cache = UserCache.UserCache(600, self.LOG)
+        self.assertEqual([100, 200, 1000],
+                         cache.get_gids_4user_nc("alice", 1000))
+        self.assertEqual([100, 1001], cache.get_gids_4user_nc("bob", 1001))
+        self.assertEqual([1002], cache.get_gids_4user_nc("carol", 1002))
+        self.assertEqual(1, self.fake.enumerations)
+
+    def test_membership_index_expires(self):
+        cache = UserCache.UserCache(600, self.LOG)
+        cache.get_gids_4user_nc("alice", 1000)
+        self.fake.groups.append(Group("new", "x", 400, ["alice"]))
+        self.assertEqual([100, 200, 1000],
+                         cache.get_gids_4user_nc("alice", 1000))
+        cache.memberships_timestamp -= 601
+        self.assertEqual([100, 200, 400, 1000],
+                         cache.get_gids_4user_nc("alice", 1000))
+        self.assertEqual(2, self.fake.enumerations)
+
+    def test_membership_index_single_flight(self):
+        cache = UserCache.UserCache(600, self.LOG)
+        self.fake.delay = 0.2
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            cache.get_gids_4user_nc("alice", 1000))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual([[100, 200, 1000]] * 4, results)
+        self.assertEqual(1, self.fake.enumerations)
+
+    def test_shared_store(self):
+        shared_file = os.path.join(self.path, "users.db")
+        cache = UserCache.UserCache(600, self.LOG, shared_file)
+        cache.prewarm(["alice"])
+        self.assertEqual(1, self.fake_pwd.lookups)
+        # a new cache (as in a forked worker) uses the shared entries
+        worker_cache = UserCache.UserCache(600, self.LOG, shared_file)
+        self.assertEqual(1000, worker_cache.get_uid_4user("alice"))
+        self.assertEqual("/home/alice", worker_cache.get_home_4user("alice"))
+        self.assertEqual([100, 200, 1000],
+                         worker_cache.get_gids_4user("alice"))
+        self.assertEqual(1, self.fake_pwd.lookups)
+        self.assertEqual(0o600, os.stat(shared_file).st_mode & 0o777)
+        self.assertEqual(0, worker_cache.shared.connection().execute(
+            "PRAGMA synchronous").fetchone()[0])
+        # expired entries are looked up again
+        worker_cache = UserCache.UserCache(0, self.LOG, shared_file)
+        self.assertEqual(1000, worker_cache.get_uid_4user("alice"))
+        self.assertEqual(2, self.fake_pwd.lookups)
+
+    def test_shared_store_not_used_if_writable_by_others(self):
+        shared_file = os.path.join(self.path, "users.db")
+        with open(shared_file, "w"):
+            pass
+        os.chmod(shared_file, 0o666)
+        cache = UserCache.UserCache(600, self.LOG, shared_file)
+        self.assertEqual(None, cache.shared.connection())
+        self.assertEqual(1000, cache.get_uid_4user("alice"))
+
+    def test_negative_entries(self):
+        cache = UserCache.UserCache(600, self.LOG, negative_ttl=60)
+        self.assertEqual(-1, cache.get_uid_4user("nobody"))
+        self.assertEqual(-1, cache.get_uid_4user("nobody"))
+        self.assertEqual(1, self.fake_pwd.lookups)
+        cache.users["nobody"].timestamp -= 61
+        self.assertEqual(-1, cache.get_uid_4user("nobody"))
+        self.assertEqual(2, self.fake_pwd.lookups)
+
+    def test_stale_entries_are_refreshed_in_background(self):
+        cache = UserCache.UserCache(600, self.LOG, max_stale=3600)
+        self.assertEqual(1000, cache.get_uid_4user("alice"))
+        cache.users["alice"].timestamp -= 601
+        # served from cache, refresh running
+        self.assertEqual(1000, cache.get_uid_4user("alice"))
+        self.assertEqual(1000, cache.get_uid_4user("alice"))
+        for _ in range(100):
+            if len(cache.refreshed) > 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(2, self.fake_pwd.lookups)
+        self.assertEqual(1000, cache.get_uid_4user("alice"))
+        self.assertFalse(cache.expired(cache.users["alice"].timestamp))
+        self.assertEqual(set(), cache.refreshing)
+        # too old entries are not used
+        cache.users["alice"].timestamp -= 3601
+        self.assertEqual(1000, cache.get_uid_4user("alice"))
+        self.assertEqual(3, self.fake_pwd.lookups)
+        self.assertEqual(set(), cache.refreshing)
+
+    def test_lru_eviction(self):
+        cache = UserCache.UserCache(600, self.LOG, max_entries=2)
+        for user in ["alice", "bob", "alice", "carol"]:
+            cache.get_uid_4user(user)
+        self.assertEqual(["alice", "carol"], list(cache.users.keys()))
+        stats = cache.statistics()
+        self.assertEqual(2, stats["users"])
+        self.assertEqual(1, stats["hits"])
+        self.assertEqual(3, stats["misses"])
+        self.assertEqual(1, stats["evictions"])
+
+    def test_identities(self):
+        cache = UserCache.UserCache(600, self.LOG)
+        self.assertEqual(None, cache.get_identity("alice", ["hpc", "users"]))
+        cache.put_identity("alice", ["hpc", "users"],
+                           (1000, 200, [200, 100], "/home/alice"))
+        self.assertEqual((1000, 200, [200, 100], "/home/alice"),
+                         cache.get_identity("alice", ["hpc", "users"]))
+        self.assertEqual(None, cache.get_identity("alice", ["users"]))
+        cache.identities[("alice", ("hpc", "users"))].timestamp -= 601
+        self.assertEqual(None, cache.get_identity("alice", ["hpc", "users"]))
+        stats = cache.statistics()
+        self.assertEqual((1, 3), (stats["identity_hits"],
+                                  stats["identity_misses"]))
+        # the user/group entry statistics are not affected
+        self.assertEqual((0, 0), (stats["hits"], stats["misses"]))
+
+    def test_prewarm(self):
+        cache = UserCache.UserCache(600, self.LOG)
+        cache.prewarm(["a*", "carol"], ["*"])
+        self.assertEqual(["alice", "carol"], sorted(cache.users.keys()))
+        self.assertEqual(["empty", "hpc", "users"],
+                         sorted(cache.groups.keys()))
+        # only carol was looked up by name
+        self.assertEqual(1, self.fake_pwd.lookups)
+        self.assertEqual(-1, cache.get_uid_4user("carol"))
+        self.assertEqual([100, 200, 1000], cache.get_gids_4user("alice"))
+        self.assertEqual(["alice"], cache.get_members_4group("hpc"))
+        self.assertEqual(0, cache.statistics()["misses"])
+
+    def test_prewarm_with_threads(self):
+        cache = UserCache.UserCache(600, self.LOG)
+        joined = len(JoiningPool.joined)
+        UserCache.ThreadPool = JoiningPool
+        try:
+            cache.prewarm(["alice", "bob", "carol"], ["hpc", "users"], 3)
+        finally:
+            UserCache.ThreadPool = ThreadPool
+        # no threads of the pools are left when the shepherd forks
+        self.assertEqual(joined + 2, len(JoiningPool.joined))
+        self.assertEqual(3, self.fake_pwd.lookups)
+        self.assertEqual(1000, cache.get_uid_4user("alice"))
+        self.assertEqual(200, cache.get_gid_4group("hpc"))
+        self.assertEqual(0, cache.statistics()["misses"])